@@ -0,0 +1,361 @@
+import json
+
+import click
+
+from .common import format_results_table
+from .replay import REPLAY_RESULT_COLUMNS
+from .runner import END_TO_END_RESULT_COLUMNS, get_benchmark_scenarios, run_end_to_end_benchmark, run_replay_benchmark
+from .serialization import SERIALIZATION_RESULT_COLUMNS, run_serialization_benchmark
+from .standin import SyntheticTableSpec, SYNTHETIC_COLUMN_TYPES
+from ..constants import DEFAULT_BENCHMARK_ITERATIONS, DEFAULT_BENCHMARK_WARMUP_ITERATIONS, \
+    DEFAULT_WEBSOCKET_FRAGMENT_SIZE, IPC_COMPRESSION_CODECS, DEFAULT_REPLAY_SPEED
+
+
+def report_results(results: list[dict],
+                   columns: list[tuple[str, str]],
+                   output: str | None
+                   ):
+    click.echo(format_results_table(results=results, columns=columns))
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        click.echo(f"Wrote results to: '{output}'")
+
+
+def get_types(types: str) -> tuple[str, ...]:
+    return tuple(column_type.strip().lower() for column_type in types.split(",") if column_type.strip())
+
+
+@click.group()
+def click_run_benchmark():
+    """
+    Benchmarks for the Arrow Flight SQL WebSocket Proxy Server's data path - no GizmoSQL deployment needed.
+    """
+
+
+@click_run_benchmark.command(name="end-to-end",
+                             context_settings=dict(ignore_unknown_options=True)
+                             )
+@click.option(
+    "--rows",
+    type=int,
+    multiple=True,
+    default=[100_000, 1_000_000],
+    show_default=True,
+    required=True,
+    help="The row count(s) of the synthetic results.  May be given more than once."
+)
+@click.option(
+    "--columns",
+    type=int,
+    default=SyntheticTableSpec._field_defaults["columns"],
+    show_default=True,
+    required=True,
+    help="The number of columns in the synthetic results."
+)
+@click.option(
+    "--types",
+    type=str,
+    default=",".join(SyntheticTableSpec._field_defaults["types"]),
+    show_default=True,
+    required=True,
+    help=f"A comma-separated list of column types - cycled over the columns.  Types: {', '.join(SYNTHETIC_COLUMN_TYPES)}."
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=SyntheticTableSpec._field_defaults["batch_size"],
+    show_default=True,
+    required=True,
+    help="The rows per record batch sent by the Flight SQL stand-in backend."
+)
+@click.option(
+    "--nulls",
+    type=float,
+    default=SyntheticTableSpec._field_defaults["nulls"],
+    show_default=True,
+    required=True,
+    help="The fraction of values which are null."
+)
+@click.option(
+    "--fetch-mode",
+    type=click.Choice(["all", "batch", "stream"]),
+    multiple=True,
+    default=["all", "batch", "stream"],
+    show_default=True,
+    required=True,
+    help="The fetch mode(s) to benchmark.  May be given more than once."
+)
+@click.option(
+    "--fetch-size",
+    type=int,
+    multiple=True,
+    default=[10_000, 100_000],
+    show_default=True,
+    required=True,
+    help="The fetch size(s) (in rows) to benchmark the batch and stream fetch modes with.  May be given more than once."
+)
+@click.option(
+    "--result-format",
+    type=click.Choice(["binary", "base64"]),
+    multiple=True,
+    default=["binary"],
+    show_default=True,
+    required=True,
+    help="The result format(s) to benchmark.  May be given more than once."
+)
+@click.option(
+    "--websocket-compression",
+    type=click.Choice(["deflate", "none"]),
+    default="deflate",
+    show_default=True,
+    required=True,
+    help="Whether the benchmark client offers permessage-deflate websocket compression (as browsers do)."
+)
+@click.option(
+    "--iterations",
+    type=int,
+    default=DEFAULT_BENCHMARK_ITERATIONS,
+    show_default=True,
+    required=True,
+    help="The number of measured runs of each scenario."
+)
+@click.option(
+    "--warmup-iterations",
+    type=int,
+    default=DEFAULT_BENCHMARK_WARMUP_ITERATIONS,
+    show_default=True,
+    required=True,
+    help="The number of unmeasured runs of each scenario - before its measured runs."
+)
+@click.option(
+    "--server-log-level",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]),
+    default="WARNING",
+    show_default=True,
+    required=True,
+    help="The log level of the proxy server under test."
+)
+@click.option(
+    "--output",
+    type=str,
+    default=None,
+    required=False,
+    help="A file to write the results to - as JSON."
+)
+@click.argument("server_arguments",
+                nargs=-1,
+                type=click.UNPROCESSED
+                )
+def click_run_end_to_end_benchmark(rows: tuple[int],
+                                   columns: int,
+                                   types: str,
+                                   batch_size: int,
+                                   nulls: float,
+                                   fetch_mode: tuple[str],
+                                   fetch_size: tuple[int],
+                                   result_format: tuple[str],
+                                   websocket_compression: str,
+                                   iterations: int,
+                                   warmup_iterations: int,
+                                   server_log_level: str,
+                                   output: str | None,
+                                   server_arguments: tuple[str]
+                                   ):
+    """
+    Runs the real proxy server against a local Flight SQL stand-in backend - with authentication bypassed - and
+    measures rows/s, bytes/s, p50/p99 fetch latency and the server's peak RSS across fetch modes and sizes.
+
+    Any SERVER_ARGUMENTS are passed to the proxy server - e.g.: -- --prefetch-batches 4
+    """
+    specs = [SyntheticTableSpec(rows=row_count,
+                                columns=columns,
+                                types=get_types(types),
+                                batch_size=batch_size,
+                                nulls=nulls
+                                )
+             for row_count in rows]
+    scenarios = get_benchmark_scenarios(specs=specs,
+                                        fetch_modes=list(fetch_mode),
+                                        fetch_sizes=list(fetch_size),
+                                        result_formats=list(result_format)
+                                        )
+    results = run_end_to_end_benchmark(scenarios=scenarios,
+                                       iterations=iterations,
+                                       warmup_iterations=warmup_iterations,
+                                       websocket_compression=websocket_compression,
+                                       server_arguments=list(server_arguments),
+                                       server_log_level=server_log_level
+                                       )
+    report_results(results=results,
+                   columns=END_TO_END_RESULT_COLUMNS,
+                   output=output
+                   )
+
+
+@click_run_benchmark.command(name="serialization")
+@click.option(
+    "--rows",
+    type=int,
+    default=1_000_000,
+    show_default=True,
+    required=True,
+    help="The row count of the synthetic table."
+)
+@click.option(
+    "--columns",
+    type=int,
+    default=SyntheticTableSpec._field_defaults["columns"],
+    show_default=True,
+    required=True,
+    help="The number of columns in the synthetic table."
+)
+@click.option(
+    "--types",
+    type=str,
+    default=",".join(SyntheticTableSpec._field_defaults["types"]),
+    show_default=True,
+    required=True,
+    help=f"A comma-separated list of column types - cycled over the columns.  Types: {', '.join(SYNTHETIC_COLUMN_TYPES)}."
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=SyntheticTableSpec._field_defaults["batch_size"],
+    show_default=True,
+    required=True,
+    help="The rows per record batch."
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["none"] + IPC_COMPRESSION_CODECS),
+    multiple=True,
+    default=["none"] + IPC_COMPRESSION_CODECS,
+    show_default=True,
+    required=True,
+    help="The IPC compression codec(s) to benchmark.  May be given more than once."
+)
+@click.option(
+    "--max-fragment-size",
+    type=int,
+    default=DEFAULT_WEBSOCKET_FRAGMENT_SIZE,
+    show_default=True,
+    required=True,
+    help="The websocket fragment size for get_record_batches_ipc_fragments."
+)
+@click.option(
+    "--repeat",
+    type=int,
+    default=5,
+    show_default=True,
+    required=True,
+    help="The number of timed calls of each helper."
+)
+@click.option(
+    "--output",
+    type=str,
+    default=None,
+    required=False,
+    help="A file to write the results to - as JSON."
+)
+def click_run_serialization_benchmark(rows: int,
+                                      columns: int,
+                                      types: str,
+                                      batch_size: int,
+                                      compression: tuple[str],
+                                      max_fragment_size: int,
+                                      repeat: int,
+                                      output: str | None
+                                      ):
+    """
+    Microbenchmarks the Arrow IPC / base64 serialization helpers in utils.py.
+    """
+    results = run_serialization_benchmark(spec=SyntheticTableSpec(rows=rows,
+                                                                  columns=columns,
+                                                                  types=get_types(types),
+                                                                  batch_size=batch_size
+                                                                  ),
+                                          compressions=list(compression),
+                                          max_fragment_size=max_fragment_size,
+                                          repeat=repeat
+                                          )
+    report_results(results=results,
+                   columns=SERIALIZATION_RESULT_COLUMNS,
+                   output=output
+                   )
+
+
+@click_run_benchmark.command(name="replay",
+                             context_settings=dict(ignore_unknown_options=True)
+                             )
+@click.option(
+    "--capture-file",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    help="A workload capture - written by the proxy server's --capture-file option."
+)
+@click.option(
+    "--speed",
+    type=float,
+    default=DEFAULT_REPLAY_SPEED,
+    show_default=True,
+    required=True,
+    help="How fast to replay the capture - 1 at the captured pace, 2 twice as fast, etc.  0 sends each request as soon as it can."
+)
+@click.option(
+    "--websocket-compression",
+    type=click.Choice(["deflate", "none"]),
+    default="deflate",
+    show_default=True,
+    required=True,
+    help="Whether the replay client offers permessage-deflate websocket compression (as browsers do)."
+)
+@click.option(
+    "--server-log-level",
+    type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]),
+    default="WARNING",
+    show_default=True,
+    required=True,
+    help="The log level of the proxy server under test."
+)
+@click.option(
+    "--output",
+    type=str,
+    default=None,
+    required=False,
+    help="A file to write the results to - as JSON."
+)
+@click.argument("server_arguments",
+                nargs=-1,
+                type=click.UNPROCESSED
+                )
+def click_run_replay_benchmark(capture_file: str,
+                               speed: float,
+                               websocket_compression: str,
+                               server_log_level: str,
+                               output: str | None,
+                               server_arguments: tuple[str]
+                               ):
+    """
+    Replays a captured workload against the real proxy server in front of a local Flight SQL stand-in backend -
+    which stands in for each captured query with a synthetic result of the captured row count and execution time -
+    so a production traffic shape can be replayed without production data (or a GizmoSQL deployment).
+
+    Any SERVER_ARGUMENTS are passed to the proxy server - e.g.: -- --prefetch-batches 4
+    """
+    results, replayer = run_replay_benchmark(capture_file=capture_file,
+                                             speed=speed,
+                                             websocket_compression=websocket_compression,
+                                             server_arguments=list(server_arguments),
+                                             server_log_level=server_log_level
+                                             )
+    report_results(results=results,
+                   columns=REPLAY_RESULT_COLUMNS + [("peak_rss_bytes", "{:,}")],
+                   output=output
+                   )
+    captured_seconds, replay_seconds = replayer.get_durations()
+    click.echo(f"Captured over {captured_seconds:.2f} second(s) - replayed in {replay_seconds:.2f} second(s)")
+
+
+if __name__ == "__main__":
+    click_run_benchmark()
@@ -0,0 +1,27 @@
+def format_results_table(results: list[dict],
+                         columns: list[tuple[str, str]]
+                         ) -> str:
+    """
+    :param columns: (result key, format string) pairs - in display order.  None values are shown as '-'.
+    :return: The results as a right-aligned, plain text table.
+    """
+    rows = [[name for name, _ in columns]] + [["-" if result[name] is None else column_format.format(result[name])
+                                                for name, column_format in columns]
+                                               for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join("  ".join(value.rjust(width) for value, width in zip(row, widths)) for row in rows)
+
+
+def get_percentile(values: list[float],
+                   percentile: float
+                   ) -> float | None:
+    """
+    :return: The percentile (0-100) of the values - linearly interpolated between the closest ranks.
+    """
+    if not values:
+        return None
+    sorted_values = sorted(values)
+    rank = (len(sorted_values) - 1) * percentile / 100
+    lower_index = int(rank)
+    upper_index = min(lower_index + 1, len(sorted_values) - 1)
+    return sorted_values[lower_index] + (sorted_values[upper_index] - sorted_values[lower_index]) * (rank - lower_index)
@@ -0,0 +1,225 @@
+import asyncio
+import random
+import re
+import ssl
+import time
+from collections import Counter
+from typing import NamedTuple
+
+from websockets.exceptions import ConnectionClosed
+
+from .common import get_percentile
+from .session import BenchmarkError, BenchmarkSession
+from ..config import logger
+
+WORKLOAD_DIRECTIVE_PATTERN = re.compile(r"^\s*--\s*(name|weight)\s*:\s*(\S+)\s*$", re.I)
+LOAD_RESULT_COLUMNS = [("statement", "{}"), ("queries", "{:,}"), ("errors", "{:,}"), ("queries_per_second", "{:,.2f}"),
+                       ("rows_per_second", "{:,.0f}"), ("bytes_per_second", "{:,.0f}"), ("latency_p50_seconds", "{:.4f}"),
+                       ("latency_p90_seconds", "{:.4f}"), ("latency_p99_seconds", "{:.4f}"),
+                       ("latency_max_seconds", "{:.4f}"), ("server_queue_seconds", "{:.4f}"),
+                       ("server_execute_seconds", "{:.4f}"), ("server_read_seconds", "{:.4f}"),
+                       ("server_serialize_seconds", "{:.4f}")
+                       ]
+
+
+class WorkloadStatement(NamedTuple):
+    name: str
+    sql: str
+    weight: float
+
+
+def read_workload(path: str) -> list[WorkloadStatement]:
+    """
+    Reads SQL statements (each terminated by a semicolon at the end of a line) from a file.  Comment lines
+    of the form "-- name: <name>" and "-- weight: <weight>" just before a statement name it and set its relative
+    frequency (default: 1).
+    """
+    statements = []
+    directives = {}
+    lines = []
+    with open(path) as workload_file:
+        for line in workload_file:
+            directive_match = WORKLOAD_DIRECTIVE_PATTERN.match(line)
+            if directive_match and not lines:
+                directives[directive_match.group(1).lower()] = directive_match.group(2)
+                continue
+
+            if line.strip() or lines:
+                lines.append(line.rstrip("\n"))
+
+            if re.search(r";\s*$", line):
+                statements.append(WorkloadStatement(name=directives.get("name", f"statement_{len(statements) + 1}"),
+                                                    sql="\n".join(lines).strip().rstrip(";"),
+                                                    weight=float(directives.get("weight", 1))
+                                                    )
+                                  )
+                directives = {}
+                lines = []
+
+    if "\n".join(lines).strip():
+        raise ValueError(f"The last statement in workload file: '{path}' is not terminated by a semicolon")
+    if not statements:
+        raise ValueError(f"Workload file: '{path}' has no SQL statements")
+    return statements
+
+
+class LoadGenerator:
+    """
+    Runs a weighted workload over concurrent sessions - as fast as possible (each session runs its next query as
+    soon as its last one is fetched), or at a target rate across all sessions.
+
+    At a target rate, queries are scheduled ahead of time and their latency is measured from when they were
+    scheduled - so that a proxy which falls behind shows it, rather than slowing the load down to its own pace.
+    """
+    def __init__(self,
+                 server_uri: str,
+                 token: str,
+                 statements: list[WorkloadStatement],
+                 sessions: int,
+                 rate: float,
+                 duration: float,
+                 max_queries: int,
+                 fetch_mode: str,
+                 fetch_size: int,
+                 stream_credits: int,
+                 result_format: str,
+                 ssl_context: ssl.SSLContext | None = None,
+                 autocommit: bool = True,
+                 compression: str | None = None,
+                 compression_level: int | None = None,
+                 seed: int | None = None
+                 ):
+        self.server_uri = server_uri
+        self.token = token
+        self.statements = statements
+        self.sessions = sessions
+        self.rate = rate
+        self.duration = duration
+        self.max_queries = max_queries
+        self.fetch_mode = fetch_mode
+        self.fetch_size = fetch_size
+        self.stream_credits = stream_credits
+        self.result_format = result_format
+        self.ssl_context = ssl_context
+        self.autocommit = autocommit
+        self.compression = compression
+        self.compression_level = compression_level
+        self.random = random.Random(seed)
+
+        self.records: list[dict] = []
+        self.queries_started = 0
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+
+    async def open_session(self) -> BenchmarkSession:
+        return await BenchmarkSession.open(server_uri=self.server_uri,
+                                           token=self.token,
+                                           result_format=self.result_format,
+                                           ssl_context=self.ssl_context,
+                                           autocommit=self.autocommit,
+                                           compression=self.compression,
+                                           compression_level=self.compression_level
+                                           )
+
+    def next_query(self) -> tuple[WorkloadStatement, float] | None:
+        """
+        :return: The next statement to run and when to run it - or None once the run is over.
+        """
+        query_number = self.queries_started
+        if self.max_queries and query_number >= self.max_queries:
+            return None
+
+        scheduled_time = self.start_time + query_number / self.rate if self.rate else time.perf_counter()
+        if self.duration and scheduled_time - self.start_time >= self.duration:
+            return None
+
+        self.queries_started += 1
+        statement = self.random.choices(self.statements, weights=[statement.weight for statement in self.statements])[0]
+        return statement, scheduled_time
+
+    async def run_session(self):
+        session = None
+        try:
+            while next_query := self.next_query():
+                statement, scheduled_time = next_query
+                await asyncio.sleep(max(scheduled_time - time.perf_counter(), 0))
+
+                record = dict(statement=statement.name, error=None)
+                try:
+                    if session is None:
+                        session = await self.open_session()
+                    record.update(await session.run_query(sql=statement.sql,
+                                                          fetch_mode=self.fetch_mode,
+                                                          fetch_size=self.fetch_size,
+                                                          stream_credits=self.stream_credits
+                                                          )
+                                  )
+                except (BenchmarkError, ConnectionClosed, OSError) as e:
+                    record.update(error=str(e))
+                    if not isinstance(e, BenchmarkError):
+                        # The session is gone - the next query opens a new one
+                        session = None
+
+                record.update(latency_seconds=time.perf_counter() - scheduled_time)
+                self.records.append(record)
+        finally:
+            if session:
+                await session.close()
+
+    async def run(self) -> list[dict]:
+        logger.info(msg=f"Running workload of {len(self.statements)} statement(s) over {self.sessions} session(s) - "
+                        f"rate: {self.rate or 'as fast as possible'} - duration: {self.duration or 'unlimited'} "
+                        f"second(s) - max queries: {self.max_queries or 'unlimited'}")
+        self.start_time = time.perf_counter()
+        await asyncio.gather(*[self.run_session() for _ in range(self.sessions)])
+        self.end_time = time.perf_counter()
+        return self.summarize()
+
+    def summarize_records(self,
+                          statement: str,
+                          records: list[dict],
+                          elapsed_seconds: float
+                          ) -> dict:
+        successes = [record for record in records if not record["error"]]
+        latencies = [record["latency_seconds"] for record in successes]
+
+        def get_mean_server_timing(name: str) -> float | None:
+            values = [record["server_timings"][name] for record in successes
+                      if record["server_timings"].get(name) is not None]
+            return sum(values) / len(values) if values else None
+
+        return dict(statement=statement,
+                    queries=len(records),
+                    errors=len(records) - len(successes),
+                    queries_per_second=len(successes) / elapsed_seconds,
+                    rows_per_second=sum(record["rows"] for record in successes) / elapsed_seconds,
+                    bytes_per_second=sum(record["wire_bytes"] for record in successes) / elapsed_seconds,
+                    latency_p50_seconds=get_percentile(latencies, 50),
+                    latency_p90_seconds=get_percentile(latencies, 90),
+                    latency_p99_seconds=get_percentile(latencies, 99),
+                    latency_max_seconds=max(latencies, default=None),
+                    server_queue_seconds=get_mean_server_timing("queue_seconds"),
+                    server_execute_seconds=get_mean_server_timing("execute_seconds"),
+                    server_read_seconds=get_mean_server_timing("read_seconds"),
+                    server_serialize_seconds=get_mean_server_timing("serialize_seconds")
+                    )
+
+    def summarize(self) -> list[dict]:
+        """
+        :return: One summary per statement - then one for the whole workload (server timings are means per query).
+        """
+        elapsed_seconds = self.end_time - self.start_time
+        summaries = [self.summarize_records(statement=statement.name,
+                                            records=[record for record in self.records if record["statement"] == statement.name],
+                                            elapsed_seconds=elapsed_seconds
+                                            )
+                     for statement in self.statements]
+        summaries.append(self.summarize_records(statement="(all)",
+                                                records=self.records,
+                                                elapsed_seconds=elapsed_seconds
+                                                )
+                         )
+        return summaries
+
+    def get_error_counts(self) -> Counter:
+        return Counter(record["error"] for record in self.records if record["error"])
@@ -0,0 +1,360 @@
+import asyncio
+import json
+import ssl
+import time
+from collections import defaultdict
+
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed
+
+from .common import get_percentile
+from ..config import logger
+from ..constants import CAPTURE_FORMAT_VERSION, REPLAY_DRAIN_TIMEOUT
+
+REPLAY_RESULT_COLUMNS = [("action", "{}"), ("requests", "{:,}"), ("errors", "{:,}"), ("skipped", "{:,}"),
+                         ("latency_p50_seconds", "{:.4f}"), ("latency_p99_seconds", "{:.4f}"),
+                         ("lag_p99_seconds", "{:.4f}"), ("rows", "{:,}"), ("captured_rows", "{:,}"),
+                         ("bytes", "{:,}"), ("captured_bytes", "{:,}")
+                         ]
+# Actions which refer to an earlier query of the session - they cannot be sent until it has its (replayed) ID
+QUERY_ACTIONS = {"fetch", "grantCredits", "closeCursor"}
+
+
+def read_capture(path: str) -> tuple[dict, dict[int, list[dict]]]:
+    """
+    Reads a capture written by the server's --capture-file option.
+
+    :return: The capture's header - and each session's events (in time order) by session number.
+    """
+    sessions = defaultdict(list)
+    with open(path) as capture_file:
+        header = json.loads(capture_file.readline() or "{}")
+        if header.get("capture") != "flight-sql-websocket-proxy":
+            raise ValueError(f"File: '{path}' is not a workload capture")
+        if header.get("version") != CAPTURE_FORMAT_VERSION:
+            raise ValueError(f"Workload capture: '{path}' has version: {header.get('version')} - expected: {CAPTURE_FORMAT_VERSION}")
+
+        for line in capture_file:
+            # A capture cut off mid-write (e.g. by the server being killed) ends with a partial line
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(msg=f"Skipping a malformed line in workload capture: '{path}'")
+                continue
+            sessions[event["s"]].append(event)
+
+    for events in sessions.values():
+        events.sort(key=lambda event: event["t"])
+    return header, dict(sessions)
+
+
+class ReplayRequest:
+    def __init__(self,
+                 action: str,
+                 scheduled_time: float
+                 ):
+        self.action = action
+        self.scheduled_time = scheduled_time
+        self.sent_time: float | None = None
+        self.latency_seconds: float | None = None
+        self.error: str | None = None
+        self.skipped: bool = False
+        self.done: bool = False
+        self.rows = 0
+        self.wire_bytes = 0
+
+
+class WorkloadReplayer:
+    """
+    Re-drives a captured workload against a proxy - each captured session on its own websocket, opened, sent its
+    requests and closed at the captured times (divided by speed).  So bursts, concurrency, fetch sizes and
+    abandoned cursors (queries which were never fetched to the end or closed) are all replayed as they happened.
+
+    A request on an earlier query waits for the query's replayed result (it needs its new ID) - so a slower proxy
+    shows up as lag (how late requests were sent) and latency, rather than as a different sequence of requests.
+    """
+    def __init__(self,
+                 server_uri: str,
+                 token: str,
+                 sessions: dict[int, list[dict]],
+                 speed: float,
+                 sql_source: str = "captured",
+                 websocket_compression: str = "deflate",
+                 ssl_context: ssl.SSLContext | None = None
+                 ):
+        """
+        :param speed: 1 replays at the captured pace, 2 twice as fast, etc. - 0 sends each request as soon as it can.
+        :param sql_source: 'captured' runs each query's captured SQL - 'synthetic' runs a query of the benchmark's
+                           Flight SQL stand-in backend in its place, which returns the captured row count (after
+                           the captured execution time) - or fails, if the captured query failed.
+        """
+        self.server_uri = server_uri
+        self.token = token
+        self.sessions = sessions
+        self.speed = speed
+        self.sql_source = sql_source
+        self.websocket_compression = websocket_compression
+        self.ssl_context = ssl_context
+
+        self.requests: list[ReplayRequest] = []
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+
+    def get_schedule_time(self,
+                          event: dict
+                          ) -> float:
+        return self.start_time + (event["t"] / self.speed if self.speed else 0)
+
+    async def wait_until(self,
+                         event: dict
+                         ):
+        await asyncio.sleep(max(self.get_schedule_time(event) - time.perf_counter(), 0))
+
+    def get_query_sql(self,
+                      event: dict,
+                      events: list[dict]
+                      ) -> str | None:
+        if self.sql_source == "synthetic":
+            # Imported here - the stand-in needs numpy (the benchmark extra), which captured replays do not
+            from .standin import SyntheticTableSpec
+
+            query_responses = [response for response in events if "k" in response and response.get("q") == event["q"]]
+            query_result = next((response for response in query_responses if response["k"] == "queryResult"), {})
+            if query_result.get("ok") is False:
+                # The stand-in fails a query of an unsupported column type - as the captured query failed
+                return SyntheticTableSpec(types=("failed",)).to_sql()
+            execute_seconds = query_result.get("ex")
+            return SyntheticTableSpec(rows=sum(response.get("rows") or 0 for response in query_responses if response["k"] == "fetchResult"),
+                                      delay=round(execute_seconds or 0.0, 4)
+                                      ).to_sql()
+        return event.get("sql")
+
+    async def receive_responses(self,
+                                websocket,
+                                requests: dict[str, ReplayRequest],
+                                query_ids: dict[int, asyncio.Future],
+                                query_requests: dict[str, int],
+                                responses: list[str]
+                                ):
+        async for raw_message in websocket:
+            message = json.loads(raw_message)
+            wire_bytes = len(raw_message)
+            if message.get("kind") == "fetchResult" and message.get("result_format") == "binary":
+                for _ in range(message.get("binary_frames", 0)):
+                    wire_bytes += len(await websocket.recv())
+
+            request = requests.get(message.get("request_id"))
+            if request is None:
+                continue
+            responses.append(message.get("kind"))
+            if request.latency_seconds is None:
+                request.latency_seconds = time.perf_counter() - request.sent_time
+            if message.get("success") is False:
+                request.error = message.get("error")
+            if message.get("kind") == "fetchResult":
+                request.rows += message.get("batch_rows_fetched") or 0
+                request.wire_bytes += wire_bytes
+            # A stream's last response is its streamEnd
+            request.done = message.get("kind") != "fetchResult" or message.get("fetch_mode") != "stream"
+
+            query_number = query_requests.pop(message["request_id"], None)
+            if query_number is not None and not query_ids[query_number].done():
+                query_ids[query_number].set_result(message.get("query_id") if message.get("success") else None)
+
+    async def send_query_request(self,
+                                 websocket,
+                                 request_id: str,
+                                 request: ReplayRequest,
+                                 message_dict: dict,
+                                 query_id_future: asyncio.Future | None
+                                 ):
+        query_id = await query_id_future if query_id_future else "unknown"
+        if query_id is None:
+            # The query failed (or was skipped) in the replay - so there is nothing to send this to
+            request.skipped = True
+            return
+        request.sent_time = time.perf_counter()
+        await websocket.send(json.dumps(dict(message_dict, query_id=query_id, request_id=request_id)))
+
+    @classmethod
+    async def drain(cls,
+                    requests: dict[str, ReplayRequest],
+                    send_tasks: set[asyncio.Task],
+                    responses: list[str],
+                    expected_responses: int
+                    ):
+        """
+        Waits (up to REPLAY_DRAIN_TIMEOUT) until the session has had as many responses as the captured one had - or
+        has nothing left in flight.  A client closes once it has what it was waiting for - not at a set time.
+        """
+        deadline = time.perf_counter() + REPLAY_DRAIN_TIMEOUT
+        while time.perf_counter() < deadline:
+            if len(responses) >= expected_responses:
+                return
+            # grantCredits and closeCursor get no response
+            if not send_tasks and all(request.done or request.sent_time is None or request.action in ("grantCredits", "closeCursor")
+                                      for request in requests.values()):
+                return
+            await asyncio.sleep(0.05)
+
+    async def replay_session(self,
+                             session_number: int,
+                             events: list[dict]
+                             ):
+        requests = {}
+        query_ids: dict[int, asyncio.Future] = defaultdict(asyncio.get_running_loop().create_future)
+        # The request IDs of queries which are waiting for their result - so their replayed ID
+        query_requests: dict[str, int] = {}
+        send_tasks: set[asyncio.Task] = set()
+        responses: list[str] = []
+
+        request_events = [event for event in events if "a" in event]
+        if not request_events:
+            return
+        await self.wait_until(request_events[0])
+
+        websocket = await connect(uri=self.server_uri,
+                                  max_size=None,
+                                  compression=None if self.websocket_compression == "none" else self.websocket_compression,
+                                  ssl=self.ssl_context
+                                  )
+        # The server's greeting
+        await websocket.recv()
+        receive_task = asyncio.create_task(self.receive_responses(websocket=websocket,
+                                                                  requests=requests,
+                                                                  query_ids=query_ids,
+                                                                  query_requests=query_requests,
+                                                                  responses=responses
+                                                                  )
+                                           )
+        close_time = None
+        try:
+            for event_number, event in enumerate(request_events):
+                action = event["a"]
+                if action == "open":
+                    continue
+
+                if action == "close":
+                    close_time = event["t"]
+                    break
+
+                await self.wait_until(event)
+
+                request_id = f"{session_number}-{event_number}"
+                request = ReplayRequest(action=action,
+                                        scheduled_time=self.get_schedule_time(event)
+                                        )
+                self.requests.append(request)
+                message_dict = {key: value for key, value in event.items() if key not in ("t", "s", "a", "q", "fp", "np", "sql", "parameters")}
+                message_dict.update(action=action)
+
+                requests[request_id] = request
+                if action in QUERY_ACTIONS:
+                    # Sent once the query has its replayed ID - in order, as futures wake their waiters in order
+                    send_task = asyncio.create_task(self.send_query_request(websocket=websocket,
+                                                                            request_id=request_id,
+                                                                            request=request,
+                                                                            message_dict=message_dict,
+                                                                            query_id_future=None if event.get("q") is None else query_ids[event["q"]]
+                                                                            )
+                                                    )
+                    send_tasks.add(send_task)
+                    send_task.add_done_callback(send_tasks.discard)
+                    continue
+
+                if action == "authenticate":
+                    message_dict.update(token=self.token)
+                elif action == "query":
+                    sql = self.get_query_sql(event=event, events=events)
+                    if sql is None:
+                        request.skipped = True
+                        query_ids[event["q"]].set_result(None)
+                        continue
+                    message_dict.update(sql=sql,
+                                        parameters=event.get("parameters")
+                                        )
+                    query_requests[request_id] = event["q"]
+                request.sent_time = time.perf_counter()
+                await websocket.send(json.dumps(dict(message_dict, request_id=request_id)))
+
+            # Close once the responses the captured session had before it closed are in - and not before its time
+            # (the capture may also have ended before the session did)
+            await self.drain(requests=requests,
+                             send_tasks=send_tasks,
+                             responses=responses,
+                             expected_responses=sum(1 for event in events if "k" in event and (close_time is None or event["t"] <= close_time))
+                             )
+            if close_time is not None:
+                await self.wait_until(dict(t=close_time))
+        except ConnectionClosed as e:
+            logger.warning(msg=f"Replayed session: {session_number} - was closed by the server: {str(e)}")
+        finally:
+            for send_task in list(send_tasks):
+                send_task.cancel()
+            await websocket.close()
+            try:
+                await receive_task
+            except ConnectionClosed:
+                pass
+
+    async def run(self) -> list[dict]:
+        logger.info(msg=f"Replaying {len(self.sessions)} captured session(s) - speed: {self.speed or 'as fast as possible'}")
+        self.start_time = time.perf_counter()
+        results = await asyncio.gather(*[self.replay_session(session_number=session_number, events=events)
+                                         for session_number, events in self.sessions.items()],
+                                       return_exceptions=True
+                                       )
+        self.end_time = time.perf_counter()
+        for session_number, result in zip(self.sessions, results):
+            if isinstance(result, Exception):
+                logger.error(msg=f"Replayed session: {session_number} - failed: {str(result)}")
+        return self.summarize()
+
+    def summarize_requests(self,
+                           action: str,
+                           requests: list[ReplayRequest],
+                           captured_responses: list[dict]
+                           ) -> dict:
+        sent_requests = [request for request in requests if request.sent_time is not None]
+        latencies = [request.latency_seconds for request in sent_requests if request.latency_seconds is not None]
+        lags = [request.sent_time - request.scheduled_time for request in sent_requests]
+        captured_fetch_results = [response for response in captured_responses if response["k"] == "fetchResult"]
+        return dict(action=action,
+                    requests=len(requests),
+                    errors=sum(1 for request in sent_requests if request.error),
+                    skipped=sum(1 for request in requests if request.skipped),
+                    latency_p50_seconds=get_percentile(latencies, 50),
+                    latency_p99_seconds=get_percentile(latencies, 99),
+                    lag_p99_seconds=get_percentile(lags, 99),
+                    rows=sum(request.rows for request in requests),
+                    captured_rows=sum(response.get("rows") or 0 for response in captured_fetch_results),
+                    bytes=sum(request.wire_bytes for request in requests),
+                    captured_bytes=sum(response.get("bytes") or 0 for response in captured_fetch_results)
+                    )
+
+    def summarize(self) -> list[dict]:
+        """
+        :return: One summary per action - then one for the whole replay.  Lag is how late requests were sent (after
+                 their replayed schedule) - and latency is the time until their first response.
+        """
+        captured_responses = [event for events in self.sessions.values() for event in events if "k" in event]
+        summaries = []
+        for action in sorted({request.action for request in self.requests}):
+            summaries.append(self.summarize_requests(action=action,
+                                                     requests=[request for request in self.requests if request.action == action],
+                                                     captured_responses=captured_responses if action == "fetch" else []
+                                                     )
+                             )
+        summaries.append(self.summarize_requests(action="(all)",
+                                                 requests=self.requests,
+                                                 captured_responses=captured_responses
+                                                 )
+                         )
+        return summaries
+
+    def get_durations(self) -> tuple[float, float]:
+        """
+        :return: The captured duration (of the sessions replayed) - and the replay's.
+        """
+        captured_times = [event["t"] for events in self.sessions.values() for event in events]
+        return max(captured_times, default=0.0) - min(captured_times, default=0.0), self.end_time - self.start_time
@@ -0,0 +1,314 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import socket
+import threading
+import time
+import urllib.request
+from typing import Iterator, NamedTuple
+
+import psutil
+
+from .common import get_percentile
+from .replay import WorkloadReplayer, read_capture
+from .session import BenchmarkError, BenchmarkSession
+from .standin import SyntheticTableSpec, run_standin_server
+from ..config import logger
+from ..constants import BENCHMARK_AUTHENTICATION_BYPASS_USER, BENCHMARK_RSS_SAMPLE_INTERVAL, \
+    BENCHMARK_STARTUP_TIMEOUT
+
+END_TO_END_RESULT_COLUMNS = [("rows", "{:,}"), ("columns", "{}"), ("types", "{}"), ("fetch_mode", "{}"),
+                             ("fetch_size", "{:,}"), ("result_format", "{}"), ("websocket_compression", "{}"),
+                             ("fetches", "{:,}"), ("rows_per_second", "{:,.0f}"), ("bytes_per_second", "{:,.0f}"),
+                             ("fetch_p50_seconds", "{:.4f}"), ("fetch_p99_seconds", "{:.4f}"), ("peak_rss_bytes", "{:,}")
+                             ]
+
+
+class BenchmarkScenario(NamedTuple):
+    spec: SyntheticTableSpec
+    fetch_mode: str
+    fetch_size: int
+    result_format: str
+
+
+def get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(check,
+             description: str,
+             timeout: float = BENCHMARK_STARTUP_TIMEOUT
+             ):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return check()
+        except Exception as e:
+            if time.monotonic() > deadline:
+                raise BenchmarkError(f"Timed out waiting for {description} - last error: {str(e)}")
+            time.sleep(0.1)
+
+
+def run_proxy_server(server_arguments: list[str],
+                     log_level: str
+                     ):
+    """
+    Runs the real proxy server (parsing server_arguments exactly as its CLI does) - with authentication bypassed -
+    until it is terminated.  A multiprocessing target.
+    """
+    from ..server import click_run_server, run_server
+
+    logging.getLogger().setLevel(log_level)
+    context = click_run_server.make_context(info_name="flight-sql-websocket-proxy-server",
+                                            args=server_arguments
+                                            )
+    asyncio.run(run_server(**context.params,
+                           authentication_bypass_user=BENCHMARK_AUTHENTICATION_BYPASS_USER
+                           )
+                )
+
+
+class RssSampler:
+    """
+    Samples a process' resident set size in a background thread - and keeps the peak.
+    """
+    def __init__(self,
+                 pid: int,
+                 interval: float = BENCHMARK_RSS_SAMPLE_INTERVAL
+                 ):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> int:
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+        return self.peak_rss
+
+
+async def run_scenario(server_uri: str,
+                       server_pid: int,
+                       scenario: BenchmarkScenario,
+                       iterations: int,
+                       warmup_iterations: int,
+                       websocket_compression: str
+                       ) -> dict:
+    session = await BenchmarkSession.open(server_uri=server_uri,
+                                          token=BENCHMARK_AUTHENTICATION_BYPASS_USER,
+                                          result_format=scenario.result_format,
+                                          websocket_compression=websocket_compression
+                                          )
+    try:
+        sql = scenario.spec.to_sql()
+        for _ in range(warmup_iterations):
+            await session.run_query(sql=sql, fetch_mode=scenario.fetch_mode, fetch_size=scenario.fetch_size)
+
+        rss_sampler = RssSampler(pid=server_pid)
+        rss_sampler.start()
+        runs = []
+        try:
+            for _ in range(iterations):
+                runs.append(await session.run_query(sql=sql, fetch_mode=scenario.fetch_mode, fetch_size=scenario.fetch_size))
+        finally:
+            peak_rss = rss_sampler.stop()
+    finally:
+        await session.close()
+
+    wall_seconds = sum(run["wall_seconds"] for run in runs)
+    rows = sum(run["rows"] for run in runs)
+    wire_bytes = sum(run["wire_bytes"] for run in runs)
+    fetch_latencies = [latency for run in runs for latency in run["fetch_latencies"]]
+    return dict(rows=scenario.spec.rows,
+                columns=scenario.spec.columns,
+                types=",".join(scenario.spec.types),
+                fetch_mode=scenario.fetch_mode,
+                fetch_size=scenario.fetch_size,
+                result_format=scenario.result_format,
+                websocket_compression=websocket_compression,
+                iterations=iterations,
+                fetches=len(fetch_latencies),
+                rows_per_second=rows / wall_seconds,
+                bytes_per_second=wire_bytes / wall_seconds,
+                fetch_p50_seconds=get_percentile(fetch_latencies, 50),
+                fetch_p99_seconds=get_percentile(fetch_latencies, 99),
+                peak_rss_bytes=peak_rss
+                )
+
+
+def get_benchmark_scenarios(specs: list[SyntheticTableSpec],
+                            fetch_modes: list[str],
+                            fetch_sizes: list[int],
+                            result_formats: list[str]
+                            ) -> list[BenchmarkScenario]:
+    scenarios = []
+    for spec in specs:
+        for result_format in result_formats:
+            for fetch_mode in fetch_modes:
+                # A fetch of "all" ignores the fetch size - so it is only run once
+                for fetch_size in ([0] if fetch_mode == "all" else fetch_sizes):
+                    scenarios.append(BenchmarkScenario(spec=spec,
+                                                       fetch_mode=fetch_mode,
+                                                       fetch_size=fetch_size,
+                                                       result_format=result_format
+                                                       )
+                                     )
+    return scenarios
+
+
+async def run_scenarios(server_uri: str,
+                        server_pid: int,
+                        scenarios: list[BenchmarkScenario],
+                        iterations: int,
+                        warmup_iterations: int,
+                        websocket_compression: str
+                        ) -> list[dict]:
+    results = []
+    for scenario in scenarios:
+        logger.info(msg=f"Running benchmark scenario: {scenario}")
+        results.append(await run_scenario(server_uri=server_uri,
+                                          server_pid=server_pid,
+                                          scenario=scenario,
+                                          iterations=iterations,
+                                          warmup_iterations=warmup_iterations,
+                                          websocket_compression=websocket_compression
+                                          )
+                       )
+    return results
+
+
+@contextlib.contextmanager
+def run_benchmark_servers(server_arguments: list[str] = None,
+                          server_log_level: str = "WARNING"
+                          ) -> Iterator[tuple[str, int]]:
+    """
+    Starts a Flight SQL stand-in backend and the real proxy server (each in its own process - so that neither one
+    competes with the other, or with the benchmark client, for a GIL) - and stops them on exit.
+
+    :param server_arguments: Extra proxy server CLI arguments - e.g. ["--prefetch-batches", "4"].
+    :return: The proxy's client websocket URI - and its process ID.
+    """
+    multiprocessing_context = multiprocessing.get_context("spawn")
+
+    standin_port = get_free_port()
+    standin_location = f"grpc://127.0.0.1:{standin_port}"
+    standin_process = multiprocessing_context.Process(target=run_standin_server,
+                                                      kwargs=dict(location=standin_location),
+                                                      daemon=True
+                                                      )
+
+    server_port = get_free_port()
+    # The metrics port is opened once the websocket port is - so it tells us when the server is ready
+    metrics_port = get_free_port()
+    server_process = multiprocessing_context.Process(target=run_proxy_server,
+                                                     kwargs=dict(server_arguments=["--port", str(server_port),
+                                                                                   "--metrics-port", str(metrics_port),
+                                                                                   "--database-server-uri", standin_location,
+                                                                                   "--database-username", "benchmark",
+                                                                                   "--database-password", "benchmark",
+                                                                                   "--clerk-secret-key", "unused",
+                                                                                   "--jwks-url", "unused",
+                                                                                   "--session-token-issuer", "unused",
+                                                                                   *(server_arguments or [])
+                                                                                   ],
+                                                                 log_level=server_log_level
+                                                                 ),
+                                                     # Not a daemon - with --workers, it starts worker processes of its own
+                                                     daemon=False
+                                                     )
+    standin_process.start()
+    try:
+        wait_for(check=lambda: socket.create_connection(("127.0.0.1", standin_port)).close(),
+                 description=f"the Flight SQL stand-in server at: {standin_location}"
+                 )
+        server_process.start()
+        try:
+            wait_for(check=lambda: urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics").close(),
+                     description=f"the proxy server on port: {server_port}"
+                     )
+            yield f"ws://127.0.0.1:{server_port}/client", server_process.pid
+        finally:
+            server_process.terminate()
+            server_process.join()
+    finally:
+        standin_process.terminate()
+        standin_process.join()
+
+
+def run_end_to_end_benchmark(scenarios: list[BenchmarkScenario],
+                             iterations: int,
+                             warmup_iterations: int,
+                             websocket_compression: str = "deflate",
+                             server_arguments: list[str] = None,
+                             server_log_level: str = "WARNING"
+                             ) -> list[dict]:
+    """
+    Runs the scenarios against the real proxy server - in front of a Flight SQL stand-in backend.
+
+    :param websocket_compression: 'deflate' or 'none' - see BenchmarkSession.open.
+    :param server_arguments: Extra proxy server CLI arguments - see run_benchmark_servers.
+    :return: One result per scenario.
+    """
+    with run_benchmark_servers(server_arguments=server_arguments,
+                               server_log_level=server_log_level
+                               ) as (server_uri, server_pid):
+        return asyncio.run(run_scenarios(server_uri=server_uri,
+                                         server_pid=server_pid,
+                                         scenarios=scenarios,
+                                         iterations=iterations,
+                                         warmup_iterations=warmup_iterations,
+                                         websocket_compression=websocket_compression
+                                         )
+                           )
+
+
+def run_replay_benchmark(capture_file: str,
+                         speed: float,
+                         websocket_compression: str = "deflate",
+                         server_arguments: list[str] = None,
+                         server_log_level: str = "WARNING"
+                         ) -> tuple[list[dict], WorkloadReplayer]:
+    """
+    Replays a captured workload against the real proxy server - in front of a Flight SQL stand-in backend, which
+    stands in for each captured query with a synthetic result of the captured size (see WorkloadReplayer).
+
+    :return: The replay's summaries - and the replayer (for its durations).
+    """
+    _, sessions = read_capture(path=capture_file)
+    with run_benchmark_servers(server_arguments=server_arguments,
+                               server_log_level=server_log_level
+                               ) as (server_uri, server_pid):
+        replayer = WorkloadReplayer(server_uri=server_uri,
+                                    token=BENCHMARK_AUTHENTICATION_BYPASS_USER,
+                                    sessions=sessions,
+                                    speed=speed,
+                                    sql_source="synthetic",
+                                    websocket_compression=websocket_compression
+                                    )
+        rss_sampler = RssSampler(pid=server_pid)
+        rss_sampler.start()
+        try:
+            summaries = asyncio.run(replayer.run())
+        finally:
+            peak_rss = rss_sampler.stop()
+
+    for summary in summaries:
+        summary.update(peak_rss_bytes=peak_rss)
+    return summaries, replayer
@@ -0,0 +1,90 @@
+import time
+from typing import Callable
+
+import numpy
+import pyarrow
+
+from .standin import SyntheticTableSpec, make_synthetic_table
+from ..utils import get_ipc_write_options, get_dataframe_ipc_bytes, get_dataframe_results_as_ipc_base64_str, \
+    get_record_batches_ipc_fragments, get_dataframe_from_ipc_bytes, get_dataframe_from_ipc_base64_str, get_payload_size
+
+SERIALIZATION_RESULT_COLUMNS = [("helper", "{}"), ("compression", "{}"), ("rows", "{:,}"), ("arrow_bytes", "{:,}"),
+                                ("output_bytes", "{:,}"), ("median_seconds", "{:.5f}"), ("min_seconds", "{:.5f}"),
+                                ("arrow_bytes_per_second", "{:,.0f}")
+                                ]
+
+
+def time_function(func: Callable,
+                  repeat: int
+                  ) -> tuple[list[float], object]:
+    """
+    :return: The wall time of each call - and the last call's result.
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start_time)
+    return timings, result
+
+
+def get_output_size(output) -> int:
+    if isinstance(output, str):
+        return len(output)
+    elif isinstance(output, pyarrow.Table):
+        return output.nbytes
+    return get_payload_size(output)
+
+
+def run_serialization_benchmark(spec: SyntheticTableSpec,
+                                compressions: list[str],
+                                max_fragment_size: int,
+                                repeat: int
+                                ) -> list[dict]:
+    """
+    Microbenchmarks the serialization helpers in utils.py (and their decoding counterparts) on a synthetic table.
+
+    :return: One result per helper and compression.
+    """
+    table = make_synthetic_table(spec)
+    record_batches = table.to_batches(max_chunksize=spec.batch_size)
+    results = []
+    for compression in compressions:
+        ipc_write_options = get_ipc_write_options(compression=compression)
+        base64_str = get_dataframe_results_as_ipc_base64_str(table, options=ipc_write_options)
+        ipc_bytes = b"".join(get_record_batches_ipc_fragments(schema=table.schema,
+                                                              record_batches=record_batches,
+                                                              max_fragment_size=max_fragment_size,
+                                                              options=ipc_write_options
+                                                              )
+                             )
+        helpers = dict(
+            get_dataframe_results_as_ipc_base64_str=lambda: get_dataframe_results_as_ipc_base64_str(table, options=ipc_write_options),
+            get_record_batches_ipc_fragments=lambda: list(get_record_batches_ipc_fragments(schema=table.schema,
+                                                                                           record_batches=record_batches,
+                                                                                           max_fragment_size=max_fragment_size,
+                                                                                           options=ipc_write_options
+                                                                                           )
+                                                          ),
+            get_dataframe_from_ipc_base64_str=lambda: get_dataframe_from_ipc_base64_str(base64_str),
+            get_dataframe_from_ipc_bytes=lambda: get_dataframe_from_ipc_bytes(ipc_bytes)
+        )
+        if compression in (None, "none"):
+            # It has no compression option
+            helpers.update(get_dataframe_ipc_bytes=lambda: get_dataframe_ipc_bytes(table))
+
+        for name, func in helpers.items():
+            timings, output = time_function(func=func, repeat=repeat)
+            median_seconds = float(numpy.median(timings))
+            results.append(dict(helper=name,
+                                compression=compression or "none",
+                                rows=table.num_rows,
+                                arrow_bytes=table.nbytes,
+                                output_bytes=get_output_size(output),
+                                median_seconds=median_seconds,
+                                min_seconds=min(timings),
+                                arrow_bytes_per_second=table.nbytes / median_seconds
+                                )
+                           )
+    return results
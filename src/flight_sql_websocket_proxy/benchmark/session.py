@@ -0,0 +1,167 @@
+import json
+import ssl
+import time
+
+from websockets.asyncio.client import connect
+
+from ..constants import DEFAULT_STREAM_CREDITS
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+class BenchmarkSession:
+    """
+    One websocket session against the proxy - which runs a query and fetches all of its results, timing each fetch.
+    """
+    def __init__(self,
+                 websocket
+                 ):
+        self.websocket = websocket
+        self.wire_bytes = 0
+
+    @classmethod
+    async def open(cls,
+                   server_uri: str,
+                   token: str,
+                   result_format: str,
+                   websocket_compression: str = "deflate",
+                   ssl_context: ssl.SSLContext | None = None,
+                   autocommit: bool = True,
+                   compression: str | None = None,
+                   compression_level: int | None = None
+                   ) -> "BenchmarkSession":
+        """
+        :param websocket_compression: 'deflate' offers permessage-deflate (as browsers do) - 'none' does not.
+        :param compression: The Arrow IPC compression codec to ask the server for.
+        """
+        websocket = await connect(uri=server_uri,
+                                  max_size=None,
+                                  compression=None if websocket_compression == "none" else websocket_compression,
+                                  ssl=ssl_context
+                                  )
+        session = cls(websocket=websocket)
+        # The server's greeting
+        await session.recv()
+
+        await session.send(dict(action="authenticate",
+                                token=token,
+                                autocommit=autocommit,
+                                result_format=result_format,
+                                compression=compression,
+                                compression_level=compression_level
+                                )
+                           )
+        message = await session.recv()
+        if not message.get("success"):
+            await session.close()
+            raise BenchmarkError(f"Authentication failed: {message.get('error')}")
+        return session
+
+    async def send(self,
+                   message_dict: dict
+                   ):
+        await self.websocket.send(json.dumps(message_dict))
+
+    async def recv(self) -> dict:
+        raw_message = await self.websocket.recv()
+        self.wire_bytes += len(raw_message)
+        message = json.loads(raw_message)
+        if message.get("kind") == "fetchResult" and message.get("result_format") == "binary":
+            for _ in range(message.get("binary_frames", 0)):
+                self.wire_bytes += len(await self.websocket.recv())
+        return message
+
+    async def recv_fetch_result(self) -> dict:
+        message = await self.recv()
+        if message.get("kind") in ("fetchResult", "streamEnd") and not message.get("success"):
+            raise BenchmarkError(f"Fetch failed: {message.get('error')}")
+        return message
+
+    @classmethod
+    def add_fetch_timings(cls,
+                          fetch_result: dict,
+                          server_timings: dict
+                          ) -> int:
+        """
+        Adds a fetch's server-side timings to the query's.
+
+        :return: The fetch's row count.
+        """
+        fetch_timings = fetch_result.get("timings") or {}
+        server_timings["read_seconds"] += fetch_timings.get("read_seconds") or 0.0
+        server_timings["serialize_seconds"] += fetch_timings.get("serialize_seconds") or 0.0
+        server_timings["first_batch_seconds"] = fetch_timings.get("first_batch_seconds")
+        return fetch_result["batch_rows_fetched"]
+
+    async def run_query(self,
+                        sql: str,
+                        fetch_mode: str,
+                        fetch_size: int,
+                        stream_credits: int = DEFAULT_STREAM_CREDITS
+                        ) -> dict:
+        """
+        :return: The run's wall time, rows, wire bytes, per-fetch latencies (for a stream: the time between
+                 results) - and the server's own timings (summed over the fetches).
+        """
+        wire_bytes_start = self.wire_bytes
+        start_time = time.perf_counter()
+
+        await self.send(dict(action="query", sql=sql, parameters=None))
+        message = await self.recv()
+        if not message.get("success"):
+            raise BenchmarkError(f"Query failed: {message.get('error')}")
+        query_id = message["query_id"]
+        query_timings = message.get("timings") or {}
+        server_timings = dict(queue_seconds=query_timings.get("queue_seconds"),
+                              execute_seconds=query_timings.get("execute_seconds"),
+                              first_batch_seconds=None,
+                              read_seconds=0.0,
+                              serialize_seconds=0.0
+                              )
+
+        rows = 0
+        fetch_latencies = []
+        if fetch_mode == "stream":
+            await self.send(dict(action="fetch",
+                                 query_id=query_id,
+                                 fetch_mode="stream",
+                                 fetch_size=fetch_size,
+                                 credits=stream_credits
+                                 )
+                            )
+            fetch_start_time = time.perf_counter()
+            while True:
+                message = await self.recv_fetch_result()
+                if message["kind"] == "streamEnd":
+                    break
+                fetch_latencies.append(time.perf_counter() - fetch_start_time)
+                fetch_start_time = time.perf_counter()
+                rows += self.add_fetch_timings(fetch_result=message, server_timings=server_timings)
+                if not message["all_rows_fetched"]:
+                    await self.send(dict(action="grantCredits", query_id=query_id, credits=1))
+        else:
+            while True:
+                fetch_start_time = time.perf_counter()
+                await self.send(dict(action="fetch",
+                                     query_id=query_id,
+                                     fetch_mode=fetch_mode,
+                                     fetch_size=fetch_size
+                                     )
+                                )
+                message = await self.recv_fetch_result()
+                fetch_latencies.append(time.perf_counter() - fetch_start_time)
+                rows += self.add_fetch_timings(fetch_result=message, server_timings=server_timings)
+                if message["all_rows_fetched"]:
+                    break
+
+        return dict(wall_seconds=time.perf_counter() - start_time,
+                    rows=rows,
+                    wire_bytes=self.wire_bytes - wire_bytes_start,
+                    fetch_latencies=fetch_latencies,
+                    server_timings=server_timings
+                    )
+
+    async def close(self):
+        await self.websocket.close()
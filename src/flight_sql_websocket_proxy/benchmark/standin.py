@@ -0,0 +1,283 @@
+import functools
+import re
+import threading
+import time
+from typing import NamedTuple
+
+import numpy
+import pyarrow
+import pyarrow.compute
+import pyarrow.flight
+
+from ..config import logger
+
+# Flight SQL commands arrive as protobuf "Any" messages - we only need a few fields of a few of them, so we decode
+# them by hand rather than depend on the Flight SQL protobuf definitions
+COMMAND_STATEMENT_QUERY = "type.googleapis.com/arrow.flight.protocol.sql.CommandStatementQuery"
+COMMAND_GET_SQL_INFO = "type.googleapis.com/arrow.flight.protocol.sql.CommandGetSqlInfo"
+COMMAND_GET_TABLE_TYPES = "type.googleapis.com/arrow.flight.protocol.sql.CommandGetTableTypes"
+
+SQL_INFO_SCHEMA = pyarrow.schema([
+    pyarrow.field("info_name", pyarrow.uint32(), nullable=False),
+    pyarrow.field("value", pyarrow.dense_union([
+        pyarrow.field("string_value", pyarrow.utf8()),
+        pyarrow.field("bool_value", pyarrow.bool_()),
+        pyarrow.field("bigint_value", pyarrow.int64()),
+        pyarrow.field("int32_bitmask", pyarrow.int32()),
+        pyarrow.field("string_list", pyarrow.list_(pyarrow.utf8())),
+        pyarrow.field("int32_to_int32_list_map", pyarrow.map_(pyarrow.int32(), pyarrow.list_(pyarrow.int32()))),
+    ]), nullable=False)
+])
+TABLE_TYPES_SCHEMA = pyarrow.schema([pyarrow.field("table_type", pyarrow.utf8(), nullable=False)])
+
+SYNTHETIC_COLUMN_TYPES = ["int64", "int32", "float64", "bool", "string", "timestamp", "date", "decimal"]
+SPEC_PARAMETER_PATTERN = re.compile(r"\b(\w+)\s*=\s*(?:'([^']*)'|([\w.]+))")
+# An endpoint's ticket is its spec's SQL - with the partition it serves appended
+PARTITION_TICKET_PATTERN = re.compile(r" -- partition=(\d+)$")
+STRING_VOCABULARY_SIZE = 1_000
+
+
+def read_varint(data: bytes,
+                position: int
+                ) -> tuple[int, int]:
+    shift = 0
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def decode_protobuf_fields(data: bytes) -> dict[int, list]:
+    """
+    :return: The message's fields (by field number) - varints as ints, length-delimited fields as bytes.
+    """
+    fields = {}
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        field_number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 2:
+            length, position = read_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type: {wire_type}")
+        fields.setdefault(field_number, []).append(value)
+    return fields
+
+
+class SyntheticTableSpec(NamedTuple):
+    """
+    Describes a synthetic result - parsed from the key=value pairs in a query's SQL text, e.g.:
+    SELECT * FROM synthetic(rows=1000000, columns=8, types='int64,float64,string', batch_size=65536)
+
+    Column types are cycled over the columns.  delay (seconds) is added to the query's execution, and batch_delay
+    (seconds) before each batch is sent - to stand in for a slow backend.  The result is served from partitions
+    Flight endpoints - each with an even share of its rows.
+    """
+    rows: int = 10_000
+    columns: int = 4
+    types: tuple[str, ...] = ("int64", "float64", "string", "timestamp")
+    batch_size: int = 65_536
+    nulls: float = 0.0
+    seed: int = 0
+    delay: float = 0.0
+    batch_delay: float = 0.0
+    partitions: int = 1
+
+    @classmethod
+    def from_sql(cls,
+                 sql: str
+                 ) -> "SyntheticTableSpec":
+        parameters = {}
+        for name, quoted_value, value in SPEC_PARAMETER_PATTERN.findall(sql):
+            if name not in cls._fields:
+                continue
+            value = quoted_value or value
+            if name == "types":
+                parameters[name] = tuple(column_type.strip().lower() for column_type in value.split(",") if column_type.strip())
+            else:
+                parameters[name] = type(cls._field_defaults[name])(value)
+
+        spec = cls(**parameters)
+        unsupported_types = set(spec.types) - set(SYNTHETIC_COLUMN_TYPES)
+        if unsupported_types:
+            raise ValueError(f"Unsupported synthetic column type(s): {sorted(unsupported_types)} - must be one of: {SYNTHETIC_COLUMN_TYPES}")
+        return spec
+
+    def to_sql(self) -> str:
+        return (f"SELECT * FROM synthetic(rows={self.rows}, columns={self.columns}, types='{','.join(self.types)}', "
+                f"batch_size={self.batch_size}, nulls={self.nulls}, seed={self.seed}, delay={self.delay}, "
+                f"batch_delay={self.batch_delay}, partitions={self.partitions})"
+                )
+
+
+def make_synthetic_column(column_type: str,
+                          rows: int,
+                          random_generator: numpy.random.Generator
+                          ) -> pyarrow.Array:
+    # Everything is built with vectorized numpy - so that the stand-in is never the bottleneck being measured
+    if column_type == "int64":
+        return pyarrow.array(random_generator.integers(0, 2 ** 62, size=rows, dtype=numpy.int64))
+    elif column_type == "int32":
+        return pyarrow.array(random_generator.integers(0, 2 ** 31 - 1, size=rows, dtype=numpy.int32))
+    elif column_type == "float64":
+        return pyarrow.array(random_generator.random(size=rows))
+    elif column_type == "bool":
+        return pyarrow.array(random_generator.random(size=rows) < 0.5)
+    elif column_type == "string":
+        vocabulary = pyarrow.array([f"value-{i:06d}-" + "x" * (i % 24) for i in range(STRING_VOCABULARY_SIZE)])
+        indices = pyarrow.array(random_generator.integers(0, STRING_VOCABULARY_SIZE, size=rows, dtype=numpy.int32))
+        return pyarrow.DictionaryArray.from_arrays(indices, vocabulary).cast(pyarrow.string())
+    elif column_type == "timestamp":
+        microseconds = random_generator.integers(1_500_000_000_000_000, 1_800_000_000_000_000, size=rows, dtype=numpy.int64)
+        return pyarrow.array(microseconds, type=pyarrow.timestamp("us"))
+    elif column_type == "date":
+        return pyarrow.array(random_generator.integers(0, 20_000, size=rows, dtype=numpy.int32), type=pyarrow.int32()).cast(pyarrow.date32())
+    elif column_type == "decimal":
+        return pyarrow.array(random_generator.integers(0, 10 ** 12, size=rows, dtype=numpy.int64)).cast(pyarrow.decimal128(18, 2))
+    raise ValueError(f"Unsupported synthetic column type: '{column_type}'")
+
+
+@functools.lru_cache(maxsize=4)
+def make_synthetic_table(spec: SyntheticTableSpec) -> pyarrow.Table:
+    random_generator = numpy.random.default_rng(seed=spec.seed)
+    arrays = []
+    fields = []
+    for column_index in range(spec.columns):
+        column_type = spec.types[column_index % len(spec.types)]
+        array = make_synthetic_column(column_type=column_type,
+                                      rows=spec.rows,
+                                      random_generator=random_generator
+                                      )
+        if spec.nulls > 0:
+            null_mask = pyarrow.array(random_generator.random(size=spec.rows) < spec.nulls)
+            array = pyarrow.compute.if_else(null_mask, pyarrow.scalar(None, type=array.type), array)
+        arrays.append(array)
+        fields.append(pyarrow.field(f"{column_type}_{column_index}", array.type))
+
+    return pyarrow.Table.from_arrays(arrays, schema=pyarrow.schema(fields))
+
+
+class StandInServerAuthHandler(pyarrow.flight.ServerAuthHandler):
+    def authenticate(self, outgoing, incoming):
+        pass
+
+    def is_valid(self, token):
+        return b""
+
+
+class BearerTokenMiddlewareFactory(pyarrow.flight.ServerMiddlewareFactory):
+    def start_call(self, info, headers):
+        return BearerTokenMiddleware()
+
+
+class BearerTokenMiddleware(pyarrow.flight.ServerMiddleware):
+    # The Flight SQL ADBC driver expects a bearer token back from its (basic auth) handshake
+    def sending_headers(self):
+        return {"authorization": "Bearer stand-in"}
+
+
+class FlightSqlStandInServer(pyarrow.flight.FlightServerBase):
+    """
+    A minimal Flight SQL server - just enough of the protocol for the ADBC Flight SQL driver (and so the proxy) to
+    connect, run statements and read their results - which serves synthetic tables described by the SQL text (see
+    SyntheticTableSpec).  Any username and password are accepted.
+    """
+    def __init__(self,
+                 location: str
+                 ):
+        super().__init__(location,
+                         auth_handler=StandInServerAuthHandler(),
+                         middleware=dict(auth=BearerTokenMiddlewareFactory())
+                         )
+
+    @classmethod
+    def get_command(cls,
+                    descriptor: pyarrow.flight.FlightDescriptor
+                    ) -> tuple[str, dict[int, list]]:
+        any_fields = decode_protobuf_fields(descriptor.command)
+        type_url = any_fields[1][0].decode()
+        return type_url, decode_protobuf_fields(any_fields.get(2, [b""])[0])
+
+    def get_flight_info(self, context, descriptor):
+        type_url, command_fields = self.get_command(descriptor)
+        if type_url == COMMAND_GET_SQL_INFO:
+            return pyarrow.flight.FlightInfo(SQL_INFO_SCHEMA, descriptor, [pyarrow.flight.FlightEndpoint(b"sql_info", [])], 0, -1)
+        elif type_url == COMMAND_GET_TABLE_TYPES:
+            return pyarrow.flight.FlightInfo(TABLE_TYPES_SCHEMA, descriptor, [pyarrow.flight.FlightEndpoint(b"table_types", [])], 1, -1)
+        elif type_url != COMMAND_STATEMENT_QUERY:
+            raise pyarrow.flight.FlightUnavailableError(f"Unsupported command: '{type_url}'")
+
+        sql = command_fields.get(1, [b""])[0].decode()
+        try:
+            spec = SyntheticTableSpec.from_sql(sql)
+        except ValueError as e:
+            raise pyarrow.flight.FlightServerError(str(e))
+
+        time.sleep(spec.delay)
+        table = make_synthetic_table(spec)
+        # The ticket is just the spec (and partition) - so do_get needs no state
+        endpoints = [pyarrow.flight.FlightEndpoint(f"{spec.to_sql()} -- partition={partition}".encode(), [])
+                     for partition in range(max(spec.partitions, 1))]
+        return pyarrow.flight.FlightInfo(table.schema, descriptor, endpoints, table.num_rows, -1)
+
+    def do_get(self, context, ticket):
+        if ticket.ticket == b"sql_info":
+            return pyarrow.flight.RecordBatchStream(SQL_INFO_SCHEMA.empty_table())
+        elif ticket.ticket == b"table_types":
+            return pyarrow.flight.RecordBatchStream(pyarrow.table(dict(table_type=["TABLE"]), schema=TABLE_TYPES_SCHEMA))
+
+        spec = SyntheticTableSpec.from_sql(ticket.ticket.decode())
+        table = make_synthetic_table(spec)
+        partition_match = PARTITION_TICKET_PATTERN.search(ticket.ticket.decode())
+        if partition_match:
+            partition_count = max(spec.partitions, 1)
+            partition = int(partition_match.group(1))
+            start_row = table.num_rows * partition // partition_count
+            table = table.slice(offset=start_row, length=table.num_rows * (partition + 1) // partition_count - start_row)
+        record_batches = table.to_batches(max_chunksize=spec.batch_size)
+        if spec.batch_delay > 0:
+            def generate_batches():
+                for record_batch in record_batches:
+                    time.sleep(spec.batch_delay)
+                    yield record_batch
+
+            return pyarrow.flight.GeneratorStream(table.schema, generate_batches())
+
+        return pyarrow.flight.RecordBatchStream(pyarrow.RecordBatchReader.from_batches(table.schema, record_batches))
+
+    def do_action(self, context, action):
+        # Prepared statements (etc.) are not supported - the driver falls back to plain statements
+        raise NotImplementedError(f"Unsupported action: '{action.type}'")
+
+
+def start_standin_server(location: str) -> FlightSqlStandInServer:
+    """
+    Starts the stand-in server in a background thread of this process.
+    """
+    standin_server = FlightSqlStandInServer(location=location)
+    threading.Thread(target=standin_server.serve, daemon=True).start()
+    logger.info(msg=f"Flight SQL stand-in server listening at: {location}")
+    return standin_server
+
+
+def run_standin_server(location: str):
+    """
+    Runs the stand-in server in this process until it is terminated - a multiprocessing target.
+    """
+    standin_server = FlightSqlStandInServer(location=location)
+    logger.info(msg=f"Flight SQL stand-in server listening at: {location}")
+    standin_server.serve()
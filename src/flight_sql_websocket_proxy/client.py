@@ -13,15 +13,19 @@ from typing import Any, Set
 
 import click
 import pandas as pd
-from munch import munchify
+import pyarrow as pa
+from munch import munchify, Munch
 from pglast import parser
 from websockets.exceptions import ConnectionClosed
 from websockets.frames import Close
 from websockets.legacy.client import connect
 
 from . import __version__ as arrow_flight_sql_websocket_proxy_client_version
-from .constants import SERVER_PROTOCOL, SERVER_PORT, SERVER_BASE_PATH
-from .utils import get_dataframe_from_ipc_base64_str
+from .benchmark.common import format_results_table
+from .benchmark.load_generator import LOAD_RESULT_COLUMNS, LoadGenerator, read_workload
+from .benchmark.replay import REPLAY_RESULT_COLUMNS, WorkloadReplayer, read_capture
+from .constants import SERVER_PROTOCOL, SERVER_PORT, SERVER_BASE_PATH, DEFAULT_STREAM_CREDITS, DEFAULT_REPLAY_SPEED
+from .utils import get_dataframe_from_ipc_base64_str, get_dataframe_from_ipc_bytes
 
 pd.set_option('display.max_rows', None)
 pd.set_option('display.max_columns', None)
@@ -118,6 +122,52 @@ async def is_sql_command(message: str) -> bool:
         return True
 
 
+async def get_fetch_result_table(websocket,
+                                 message
+                                 ) -> pa.Table | None:
+    """
+    Decodes the Arrow data for a fetchResult message - reading any binary frame(s) that follow its header.
+    """
+    if message.get("result_format") == "binary":
+        tables = []
+        for _ in range(message.get("binary_frames", 0)):
+            tables.append(get_dataframe_from_ipc_bytes(bytes_value=await websocket.recv()))
+        return pa.concat_tables(tables) if tables else None
+    elif message.data:
+        return get_dataframe_from_ipc_base64_str(base64_str=message.data)
+
+
+def get_ssl_context(server_protocol: str,
+                    tls_verify: bool,
+                    tls_roots: str
+                    ) -> ssl.SSLContext | None:
+    if server_protocol.lower() != "wss":
+        return None
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.load_default_certs()
+
+    if tls_verify:
+        ssl_context.check_hostname = True
+        ssl_context.verify_mode = ssl.CERT_REQUIRED
+        if tls_roots:
+            ssl_context.load_verify_locations(cafile=tls_roots)
+    else:
+        print("WARNING: TLS Verification is disabled.")
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+
+    return ssl_context
+
+
+def get_server_uri(server_protocol: str,
+                   server_hostname: str,
+                   server_port: int,
+                   server_base_path: str
+                   ) -> str:
+    return f"{server_protocol.lower()}://{server_hostname}:{server_port}{server_base_path.rstrip('/')}/client"
+
+
 async def _run_client(
         server_protocol: str,
         server_hostname: str,
@@ -128,6 +178,11 @@ async def _run_client(
         token: str,
         max_result_set_rows: int,
         autocommit: bool,
+        result_format: str,
+        compression: str,
+        compression_level: int | None,
+        fetch_mode: str,
+        stream_credits: int,
         loop: asyncio.AbstractEventLoop,
         inputs: asyncio.Queue[str],
         stop: asyncio.Future[None],
@@ -135,24 +190,15 @@ async def _run_client(
     print(
         f"Starting Arrow Flight SQL Websocket Proxy Client - by GizmoData™ - version: {arrow_flight_sql_websocket_proxy_client_version}")
 
-    scheme = server_protocol.lower()
-
-    ssl_context = None
-    if scheme == "wss":
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        ssl_context.load_default_certs()
-
-        if tls_verify:
-            ssl_context.check_hostname = True
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-            if tls_roots:
-                ssl_context.load_verify_locations(cafile=tls_roots)
-        else:
-            print("WARNING: TLS Verification is disabled.")
-            ssl_context.check_hostname = False
-            ssl_context.verify_mode = ssl.CERT_NONE
-
-    server_uri = f"{scheme}://{server_hostname}:{server_port}{server_base_path.rstrip('/')}/client"
+    ssl_context = get_ssl_context(server_protocol=server_protocol,
+                                  tls_verify=tls_verify,
+                                  tls_roots=tls_roots
+                                  )
+    server_uri = get_server_uri(server_protocol=server_protocol,
+                                server_hostname=server_hostname,
+                                server_port=server_port,
+                                server_base_path=server_base_path
+                                )
     print(f"Connecting to Server URI: {server_uri}")
 
     try:
@@ -169,7 +215,10 @@ async def _run_client(
         # Authenticate
         message_dict = dict(action="authenticate",
                             token=token,
-                            autocommit=autocommit
+                            autocommit=autocommit,
+                            result_format=result_format,
+                            compression=compression,
+                            compression_level=compression_level
                             )
 
         await websocket.send(json.dumps(message_dict))
@@ -213,20 +262,30 @@ async def _run_client(
                                 result_set_bytes = 0
                                 remaining_rows_to_print = max_result_set_rows
 
-                                while fetch_more_data:
+                                if fetch_mode == "stream":
+                                    # The server pushes batches as long as we have granted it credits
                                     message_dict = dict(action="fetch",
                                                         query_id=query_id,
-                                                        fetch_mode="batch"
+                                                        fetch_mode="stream",
+                                                        credits=stream_credits
                                                         )
                                     await websocket.send(json.dumps(message_dict))
 
+                                while fetch_more_data:
+                                    if fetch_mode == "batch":
+                                        message_dict = dict(action="fetch",
+                                                            query_id=query_id,
+                                                            fetch_mode="batch"
+                                                            )
+                                        await websocket.send(json.dumps(message_dict))
+
                                     raw_message = await websocket.recv()
                                     message = munchify(x=json.loads(raw_message))
 
                                     if message.kind == "fetchResult":
+                                        df = await get_fetch_result_table(websocket=websocket, message=message)
                                         if message.success:
-                                            if message.data:
-                                                df = get_dataframe_from_ipc_base64_str(base64_str=message.data)
+                                            if df is not None:
                                                 total_rows_fetched += df.num_rows
                                                 result_set_bytes += df.nbytes
 
@@ -248,14 +307,26 @@ async def _run_client(
                                                 print_during_input(
                                                     f"\n-----------\nResult set size: {total_rows_fetched:,} row(s) / {result_set_bytes:,} bytes")
                                                 break
+
+                                            if fetch_mode == "stream":
+                                                message_dict = dict(action="grantCredits",
+                                                                    query_id=query_id,
+                                                                    credits=1
+                                                                    )
+                                                await websocket.send(json.dumps(message_dict))
                                         else:
                                             print_during_input(f"Error: {message.error}")
                                             break
+                                    elif message.kind == "streamEnd":
+                                        break
                                     else:
                                         raise ValueError(f"Unknown message kind: {message.kind}")
 
                             elif not message.success:
                                 print_during_input(f"Error: {message.error}")
+                        elif message.kind in ["fetchResult", "streamEnd"]:
+                            # Stream messages which were in flight when we closed the cursor - nothing to do
+                            pass
                         else:
                             raise ValueError(f"Unknown message kind: {message.kind}")
 
@@ -289,7 +360,12 @@ def run_client(version: bool,
                tls_roots: str,
                token: str,
                max_result_set_rows: int,
-               autocommit: bool
+               autocommit: bool,
+               result_format: str,
+               compression: str,
+               compression_level: int | None,
+               fetch_mode: str,
+               stream_credits: int
                ):
     if version:
         print(f"Arrow Flight SQL Websocket Proxy Client - version: {arrow_flight_sql_websocket_proxy_client_version}")
@@ -336,6 +412,11 @@ def run_client(version: bool,
                                  token=token,
                                  max_result_set_rows=max_result_set_rows,
                                  autocommit=autocommit,
+                                 result_format=result_format,
+                                 compression=compression,
+                                 compression_level=compression_level,
+                                 fetch_mode=fetch_mode,
+                                 stream_credits=stream_credits,
                                  loop=loop,
                                  inputs=inputs,
                                  stop=stop,
@@ -376,7 +457,7 @@ def run_client(version: bool,
     loop.close()
 
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option(
     "--version/--no-version",
     type=bool,
@@ -454,7 +535,49 @@ def run_client(version: bool,
     show_default=True,
     help="Enable autocommit mode."
 )
-def click_run_client(version: bool,
+@click.option(
+    "--result-format",
+    type=click.Choice(["binary", "base64"]),
+    default=os.getenv("RESULT_FORMAT", "binary"),
+    show_default=True,
+    required=True,
+    help="The format to receive fetch results in.  'binary' receives raw Arrow IPC binary frames, 'base64' receives base64-encoded Arrow IPC inside JSON messages (legacy).  Defaults to environment variable RESULT_FORMAT if set."
+)
+@click.option(
+    "--compression",
+    type=click.Choice(["none", "lz4", "zstd"]),
+    default=os.getenv("COMPRESSION", "none"),
+    show_default=True,
+    required=True,
+    help="Ask the server to compress Arrow IPC record batch buffers in fetch results with this codec ('lz4' is LZ4_FRAME).  Defaults to environment variable COMPRESSION if set."
+)
+@click.option(
+    "--compression-level",
+    type=int,
+    default=os.getenv("COMPRESSION_LEVEL"),
+    show_default=True,
+    required=False,
+    help="The compression level for --compression - the codec's default level is used if not set.  Defaults to environment variable COMPRESSION_LEVEL if set."
+)
+@click.option(
+    "--fetch-mode",
+    type=click.Choice(["batch", "stream"]),
+    default=os.getenv("FETCH_MODE", "batch"),
+    show_default=True,
+    required=True,
+    help="How to fetch query results.  'batch' requests each batch from the server, 'stream' lets the server push batches as long as the client has granted it credits.  Defaults to environment variable FETCH_MODE if set."
+)
+@click.option(
+    "--stream-credits",
+    type=int,
+    default=os.getenv("STREAM_CREDITS", DEFAULT_STREAM_CREDITS),
+    show_default=True,
+    required=True,
+    help="The number of batches the server may push ahead of the client when using --fetch-mode stream.  Defaults to environment variable STREAM_CREDITS if set."
+)
+@click.pass_context
+def click_run_client(ctx: click.Context,
+                     version: bool,
                      server_protocol: str,
                      server_hostname: str,
                      server_port: int,
@@ -463,9 +586,239 @@ def click_run_client(version: bool,
                      tls_roots: str,
                      token: str,
                      max_result_set_rows: int,
-                     autocommit: bool
+                     autocommit: bool,
+                     result_format: str,
+                     compression: str,
+                     compression_level: int | None,
+                     fetch_mode: str,
+                     stream_credits: int
+                     ) -> None:
+    """
+    Runs an interactive SQL client - or, with a command, the client options are used by that command.
+    """
+    client_options = munchify(x={key: value for key, value in locals().items() if key != "ctx"})
+    if ctx.invoked_subcommand is None:
+        run_client(**client_options)
+    else:
+        ctx.obj = client_options
+
+
+def run_bench(client_options: Munch,
+              workload: str,
+              sessions: int,
+              rate: float,
+              duration: float,
+              max_queries: int,
+              fetch_size: int,
+              seed: int | None,
+              output: str | None
+              ):
+    ssl_context = get_ssl_context(server_protocol=client_options.server_protocol,
+                                  tls_verify=client_options.tls_verify,
+                                  tls_roots=client_options.tls_roots
+                                  )
+    load_generator = LoadGenerator(server_uri=get_server_uri(server_protocol=client_options.server_protocol,
+                                                             server_hostname=client_options.server_hostname,
+                                                             server_port=client_options.server_port,
+                                                             server_base_path=client_options.server_base_path
+                                                             ),
+                                   token=client_options.token,
+                                   statements=read_workload(path=workload),
+                                   sessions=sessions,
+                                   rate=rate,
+                                   duration=duration,
+                                   max_queries=max_queries,
+                                   fetch_mode=client_options.fetch_mode,
+                                   fetch_size=fetch_size,
+                                   stream_credits=client_options.stream_credits,
+                                   result_format=client_options.result_format,
+                                   ssl_context=ssl_context,
+                                   autocommit=client_options.autocommit,
+                                   compression=client_options.compression,
+                                   compression_level=client_options.compression_level,
+                                   seed=seed
+                                   )
+    summaries = asyncio.run(load_generator.run())
+
+    print(format_results_table(results=summaries, columns=LOAD_RESULT_COLUMNS))
+    error_counts = load_generator.get_error_counts()
+    if error_counts:
+        print(f"\nErrors ({sum(error_counts.values()):,}):")
+        for error, count in error_counts.most_common(10):
+            print(f"  {count:,} x {error}")
+
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(dict(summaries=summaries, errors=dict(error_counts)), output_file, indent=2)
+        print(f"Wrote results to: '{output}'")
+
+
+@click_run_client.command(name="bench")
+@click.option(
+    "--workload",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    help="A file of SQL statements - each terminated by a semicolon at the end of a line.  Comment lines of the form '-- name: <name>' and '-- weight: <weight>' just before a statement name it and set its relative frequency (default: 1)."
+)
+@click.option(
+    "--sessions",
+    type=int,
+    default=4,
+    show_default=True,
+    required=True,
+    help="The number of concurrent websocket sessions."
+)
+@click.option(
+    "--rate",
+    type=float,
+    default=0,
+    show_default=True,
+    required=True,
+    help="The target rate (queries per second) across all sessions - latency is then measured from when each query was scheduled.  0 runs as fast as possible."
+)
+@click.option(
+    "--duration",
+    type=float,
+    default=30,
+    show_default=True,
+    required=True,
+    help="How many seconds to start queries for.  0 means no limit (use --max-queries)."
+)
+@click.option(
+    "--max-queries",
+    type=int,
+    default=0,
+    show_default=True,
+    required=True,
+    help="The most queries to run.  0 means no limit."
+)
+@click.option(
+    "--fetch-size",
+    type=int,
+    default=10_000,
+    show_default=True,
+    required=True,
+    help="The number of rows per fetch (the fetch mode is the client's --fetch-mode)."
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=None,
+    required=False,
+    help="Seeds the choice of statements - for a repeatable workload."
+)
+@click.option(
+    "--output",
+    type=str,
+    default=None,
+    required=False,
+    help="A file to write the results to - as JSON."
+)
+@click.pass_obj
+def click_run_bench(client_options: Munch,
+                    workload: str,
+                    sessions: int,
+                    rate: float,
+                    duration: float,
+                    max_queries: int,
+                    fetch_size: int,
+                    seed: int | None,
+                    output: str | None
+                    ) -> None:
+    """
+    Generates load - runs a weighted workload of SQL statements over concurrent sessions, and reports throughput,
+    latency percentiles, errors and the server's own timings.
+    """
+    run_bench(**locals())
+
+
+def run_replay(client_options: Munch,
+               capture_file: str,
+               speed: float,
+               sql_source: str,
+               output: str | None
+               ):
+    header, sessions = read_capture(path=capture_file)
+    if sql_source == "captured" and header.get("sql") == "none":
+        raise click.UsageError(f"Workload capture: '{capture_file}' has no SQL - replay it with --sql-source synthetic")
+    if sql_source == "captured" and header.get("sql") == "redacted":
+        print("Note: the capture's SQL is redacted - queries run with their literals replaced, so their results may differ from the captured ones")
+
+    replayer = WorkloadReplayer(server_uri=get_server_uri(server_protocol=client_options.server_protocol,
+                                                          server_hostname=client_options.server_hostname,
+                                                          server_port=client_options.server_port,
+                                                          server_base_path=client_options.server_base_path
+                                                          ),
+                                token=client_options.token,
+                                sessions=sessions,
+                                speed=speed,
+                                sql_source=sql_source,
+                                ssl_context=get_ssl_context(server_protocol=client_options.server_protocol,
+                                                            tls_verify=client_options.tls_verify,
+                                                            tls_roots=client_options.tls_roots
+                                                            )
+                                )
+    summaries = asyncio.run(replayer.run())
+
+    captured_seconds, replay_seconds = replayer.get_durations()
+    print(format_results_table(results=summaries, columns=REPLAY_RESULT_COLUMNS))
+    print(f"\nReplayed {len(sessions):,} session(s) - captured over {captured_seconds:.2f} second(s), replayed in {replay_seconds:.2f} second(s) (speed: {speed or 'as fast as possible'})")
+
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(dict(summaries=summaries,
+                           captured_seconds=captured_seconds,
+                           replay_seconds=replay_seconds
+                           ),
+                      output_file,
+                      indent=2
+                      )
+        print(f"Wrote results to: '{output}'")
+
+
+@click_run_client.command(name="replay")
+@click.option(
+    "--capture-file",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+    help="A workload capture - written by the server's --capture-file option."
+)
+@click.option(
+    "--speed",
+    type=float,
+    default=DEFAULT_REPLAY_SPEED,
+    show_default=True,
+    required=True,
+    help="How fast to replay the capture - 1 at the captured pace, 2 twice as fast, etc.  0 sends each request as soon as it can."
+)
+@click.option(
+    "--sql-source",
+    type=click.Choice(["captured", "synthetic"]),
+    default="captured",
+    show_default=True,
+    required=True,
+    help="'captured' runs each query's captured SQL.  'synthetic' runs a query of the benchmark's Flight SQL stand-in backend in its place - returning the captured row count after the captured execution time - for a proxy in front of the stand-in (see: flight-sql-websocket-proxy-benchmark replay)."
+)
+@click.option(
+    "--output",
+    type=str,
+    default=None,
+    required=False,
+    help="A file to write the results to - as JSON."
+)
+@click.pass_obj
+def click_run_replay(client_options: Munch,
+                     capture_file: str,
+                     speed: float,
+                     sql_source: str,
+                     output: str | None
                      ) -> None:
-    run_client(**locals())
+    """
+    Replays a captured workload - each captured session's requests (with their fetch sizes, bursts and abandoned
+    cursors) at their captured times, and reports latency, lag behind the capture's schedule, and rows/bytes
+    against the captured ones.  The session settings (result format, compression, etc.) are the captured ones.
+    """
+    run_replay(**locals())
 
 
 if __name__ == "__main__":
@@ -1,8 +1,82 @@
 # Constants
 DEFAULT_MAX_WEBSOCKET_MESSAGE_SIZE = 1024 ** 3
+DEFAULT_WEBSOCKET_FRAGMENT_SIZE = 1024 ** 2
+IPC_SMALL_CHUNK_SIZE = 64 * 1024
+IPC_COMPRESSION_CODECS = ["lz4", "zstd"]
 DEFAULT_CLIENT_FETCH_SIZE = 50
-TIMER_TEXT = "{name}: Elapsed time: {:.4f} seconds"
+DEFAULT_RESULT_FORMAT = "base64"
+DEFAULT_STREAM_CREDITS = 4
+DEFAULT_ADAPTIVE_FETCH_TARGET_BYTES = 4 * 1024 ** 2
+DEFAULT_ADAPTIVE_FETCH_TARGET_SEND_SECONDS = 0.5
+DEFAULT_ADAPTIVE_FETCH_MIN_BYTES = 64 * 1024
+DEFAULT_DATABASE_POOL_MIN_SIZE = 1
+DEFAULT_DATABASE_POOL_MAX_SIZE = 100
+DEFAULT_DATABASE_POOL_IDLE_TIMEOUT = 300
+DEFAULT_DATABASE_POOL_HEALTH_CHECK_INTERVAL = 60
+DEFAULT_DATABASE_POOL_CHECKOUT_TIMEOUT = 30
+DEFAULT_MAX_SESSION_CONCURRENCY = 16
+DEFAULT_MAX_CONCURRENT_QUERIES = 8
+DEFAULT_MAX_QUERIES_PER_USER = 4
+DEFAULT_MAX_QUERY_QUEUE_DEPTH = 1000
+QUERY_PRIORITY_WEIGHTS = dict(low=1, normal=4, high=16)
+DEFAULT_RESULT_CACHE_MAX_BYTES = 0
+DEFAULT_RESULT_CACHE_TTL = 60
+DEFAULT_PREFETCH_BATCHES = 0
+DEFAULT_PREFETCH_BYTES = 64 * 1024 ** 2
+DEFAULT_RESULT_MEMORY_BUDGET = 0
+DEFAULT_RESULT_MEMORY_BUDGET_FRACTION = 0.5
+DEFAULT_MAX_PARTITION_READERS = 8
+PARTITION_READ_POLL_INTERVAL = 0.1
+DEFAULT_DISTRIBUTE_MODE = "false"
+DEFAULT_BACKEND_ROUTING_POLICY = "least_outstanding"
+DEFAULT_BACKEND_HEALTH_CHECK_INTERVAL = 10
+DEFAULT_BACKEND_EJECTION_THRESHOLD = 3
+DEFAULT_BACKEND_EJECTION_TIME = 30
+DEFAULT_BACKEND_MAX_RETRIES = 1
+BACKEND_HEALTH_CHECK_TIMEOUT = 5
+BACKEND_LATENCY_EWMA_WEIGHT = 0.2
+BACKEND_HASH_RING_REPLICAS = 64
+DEFAULT_CAPTURE_SQL = "redacted"
+CAPTURE_FORMAT_VERSION = 1
+DEFAULT_PROCESS_ENCODING_MIN_BYTES = 0
+# Seconds after startup - so that the calibration does not slow down clients (re)connecting
+PROCESS_ENCODING_CALIBRATION_DELAY = 30
+PROCESS_ENCODING_CALIBRATION_SIZES = [2 ** power for power in range(14, 23, 2)]
+PROCESS_ENCODING_CALIBRATION_ROUNDS = 3
+PROCESS_ENCODING_MAX_CPU_RATIO = 0.5
+PROCESS_ENCODING_MAX_LATENCY_RATIO = 2.5
+SHARED_MEMORY_PATH = "/dev/shm"
+DEFAULT_SERVER_WORKERS = 1
+WORKER_MONITOR_INTERVAL = 1
+WORKER_METRICS_PUBLISH_INTERVAL = 1
+WORKER_MIN_UPTIME = 10
+WORKER_RESTART_DELAY = 1
+WORKER_MAX_RESTART_DELAY = 30
+WORKER_SHUTDOWN_TIMEOUT = 10
+METRICS_PREFIX = "flight_sql_websocket_proxy"
+METRICS_LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+BENCHMARK_AUTHENTICATION_BYPASS_USER = "benchmark"
+BENCHMARK_RSS_SAMPLE_INTERVAL = 0.02
+BENCHMARK_STARTUP_TIMEOUT = 60
+DEFAULT_BENCHMARK_ITERATIONS = 3
+DEFAULT_BENCHMARK_WARMUP_ITERATIONS = 1
+DEFAULT_REPLAY_SPEED = 1.0
+REPLAY_DRAIN_TIMEOUT = 30
+JWKS_REQUEST_TIMEOUT = 10
+JWKS_DEFAULT_TTL = 300
+JWKS_MIN_TTL = 30
+JWKS_MAX_TTL = 24 * 60 * 60
+JWKS_REFRESH_AT_FRACTION = 0.9
+JWKS_RETRY_INTERVAL = 10
+JWKS_UNKNOWN_KID_REFRESH_INTERVAL = 30
+DEFAULT_AUTHENTICATION_CACHE_MAX_ENTRIES = 10000
+DEFAULT_TOKEN_CACHE_MAX_TTL = 300
+DEFAULT_USER_CACHE_TTL = 300
 
 SERVER_PROTOCOL = "wss"
 SERVER_PORT = 8765
 SERVER_BASE_PATH = "/"
+# The metrics endpoint is off unless a port is given - and then only listens locally unless told otherwise
+DEFAULT_METRICS_PORT = 0
+DEFAULT_METRICS_HOST = "127.0.0.1"
+METRICS_PATH = "/metrics"
@@ -1,20 +1,87 @@
+import functools
 import json
 
-import sqlparse
 from munch import munchify
 from pglast import parser
 
+# How each shard's partial result of an aggregate combines into the whole
+SUMMARY_AGGREGATE_FUNCTIONS = dict(sum="SUM", count="SUM", min="MIN", max="MAX",
+                                   # Not exact - an average of the shards' averages (see merge_problems)
+                                   avg="AVG"
+                                   )
+
+
+
+@functools.cache
+def get_known_function_names() -> tuple[frozenset[str], frozenset[str]]:
+    """
+    The names of DuckDB's (the merge's engine) aggregate functions - and of its scalar functions which are not
+    aggregates too.
+    """
+    import duckdb
+
+    with duckdb.connect() as duckdb_connection:
+        function_names = duckdb_connection.execute("SELECT DISTINCT function_type, function_name FROM duckdb_functions() "
+                                                   "WHERE function_type IN ('aggregate', 'scalar', 'macro')"
+                                                   ).fetchall()
+    aggregate_names = frozenset(name for function_type, name in function_names if function_type == "aggregate")
+    scalar_names = frozenset(name for function_type, name in function_names if function_type != "aggregate") - aggregate_names
+    return aggregate_names, scalar_names
+
+
+def get_function_name(func_call) -> str:
+    return func_call.funcname[-1].String.sval.lower()
+
+
+def is_aggregate_function(func_call) -> bool:
+    function_name = get_function_name(func_call)
+    return function_name in SUMMARY_AGGREGATE_FUNCTIONS or function_name in get_known_function_names()[0]
+
+
+def is_scalar_function(func_call) -> bool:
+    # SQL syntax forms (e.g. EXTRACT, SUBSTRING ... FROM, TRIM) are all scalar
+    return func_call.get("funcformat") == "COERCE_SQL_SYNTAX" or get_function_name(func_call) in get_known_function_names()[1]
+
 
 def target_is_aggregate(target):
     try:
-        for funcname in target.ResTarget.val.FuncCall.funcname:
-            if funcname.String.sval in ("sum", "avg", "min", "max", "count"):
-                return True
+        return is_aggregate_function(target.ResTarget.val.FuncCall)
     except AttributeError:
-        pass
+        return False
+
+
+def find_nodes(node, node_type: str):
+    """
+    Yields every node of node_type (e.g. "FuncCall") in a parse tree - at any depth.
+    """
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == node_type:
+                yield value
+            yield from find_nodes(value, node_type)
+    elif isinstance(node, list):
+        for item in node:
+            yield from find_nodes(item, node_type)
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def get_integer_constant(node) -> int | None:
+    a_const = node.get("A_Const") if node else None
+    if a_const is None or a_const.get("isnull") or "ival" not in a_const:
+        return None
+    # A zero is left out of the parse tree
+    return a_const.ival.get("ival", 0)
 
 
 class Query(object):
+    """
+    A parsed SELECT statement - and how to merge its results from several shards (each of which runs the whole
+    statement over its own part of the data) into the statement's result over all of the data.  The merge is a
+    "summary query" over the shards' results combined into one relation: combined_result.
+    """
     def __init__(self, query_text: str):
         self.query_text = query_text
         self.parsed_query = munchify(
@@ -22,119 +89,171 @@ class Query(object):
         self._validate_query()
         self.select_stmt = self.parsed_query.stmt.SelectStmt
 
-        self.summary_query = self.__get_summary_query()
+        # Each ORDER BY key - as a 0-based output column position (or an output column name) - with its direction
+        self.sort_keys: list[tuple[int | str, str]] = []
+        self.merge_problems = self.__get_merge_problems()
 
     def _validate_query(self):
         if not hasattr(self.parsed_query.stmt, "SelectStmt"):
             raise RuntimeError(
                 "The query is NOT a SELECT statement - it is not supported.")
 
+    @property
+    def targets(self) -> list:
+        return self.select_stmt.get("targetList", [])
+
     @property
     def has_aggregates(self):
-        for target in self.select_stmt.targetList:
+        for target in self.targets:
             if target_is_aggregate(target):
                 return True
         return False
 
-    def __get_summary_query(self):
-        def __get_select_and_group_by_sql():
-            select_column_sql = ""
-            group_by_clause = ""
-            for target in self.select_stmt.targetList:
-                if not target_is_aggregate(target):
-                    column_name = target.ResTarget.val.ColumnRef.fields[-1].String.sval
-                    group_by_clause += f", {column_name}"
-                    select_column_sql += f", {column_name}"
-                else:
-                    raw_aggregate_function = \
-                        target.ResTarget.val.FuncCall.funcname[
-                            0].String.sval.upper()
-                    if raw_aggregate_function in ("SUM", "COUNT"):
-                        summary_aggregate_function = "SUM"
-                    else:
-                        summary_aggregate_function = raw_aggregate_function
-
-                    if hasattr(target.ResTarget, "name"):
-                        column_name = target.ResTarget.name
-                    elif getattr(target.ResTarget.val.FuncCall, "agg_star",
-                                 False):
-                        column_name = f'"{target.ResTarget.val.FuncCall.funcname[0].String.sval}_star()"'
-                    else:
-                        column_name = (f'"{target.ResTarget.val.FuncCall.funcname[0].String.sval}('
-                                       f'{"DISTINCT " if getattr(target.ResTarget.val.FuncCall, "agg_distinct", False) else ""}'
-                                       f'{target.ResTarget.val.FuncCall.args[0].ColumnRef.fields[-1].String.sval})"'
-                                       )
-
-                    aggregate_clause = f", {summary_aggregate_function} ({column_name}) AS {column_name}"
-                    select_column_sql += aggregate_clause
-
-            select_column_sql = select_column_sql.strip(', ')
-            if group_by_clause:
-                group_by_clause = f" GROUP BY {group_by_clause.lstrip(', ')}"
-
-            return select_column_sql, group_by_clause
-
-        def __get_order_by_clause():
-            sort_columns = getattr(self.select_stmt, "sortClause", None)
-            order_by_clause = ""
-            if sort_columns:
-                order_by_clause = "\nORDER BY "
-                comma = ""
-                for sort_column in sort_columns:
-                    if hasattr(sort_column.SortBy.node, "ColumnRef"):
-                        column_name = sort_column.SortBy.node.ColumnRef.fields[-1].String.sval
-                    elif hasattr(sort_column.SortBy.node, "A_Const"):
-                        column_name = sort_column.SortBy.node.A_Const.ival.ival
-                    sort_direction = "ASC" if sort_column.SortBy.sortby_dir == "SORTBY_DEFAULT" else "DESC"
-                    sort_nulls = "NULLS FIRST" if sort_column.SortBy.sortby_nulls == "SORTBY_NULLS_DEFAULT" else "NULLS LAST"
-                    order_by_clause += f"{comma}{column_name} {sort_direction} {sort_nulls}"
-                    comma = ",\n"
-
-            return order_by_clause
-
-        def __get_limit_clause():
-            limit_option = getattr(self.select_stmt, "limitCount", None)
-            limit_clause = ""
-            if limit_option:
-                limit_clause = f"\nLIMIT {limit_option.A_Const.ival.ival}"
-
-            return limit_clause
+    @property
+    def has_star(self) -> bool:
+        return any(list(find_nodes(target.ResTarget.val, "A_Star")) for target in self.targets)
+
+    @property
+    def is_exactly_mergeable(self) -> bool:
+        return not self.merge_problems
+
+    @property
+    def limit(self) -> int | None:
+        return get_integer_constant(self.select_stmt.get("limitCount"))
+
+    def __get_target_position(self, name: str) -> int | None:
+        # An output column alias first - then a selected column
+        for position, target in enumerate(self.targets):
+            if target.ResTarget.get("name") == name:
+                return position
+        for position, target in enumerate(self.targets):
+            column_ref = target.ResTarget.val.get("ColumnRef")
+            if column_ref and "String" in column_ref.fields[-1] and column_ref.fields[-1].String.sval == name:
+                return position
+        return None
+
+    def __get_merge_problems(self) -> list[str]:
+        """
+        :return: What about the statement keeps its shards' results from merging into exactly its result over
+                 all of the data - nothing, if they do.
+        """
+        if self.select_stmt.get("op", "SETOP_NONE") != "SETOP_NONE":
+            return ["a set operation (UNION, INTERSECT or EXCEPT)"]
+
+        problems = []
+        if self.select_stmt.get("havingClause"):
+            problems.append("a HAVING clause (applied to each shard's partial aggregates)")
+        if self.select_stmt.get("limitOffset"):
+            problems.append("an OFFSET (applied on each shard)")
+        if any(self.select_stmt.get("distinctClause", [])):
+            problems.append("DISTINCT ON")
+        if list(find_nodes(self.select_stmt.get("groupClause", []), "GroupingSet")):
+            problems.append("GROUPING SETS, CUBE or ROLLUP")
+        if any(func_call.get("over") for func_call in find_nodes(self.targets, "FuncCall")):
+            problems.append("a window function")
+
+        for target in self.targets:
+            if target_is_aggregate(target):
+                func_call = target.ResTarget.val.FuncCall
+                function_name = get_function_name(func_call)
+                if function_name == "avg":
+                    problems.append("AVG (merged as an average of the shards' averages)")
+                elif function_name not in SUMMARY_AGGREGATE_FUNCTIONS:
+                    problems.append(f"{function_name.upper()} (it cannot be re-aggregated - one shard's value is kept)")
+                if func_call.get("agg_distinct"):
+                    problems.append("a DISTINCT aggregate (merged as a sum of the shards' distinct counts)")
+            elif any(is_aggregate_function(func_call) for func_call in find_nodes(target.ResTarget.val, "FuncCall")):
+                problems.append("an expression over aggregates (only bare aggregates can be re-aggregated)")
+
+            # A function we do not know may be an aggregate (e.g. a user-defined one) - which would be merged as a
+            # group key
+            for func_call in find_nodes(target.ResTarget.val, "FuncCall"):
+                if not (func_call.get("over") or is_aggregate_function(func_call) or is_scalar_function(func_call)):
+                    problems.append(f"a function which is not known to be scalar: {get_function_name(func_call)}")
 
         if self.has_aggregates:
-            select_column_sql, group_by_clause = __get_select_and_group_by_sql()
-            order_by_clause = __get_order_by_clause()
-            limit_clause = __get_limit_clause()
-
-            return_sql = f"SELECT {select_column_sql} FROM combined_result {group_by_clause}{order_by_clause}{limit_clause}"
-            return sqlparse.format(sql=return_sql,
-                                   reindent=True,
-                                   keyword_case='upper',
-                                   identifier_case='lower',
-                                   use_space_around_operators=True,
-                                   comma_first=True
-                                   )
+            if self.has_star:
+                problems.append("* alongside aggregates")
+            group_key_count = sum(1 for target in self.targets if not target_is_aggregate(target))
+            if len(self.select_stmt.get("groupClause", [])) > group_key_count:
+                problems.append("GROUP BY keys which are not selected")
+
+        for sort_by in self.select_stmt.get("sortClause", []):
+            sort_by = sort_by.SortBy
+            position = get_integer_constant(sort_by.node)
+            if position is not None:
+                sort_key = position - 1
+            elif "ColumnRef" in sort_by.node and "String" in sort_by.node.ColumnRef.fields[-1]:
+                name = sort_by.node.ColumnRef.fields[-1].String.sval
+                sort_key = self.__get_target_position(name)
+                if sort_key is None and self.has_star:
+                    # It may be one of the columns * expands to
+                    sort_key = name
+            else:
+                sort_key = None
+
+            if sort_key is None:
+                problems.append("ORDER BY an expression which is not selected")
+                continue
+
+            direction = "DESC" if sort_by.sortby_dir == "SORTBY_DESC" else "ASC"
+            if sort_by.sortby_nulls == "SORTBY_NULLS_FIRST":
+                direction += " NULLS FIRST"
+            elif sort_by.sortby_nulls == "SORTBY_NULLS_LAST":
+                direction += " NULLS LAST"
+            self.sort_keys.append((sort_key, direction))
+
+        if self.select_stmt.get("limitCount") and self.limit is None and not self.select_stmt.limitCount.get("A_Const"):
+            problems.append("a LIMIT which is not a constant")
+
+        return problems
+
+    def get_summary_query(self, column_names: list[str]) -> str | None:
+        """
+        Builds the query which merges the shards' results (combined into one relation: combined_result) - its
+        aggregates are re-aggregated over its group keys, and its DISTINCT, ORDER BY and LIMIT are re-applied.
+        Whatever cannot be merged (see merge_problems) is merged as well as it can be - or left out.
+
+        :param column_names: The names of the shards' result columns - the statement's targets, in order.
+        :return: None - if the shards' results only need to be concatenated.
+        """
+        quoted_names = [quote_identifier(column_name) for column_name in column_names]
+        group_by_clause = ""
+        distinct = bool(self.select_stmt.get("distinctClause"))
+        if self.has_aggregates and not self.has_star:
+            if len(self.targets) != len(column_names):
+                raise ValueError(f"The query selects {len(self.targets)} column(s) - but its result has {len(column_names)}")
+
+            select_columns = []
+            group_keys = []
+            for target, quoted_name in zip(self.targets, quoted_names):
+                if target_is_aggregate(target):
+                    # An aggregate which cannot be re-aggregated keeps one shard's value (see merge_problems)
+                    summary_function = SUMMARY_AGGREGATE_FUNCTIONS.get(get_function_name(target.ResTarget.val.FuncCall), "ANY_VALUE")
+                    select_columns.append(f"{summary_function}({quoted_name}) AS {quoted_name}")
+                else:
+                    select_columns.append(quoted_name)
+                    group_keys.append(quoted_name)
+            select_column_sql = ", ".join(select_columns)
+            if group_keys:
+                group_by_clause = f" GROUP BY {', '.join(group_keys)}"
+        else:
+            select_column_sql = "*"
+            # Grouping without aggregates - each shard's groups may be another's too
+            distinct = distinct or bool(self.select_stmt.get("groupClause"))
+
+        order_by_items = []
+        for sort_key, direction in self.sort_keys:
+            if isinstance(sort_key, int) and 0 <= sort_key < len(quoted_names):
+                order_by_items.append(f"{quoted_names[sort_key]} {direction}")
+            elif isinstance(sort_key, str) and sort_key in column_names:
+                order_by_items.append(f"{quote_identifier(sort_key)} {direction}")
+        order_by_clause = f" ORDER BY {', '.join(order_by_items)}" if order_by_items else ""
+        limit_clause = f" LIMIT {self.limit}" if self.limit is not None else ""
+
+        if select_column_sql == "*" and not (distinct or order_by_clause or limit_clause):
+            return None
 
-# x = Query(query_text="""
-# select
-#        l_returnflag,
-#        l_linestatus,
-#        sum(l_quantity) as sum_qty,
-#        sum(l_extendedprice) as sum_base_price,
-#        sum(l_extendedprice * (1-l_discount)) as sum_disc_price,
-#        sum(l_extendedprice * (1-l_discount) * (1+l_tax)) as sum_charge,
-#        avg(l_quantity) as avg_qty,
-#        avg(l_extendedprice) as avg_price,
-#        avg(l_discount) as avg_disc,
-#        count(*) as count_order
-#  from
-#        lineitem
-#  where
-#        l_shipdate <= DATE '1998-12-01' - 90
-#  group by
-#        l_returnflag,
-#        l_linestatus
-#  order by
-#        1, 2
-# limit 100;""")
-#
-# print(x)
+        return (f"SELECT {'DISTINCT ' if distinct else ''}{select_column_sql} FROM combined_result"
+                f"{group_by_clause}{order_by_clause}{limit_clause}"
+                )
@@ -1,69 +1,162 @@
-from clerk_backend_api import Clerk, models
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+from clerk_backend_api import Clerk
+import httpx
 import jwt
-import requests
-from jwt.algorithms import RSAAlgorithm
 from jwt.exceptions import InvalidTokenError
-from asyncio import Lock
 
-# In-memory cache for public keys
-public_key_cache = {}
-cache_lock = Lock()  # Lock to prevent race conditions while updating the cache
+from .config import logger
+from .constants import JWKS_REQUEST_TIMEOUT, JWKS_DEFAULT_TTL, JWKS_MIN_TTL, JWKS_MAX_TTL, JWKS_REFRESH_AT_FRACTION, \
+    JWKS_RETRY_INTERVAL, JWKS_UNKNOWN_KID_REFRESH_INTERVAL
+
+CACHE_CONTROL_MAX_AGE_PATTERN = re.compile(r"(?:^|,)\s*(?:s-maxage|max-age)\s*=\s*\"?(\d+)", re.I)
+CACHE_CONTROL_NO_CACHE_PATTERN = re.compile(r"(?:^|,)\s*(?:no-cache|no-store)\b", re.I)
 
 
-async def get_cached_public_key(jwks_url: str, kid: str):
+def get_cache_control_ttl(cache_control: str | None) -> int | None:
     """
-    Retrieves the public key from the cache or fetches it from the JWKS endpoint if it's not cached.
-    :param jwks_url: The URL of the JWKS endpoint.
-    :param kid: The key ID to find the public key.
-    :return: The public key corresponding to the given `kid`.
+    :param cache_control: A Cache-Control response header value.
+    :return: The seconds the response may be cached for - or None if the header does not say.
     """
-    global public_key_cache
+    if not cache_control:
+        return None
+    if CACHE_CONTROL_NO_CACHE_PATTERN.search(cache_control):
+        return 0
+    max_ages = [int(max_age) for max_age in CACHE_CONTROL_MAX_AGE_PATTERN.findall(cache_control)]
+    return min(max_ages) if max_ages else None
 
-    # Check if the public key is in the cache
-    if kid in public_key_cache:
-        return public_key_cache[kid]
 
-    # Acquire the lock to fetch and update the cache
-    async with cache_lock:
-        # Double-check if the key was added to the cache during the wait
-        if kid in public_key_cache:
-            return public_key_cache[kid]
+class JwksManager:
+    """
+    Holds the public keys of a JWKS endpoint - fetched asynchronously (over a pooled HTTP client), loaded at
+    startup, and refreshed in the background before they expire.  Their lifetime comes from the response's
+    Cache-Control header (or JWKS_DEFAULT_TTL) - kept within JWKS_MIN_TTL and JWKS_MAX_TTL.
+
+    A token signed with a key we do not have (e.g. a newly rotated one) triggers a refresh - but no more than
+    one every JWKS_UNKNOWN_KID_REFRESH_INTERVAL seconds, so that a flood of bad tokens is not a flood of JWKS
+    requests.  Concurrent refreshes share one request.  If a refresh fails, the keys we have are kept.
+    """
+    def __init__(self,
+                 jwks_url: str
+                 ):
+        self.jwks_url = jwks_url
+        self.public_keys: dict[str, object] = {}
+        self.http_client = httpx.AsyncClient(timeout=JWKS_REQUEST_TIMEOUT)
+        self.expires_at: float | None = None
+        self.last_refresh_at: float | None = None
+        self.pending_refresh: asyncio.Future | None = None
+        self.refresh_task: asyncio.Task | None = None
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.unknown_kid_rejections = 0
 
-        # Fetch the JWKS data
-        response = requests.get(jwks_url)
+    async def fetch_keys(self):
+        response = await self.http_client.get(self.jwks_url)
         if response.status_code != 200:
-            raise ConnectionError(f"Failed to fetch JWKS from {jwks_url}: {response.status_code}")
+            raise ConnectionError(f"Failed to fetch JWKS from {self.jwks_url}: {response.status_code}")
 
-        jwks = response.json()
-        keys = jwks.get("keys", [])
-        if not keys:
-            raise ValueError("No keys found in JWKS.")
+        public_keys = {}
+        for key_data in response.json().get("keys", []):
+            try:
+                public_keys[key_data["kid"]] = jwt.PyJWK(key_data).key
+            except Exception as e:
+                # One key we cannot use should not cost us the others
+                logger.warning(msg=f"Skipping JWKS key: '{key_data.get('kid')}' from {self.jwks_url} - error: {str(e)}")
+        if not public_keys:
+            raise ValueError(f"No usable keys found in JWKS from {self.jwks_url}.")
 
-        # Find the key with the matching `kid`
-        public_key_data = next((key for key in keys if key["kid"] == kid), None)
-        if not public_key_data:
-            raise ValueError(f"Key with kid `{kid}` not found in JWKS.")
+        ttl = get_cache_control_ttl(response.headers.get("cache-control"))
+        self.public_keys = public_keys
+        self.expires_at = time.monotonic() + min(max(JWKS_DEFAULT_TTL if ttl is None else ttl, JWKS_MIN_TTL), JWKS_MAX_TTL)
+        self.refreshes += 1
 
-        # Construct the public key
+    async def refresh(self):
+        if self.pending_refresh is None:
+            self.last_refresh_at = time.monotonic()
+            self.pending_refresh = asyncio.ensure_future(self.fetch_keys())
+            self.pending_refresh.add_done_callback(self.finish_refresh)
+        # Shielded - so that one waiter going away does not cancel the refresh the others are waiting on
+        await asyncio.shield(self.pending_refresh)
+
+    def finish_refresh(self,
+                       refresh: asyncio.Future
+                       ):
+        self.pending_refresh = None
+        if not refresh.cancelled() and refresh.exception() is not None:
+            self.refresh_failures += 1
+
+    async def get_public_key(self,
+                             kid: str
+                             ):
+        """
+        :param kid: The key ID from the token's header.
+        :return: The public key with the given `kid`.
+        :raises: InvalidTokenError if the JWKS has no such key.
+        """
+        public_key = self.public_keys.get(kid)
+        if public_key is not None:
+            return public_key
+
+        # Maybe the keys were rotated - look again, unless we looked very recently
+        if self.pending_refresh is not None or self.last_refresh_at is None \
+                or time.monotonic() - self.last_refresh_at >= JWKS_UNKNOWN_KID_REFRESH_INTERVAL:
+            await self.refresh()
+            public_key = self.public_keys.get(kid)
+
+        if public_key is None:
+            self.unknown_kid_rejections += 1
+            raise InvalidTokenError(f"Key with kid `{kid}` not found in JWKS.")
+        return public_key
+
+    async def refresh_periodically(self):
+        while True:
+            if self.expires_at is None:
+                delay = JWKS_RETRY_INTERVAL
+            else:
+                # Refresh before the keys expire - rather than when a token needs them
+                delay = max((self.expires_at - time.monotonic()) * JWKS_REFRESH_AT_FRACTION, 0)
+            await asyncio.sleep(delay)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(msg=f"Failed to refresh JWKS from {self.jwks_url} - keeping the {len(self.public_keys)} key(s) we have - error: {str(e)}")
+                await asyncio.sleep(JWKS_RETRY_INTERVAL)
+
+    async def start(self):
+        # Loaded up front - so that the first login does not wait for them
         try:
-            public_key = RSAAlgorithm.from_jwk(public_key_data)
+            await self.refresh()
+            logger.info(msg=f"Loaded {len(self.public_keys)} JWKS key(s) from {self.jwks_url}")
         except Exception as e:
-            raise ValueError(f"Error constructing public key from JWK: {str(e)}")
+            logger.error(msg=f"Failed to load JWKS from {self.jwks_url} - retrying in the background - error: {str(e)}")
+        self.refresh_task = asyncio.create_task(self.refresh_periodically())
 
-        # Update the cache
-        public_key_cache[kid] = public_key
-        return public_key
+    async def close(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+        await self.http_client.aclose()
 
+    def stats(self) -> dict:
+        return dict(keys=len(self.public_keys),
+                    refreshes=self.refreshes,
+                    refresh_failures=self.refresh_failures,
+                    unknown_kid_rejections=self.unknown_kid_rejections
+                    )
 
-async def validate_and_decode_jwt(jwks_url: str,
+
+async def validate_and_decode_jwt(jwks_manager: JwksManager,
                                   token: str,
                                   audience: str = None,
                                   issuer: str = None
                                   ):
     """
-    Validates and decodes the JWT using a public key retrieved from the JWKS endpoint or cache.
+    Validates and decodes the JWT using a public key from the JWKS manager.
 
-    :param jwks_url: The URL of the JWKS endpoint.
+    :param jwks_manager: The keys of the JWKS endpoint.
     :param token: The JWT to validate and decode.
     :param audience: Optional audience to validate in the JWT payload.
     :param issuer: Optional issuer to validate in the JWT payload.
@@ -79,8 +172,7 @@ async def validate_and_decode_jwt(jwks_url: str,
     except jwt.DecodeError:
         raise InvalidTokenError("Invalid Token: Unable to decode JWT header.")
 
-    # Get the cached public key or fetch it if not cached
-    public_key = await get_cached_public_key(jwks_url, kid)
+    public_key = await jwks_manager.get_public_key(kid)
 
     # Decode and validate the JWT
     try:
@@ -97,28 +189,147 @@ async def validate_and_decode_jwt(jwks_url: str,
     except Exception as e:
         raise ValueError(f"Unexpected error while decoding JWT: {str(e)}")
 
-async def authenticate_user(oauth2_secret_key: str,
-                            jwks_url: str,
-                            session_token_issuer: str,
-                            user_token: str
-                            ):
-    decoded_jwt = await validate_and_decode_jwt(jwks_url=jwks_url,
-                                                token=user_token,
-                                                issuer=session_token_issuer
-                                                )
-    async with Clerk(
-            bearer_auth=oauth2_secret_key,
-    ) as clerk:
-        try:
-            user = await clerk.users.get_async(user_id=decoded_jwt.get("sub"))
 
-            return user.email_addresses[0].email_address
+class ExpiringCache:
+    """
+    A bounded cache whose entries each expire at their own time (epoch seconds) - the least-recently-used entries
+    are evicted to keep it under max_entries (0 disables it).
+    """
+    def __init__(self,
+                 max_entries: int
+                 ):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-        except models.ClerkErrors as e:
-            # handle e.data: models.ClerkErrorsData
-            raise (e)
-        except models.SDKError as e:
-            # handle exception
-            raise (e)
-        except Exception as e:
-            raise (e)
+    def get(self,
+            key: str
+            ) -> str | None:
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] <= time.time():
+            del self.entries[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self,
+            key: str,
+            value: str,
+            expires_at: float
+            ):
+        if not self.max_entries or expires_at <= time.time():
+            return
+
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def get_token_hash(token: str) -> str:
+    # We never hold on to the tokens themselves
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class UserAuthenticator:
+    """
+    Verifies client session tokens - and resolves their users' email addresses (via the Clerk API).
+
+    A verified token's user is cached (by the token's hash) until the token expires - or for token_cache_max_ttl
+    seconds, if that is sooner - so that reconnects with the same token skip the verification and the Clerk call.
+    Users' email addresses are cached for user_cache_ttl seconds - so that a user's new tokens skip the Clerk call.
+    Sockets which authenticate with the same token at once share one verification.
+    """
+    def __init__(self,
+                 clerk_secret_key: str,
+                 jwks_manager: JwksManager,
+                 session_token_issuer: str,
+                 cache_max_entries: int,
+                 token_cache_max_ttl: int,
+                 user_cache_ttl: int
+                 ):
+        self.jwks_manager = jwks_manager
+        self.session_token_issuer = session_token_issuer
+        self.token_cache_max_ttl = token_cache_max_ttl
+        self.user_cache_ttl = user_cache_ttl
+        self.token_cache = ExpiringCache(max_entries=cache_max_entries if token_cache_max_ttl > 0 else 0)
+        self.user_cache = ExpiringCache(max_entries=cache_max_entries if user_cache_ttl > 0 else 0)
+        self.pending_verifications: dict[str, asyncio.Future] = {}
+        # One client (and its connection pool) for all lookups - rather than one per authentication
+        self.clerk = Clerk(bearer_auth=clerk_secret_key)
+
+    async def get_user_email(self,
+                             user_id: str
+                             ) -> str:
+        email = self.user_cache.get(user_id)
+        if email is None:
+            user = await self.clerk.users.get_async(user_id=user_id)
+            email = user.email_addresses[0].email_address
+            self.user_cache.put(key=user_id,
+                                value=email,
+                                expires_at=time.time() + self.user_cache_ttl
+                                )
+        return email
+
+    async def verify(self,
+                     user_token: str,
+                     token_hash: str
+                     ) -> str:
+        decoded_jwt = await validate_and_decode_jwt(jwks_manager=self.jwks_manager,
+                                                    token=user_token,
+                                                    issuer=self.session_token_issuer
+                                                    )
+        email = await self.get_user_email(user_id=decoded_jwt.get("sub"))
+
+        expires_at = time.time() + self.token_cache_max_ttl
+        if decoded_jwt.get("exp") is not None:
+            expires_at = min(expires_at, float(decoded_jwt["exp"]))
+        self.token_cache.put(key=token_hash,
+                             value=email,
+                             expires_at=expires_at
+                             )
+        return email
+
+    async def authenticate(self,
+                           user_token: str
+                           ) -> str:
+        """
+        :param user_token: The client's session token (a JWT).
+        :return: The email address of the token's user.
+        :raises: InvalidTokenError (or the Clerk API's error) if the token cannot be verified.
+        """
+        token_hash = get_token_hash(user_token)
+        email = self.token_cache.get(token_hash)
+        if email is not None:
+            return email
+
+        verification = self.pending_verifications.get(token_hash)
+        if verification is None:
+            verification = asyncio.ensure_future(self.verify(user_token=user_token, token_hash=token_hash))
+            self.pending_verifications[token_hash] = verification
+            verification.add_done_callback(lambda _: self.pending_verifications.pop(token_hash, None))
+
+        # Shielded - so that one socket going away does not cancel the verification the others are waiting on
+        return await asyncio.shield(verification)
+
+    async def close(self):
+        await self.clerk.__aexit__(None, None, None)
+
+    def stats(self) -> dict:
+        return dict(token_cache_entries=len(self.token_cache),
+                    token_cache_hits=self.token_cache.hits,
+                    token_cache_misses=self.token_cache.misses,
+                    user_cache_entries=len(self.user_cache),
+                    user_cache_hits=self.user_cache.hits,
+                    user_cache_misses=self.user_cache.misses
+                    )
@@ -1,13 +1,26 @@
 import os
+import socket
+import tempfile
 from pathlib import Path
 
 import click
 from dotenv import load_dotenv
 
 from . import __version__ as arrow_flight_sql_websocket_proxy_server_version
-from .constants import DEFAULT_MAX_WEBSOCKET_MESSAGE_SIZE, DEFAULT_CLIENT_FETCH_SIZE, \
-    SERVER_PORT, SERVER_BASE_PATH
+from .constants import DEFAULT_MAX_WEBSOCKET_MESSAGE_SIZE, DEFAULT_WEBSOCKET_FRAGMENT_SIZE, DEFAULT_CLIENT_FETCH_SIZE, \
+    DEFAULT_RESULT_FORMAT, DEFAULT_ADAPTIVE_FETCH_TARGET_BYTES, DEFAULT_DATABASE_POOL_MIN_SIZE, \
+    DEFAULT_DATABASE_POOL_MAX_SIZE, DEFAULT_DATABASE_POOL_IDLE_TIMEOUT, DEFAULT_DATABASE_POOL_HEALTH_CHECK_INTERVAL, \
+    DEFAULT_DATABASE_POOL_CHECKOUT_TIMEOUT, DEFAULT_MAX_SESSION_CONCURRENCY, DEFAULT_MAX_CONCURRENT_QUERIES, \
+    DEFAULT_MAX_QUERIES_PER_USER, DEFAULT_MAX_QUERY_QUEUE_DEPTH, DEFAULT_RESULT_CACHE_MAX_BYTES, \
+    DEFAULT_RESULT_CACHE_TTL, DEFAULT_PREFETCH_BATCHES, DEFAULT_PREFETCH_BYTES, DEFAULT_RESULT_MEMORY_BUDGET, \
+    DEFAULT_MAX_PARTITION_READERS, DEFAULT_DISTRIBUTE_MODE, DEFAULT_BACKEND_ROUTING_POLICY, DEFAULT_BACKEND_HEALTH_CHECK_INTERVAL, \
+    DEFAULT_BACKEND_EJECTION_THRESHOLD, DEFAULT_BACKEND_EJECTION_TIME, DEFAULT_BACKEND_MAX_RETRIES, DEFAULT_CAPTURE_SQL, \
+    DEFAULT_SERVER_WORKERS, DEFAULT_PROCESS_ENCODING_MIN_BYTES, DEFAULT_AUTHENTICATION_CACHE_MAX_ENTRIES, \
+    DEFAULT_TOKEN_CACHE_MAX_TTL, DEFAULT_USER_CACHE_TTL, SERVER_PORT, SERVER_BASE_PATH, DEFAULT_METRICS_PORT, \
+    DEFAULT_METRICS_HOST, METRICS_PATH
+from .server_components.common import CaptureSql, DistributeMode, RoutingPolicy
 from .server_components.server_class import Server
+from .server_components.supervisor import Supervisor
 from .utils import coro, get_cpu_count
 
 # Load our environment file if it is present
@@ -17,6 +30,8 @@ load_dotenv(dotenv_path=".env")
 async def run_server(version: bool,
                      port: int,
                      base_path: str,
+                     metrics_port: int,
+                     metrics_host: str,
                      tls: list,
                      database_server_uri: str,
                      database_username: str,
@@ -26,15 +41,65 @@ async def run_server(version: bool,
                      clerk_secret_key: str,
                      jwks_url: str,
                      session_token_issuer: str,
+                     authentication_cache_max_entries: int,
+                     token_cache_max_ttl: int,
+                     user_cache_ttl: int,
                      max_process_workers: int,
+                     workers: int,
                      websocket_ping_timeout: int,
                      max_websocket_message_size: int,
-                     client_default_fetch_size: int
+                     websocket_fragment_size: int,
+                     client_default_fetch_size: int,
+                     default_result_format: str,
+                     adaptive_fetch_target_bytes: int,
+                     database_pool_min_size: int,
+                     database_pool_max_size: int,
+                     database_pool_idle_timeout: int,
+                     database_pool_health_check_interval: int,
+                     database_pool_checkout_timeout: int,
+                     max_session_concurrency: int,
+                     max_concurrent_queries: int,
+                     max_queries_per_user: int,
+                     max_query_queue_depth: int,
+                     result_cache_max_bytes: int,
+                     result_cache_ttl: int,
+                     prefetch_batches: int,
+                     prefetch_bytes: int,
+                     result_memory_budget: int,
+                     spill_directory: str,
+                     process_encoding_min_bytes: int,
+                     max_partition_readers: int,
+                     database_replica_uris: tuple[str, ...],
+                     backend_routing_policy: str,
+                     backend_health_check_interval: int,
+                     backend_ejection_threshold: int,
+                     backend_ejection_time: int,
+                     backend_max_retries: int,
+                     database_shard_uris: tuple[str, ...],
+                     default_distribute_mode: str,
+                     capture_file: str | None,
+                     capture_sql: str,
+                     authentication_bypass_user: str | None = None,
+                     worker_id: int | None = None,
+                     worker_metrics_directory: str | None = None
                      ):
+    # For the worker processes (with --workers) - which each run the server with these same arguments
+    server_arguments = {name: value for name, value in locals().items() if name not in ("worker_id", "worker_metrics_directory")}
+
     if version:
         print(f"Arrow Flight SQL Websocket Proxy Server - version: {arrow_flight_sql_websocket_proxy_server_version}")
         return
 
+    if workers < 1:
+        raise click.BadParameter(message=f"--workers must be at least 1 - not: {workers}")
+    if workers > 1 and worker_id is None:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise click.BadParameter(message="--workers greater than 1 needs SO_REUSEPORT - which this platform does not support")
+        await Supervisor(server_arguments=server_arguments,
+                         workers=workers
+                         ).run()
+        return
+
     tls_certfile = None
     tls_keyfile = None
     if tls:
@@ -43,6 +108,8 @@ async def run_server(version: bool,
 
     await Server(port=port,
                  base_path=base_path,
+                 metrics_port=metrics_port,
+                 metrics_host=metrics_host,
                  tls_certfile=tls_certfile,
                  tls_keyfile=tls_keyfile,
                  database_server_uri=database_server_uri,
@@ -53,10 +120,47 @@ async def run_server(version: bool,
                  clerk_secret_key=clerk_secret_key,
                  jwks_url=jwks_url,
                  session_token_issuer=session_token_issuer,
+                 authentication_cache_max_entries=authentication_cache_max_entries,
+                 token_cache_max_ttl=token_cache_max_ttl,
+                 user_cache_ttl=user_cache_ttl,
                  max_process_workers=max_process_workers,
                  websocket_ping_timeout=websocket_ping_timeout,
                  max_websocket_message_size=max_websocket_message_size,
-                 client_default_fetch_size=client_default_fetch_size
+                 websocket_fragment_size=websocket_fragment_size,
+                 client_default_fetch_size=client_default_fetch_size,
+                 default_result_format=default_result_format,
+                 adaptive_fetch_target_bytes=adaptive_fetch_target_bytes,
+                 database_pool_min_size=database_pool_min_size,
+                 database_pool_max_size=database_pool_max_size,
+                 database_pool_idle_timeout=database_pool_idle_timeout,
+                 database_pool_health_check_interval=database_pool_health_check_interval,
+                 database_pool_checkout_timeout=database_pool_checkout_timeout,
+                 max_session_concurrency=max_session_concurrency,
+                 max_concurrent_queries=max_concurrent_queries,
+                 max_queries_per_user=max_queries_per_user,
+                 max_query_queue_depth=max_query_queue_depth,
+                 result_cache_max_bytes=result_cache_max_bytes,
+                 result_cache_ttl=result_cache_ttl,
+                 prefetch_batches=prefetch_batches,
+                 prefetch_bytes=prefetch_bytes,
+                 result_memory_budget=result_memory_budget,
+                 spill_directory=spill_directory,
+                 process_encoding_min_bytes=process_encoding_min_bytes,
+                 max_partition_readers=max_partition_readers,
+                 database_replica_uris=list(database_replica_uris),
+                 backend_routing_policy=backend_routing_policy,
+                 backend_health_check_interval=backend_health_check_interval,
+                 backend_ejection_threshold=backend_ejection_threshold,
+                 backend_ejection_time=backend_ejection_time,
+                 backend_max_retries=backend_max_retries,
+                 database_shard_uris=list(database_shard_uris),
+                 default_distribute_mode=default_distribute_mode,
+                 capture_file=capture_file,
+                 capture_sql=capture_sql,
+                 authentication_bypass_user=authentication_bypass_user,
+                 workers=workers,
+                 worker_id=worker_id,
+                 worker_metrics_directory=worker_metrics_directory
                  ).run()
 
 
@@ -85,6 +189,22 @@ async def run_server(version: bool,
     required=True,
     help=f"Run the websocket server on this path.  Defaults to environment variable SERVER_PATH if set, or {SERVER_BASE_PATH} if not set."
 )
+@click.option(
+    "--metrics-port",
+    type=int,
+    default=os.getenv("METRICS_PORT", DEFAULT_METRICS_PORT),
+    show_default=True,
+    required=True,
+    help=f"Serve Prometheus-style metrics over plain HTTP on this port - at path: {METRICS_PATH}.  They are served on a port of their own (rather than the websocket port), and are not authenticated - so keep the port private.  0 serves no metrics.  Defaults to environment variable METRICS_PORT if set."
+)
+@click.option(
+    "--metrics-host",
+    type=str,
+    default=os.getenv("METRICS_HOST", DEFAULT_METRICS_HOST),
+    show_default=True,
+    required=True,
+    help="The address the metrics port listens on (with --metrics-port) - e.g. 0.0.0.0 for a scraper on another host.  Defaults to environment variable METRICS_HOST if set."
+)
 @click.option(
     "--tls",
     nargs=2,
@@ -157,13 +277,45 @@ async def run_server(version: bool,
     required=True,
     help="The issuer used for client session JWT token validation - for user authentication.  Defaults to environment variable SESSION_TOKEN_ISSUER if set.  Example: https://wise-cattle-777.clerk.accounts.dev"
 )
+@click.option(
+    "--authentication-cache-max-entries",
+    type=int,
+    default=os.getenv("AUTHENTICATION_CACHE_MAX_ENTRIES", DEFAULT_AUTHENTICATION_CACHE_MAX_ENTRIES),
+    show_default=True,
+    required=True,
+    help="The most verified session tokens (and, separately, users) to cache - so that reconnects skip token verification and the Clerk API user lookup.  0 disables both caches.  Defaults to environment variable AUTHENTICATION_CACHE_MAX_ENTRIES if set."
+)
+@click.option(
+    "--token-cache-max-ttl",
+    type=int,
+    default=os.getenv("TOKEN_CACHE_MAX_TTL", DEFAULT_TOKEN_CACHE_MAX_TTL),
+    show_default=True,
+    required=True,
+    help="The most seconds a verified session token is cached for - it is never cached past its own expiry (exp).  A session revoked in Clerk is still accepted - from the cache - for up to this long.  0 disables the token cache.  Defaults to environment variable TOKEN_CACHE_MAX_TTL if set."
+)
+@click.option(
+    "--user-cache-ttl",
+    type=int,
+    default=os.getenv("USER_CACHE_TTL", DEFAULT_USER_CACHE_TTL),
+    show_default=True,
+    required=True,
+    help="The seconds a user's email address (looked up via the Clerk API) is cached for.  0 disables the user cache.  Defaults to environment variable USER_CACHE_TTL if set."
+)
 @click.option(
     "--max-process-workers",
     type=int,
     default=os.getenv("MAX_PROCESS_WORKERS", get_cpu_count()),
     show_default=True,
     required=True,
-    help="Max process workers.  Defaults to environment variable MAX_PROCESS_WORKERS if set."
+    help="Max process workers - shared by the --workers processes.  Defaults to environment variable MAX_PROCESS_WORKERS if set."
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=os.getenv("WORKERS", DEFAULT_SERVER_WORKERS),
+    show_default=True,
+    required=True,
+    help="The number of server processes to run - each with its own event loop and database connections, sharing the port (with SO_REUSEPORT).  With more than 1, a supervisor process restarts workers which exit, and the metrics path serves all of their metrics combined.  Pool sizes, concurrency limits and the result cache apply to each worker.  Defaults to environment variable WORKERS if set."
 )
 @click.option(
     "--websocket-ping-timeout",
@@ -179,7 +331,15 @@ async def run_server(version: bool,
     default=DEFAULT_MAX_WEBSOCKET_MESSAGE_SIZE,
     show_default=True,
     required=True,
-    help="Maximum Websocket message size"
+    help="Maximum Websocket message size (for messages received from clients)"
+)
+@click.option(
+    "--websocket-fragment-size",
+    type=int,
+    default=os.getenv("WEBSOCKET_FRAGMENT_SIZE", DEFAULT_WEBSOCKET_FRAGMENT_SIZE),
+    show_default=True,
+    required=True,
+    help="The maximum Websocket frame size for binary fetch results - larger results are sent as fragmented messages.  Defaults to environment variable WEBSOCKET_FRAGMENT_SIZE if set."
 )
 @click.option(
     "--client-default-fetch-size",
@@ -189,10 +349,249 @@ async def run_server(version: bool,
     required=True,
     help="The default websocket client fetch size for queries."
 )
+@click.option(
+    "--default-result-format",
+    type=click.Choice(["base64", "binary"]),
+    default=os.getenv("DEFAULT_RESULT_FORMAT", DEFAULT_RESULT_FORMAT),
+    show_default=True,
+    required=True,
+    help=("The default format for fetch results - for clients which do not request one when authenticating.  "
+          "'base64' sends Arrow IPC as a base64 string inside the JSON fetchResult message (legacy), "
+          "'binary' sends a JSON fetchResult header followed by raw Arrow IPC binary frame(s).  "
+          f"Defaults to environment variable DEFAULT_RESULT_FORMAT if set, or {DEFAULT_RESULT_FORMAT} if not set.")
+)
+@click.option(
+    "--adaptive-fetch-target-bytes",
+    type=int,
+    default=os.getenv("ADAPTIVE_FETCH_TARGET_BYTES", DEFAULT_ADAPTIVE_FETCH_TARGET_BYTES),
+    show_default=True,
+    required=True,
+    help="The target response frame size (in bytes) for clients fetching with fetch_sizing 'adaptive'.  The server shrinks it when a client's observed send throughput cannot keep up.  Defaults to environment variable ADAPTIVE_FETCH_TARGET_BYTES if set."
+)
+@click.option(
+    "--database-pool-min-size",
+    type=int,
+    default=os.getenv("DATABASE_POOL_MIN_SIZE", DEFAULT_DATABASE_POOL_MIN_SIZE),
+    show_default=True,
+    required=True,
+    help="The number of (autocommit) database connections to pre-warm at startup, and to keep open when idle.  Defaults to environment variable DATABASE_POOL_MIN_SIZE if set."
+)
+@click.option(
+    "--database-pool-max-size",
+    type=int,
+    default=os.getenv("DATABASE_POOL_MAX_SIZE", DEFAULT_DATABASE_POOL_MAX_SIZE),
+    show_default=True,
+    required=True,
+    help="The maximum number of database connections (backend sessions) shared by all clients.  Defaults to environment variable DATABASE_POOL_MAX_SIZE if set."
+)
+@click.option(
+    "--database-pool-idle-timeout",
+    type=int,
+    default=os.getenv("DATABASE_POOL_IDLE_TIMEOUT", DEFAULT_DATABASE_POOL_IDLE_TIMEOUT),
+    show_default=True,
+    required=True,
+    help="Close pooled database connections which have been idle for this many seconds (down to --database-pool-min-size).  Defaults to environment variable DATABASE_POOL_IDLE_TIMEOUT if set."
+)
+@click.option(
+    "--database-pool-health-check-interval",
+    type=int,
+    default=os.getenv("DATABASE_POOL_HEALTH_CHECK_INTERVAL", DEFAULT_DATABASE_POOL_HEALTH_CHECK_INTERVAL),
+    show_default=True,
+    required=True,
+    help="Health check idle pooled database connections every this many seconds.  Defaults to environment variable DATABASE_POOL_HEALTH_CHECK_INTERVAL if set."
+)
+@click.option(
+    "--database-pool-checkout-timeout",
+    type=int,
+    default=os.getenv("DATABASE_POOL_CHECKOUT_TIMEOUT", DEFAULT_DATABASE_POOL_CHECKOUT_TIMEOUT),
+    show_default=True,
+    required=True,
+    help="How many seconds a query waits for a database connection when the pool is at its max size.  Defaults to environment variable DATABASE_POOL_CHECKOUT_TIMEOUT if set."
+)
+@click.option(
+    "--max-session-concurrency",
+    type=int,
+    default=os.getenv("MAX_SESSION_CONCURRENCY", DEFAULT_MAX_SESSION_CONCURRENCY),
+    show_default=True,
+    required=True,
+    help="The maximum number of requests (query, fetch, closeCursor, etc.) a single websocket session may have in flight at once - requests on different query IDs run concurrently, and their responses may arrive out of order.  Defaults to environment variable MAX_SESSION_CONCURRENCY if set."
+)
+@click.option(
+    "--max-concurrent-queries",
+    type=int,
+    default=os.getenv("MAX_CONCURRENT_QUERIES", DEFAULT_MAX_CONCURRENT_QUERIES),
+    show_default=True,
+    required=True,
+    help="The maximum number of queries executing against the database server at once (across all clients) - further queries wait in a fair-share queue.  Defaults to environment variable MAX_CONCURRENT_QUERIES if set."
+)
+@click.option(
+    "--max-queries-per-user",
+    type=int,
+    default=os.getenv("MAX_QUERIES_PER_USER", DEFAULT_MAX_QUERIES_PER_USER),
+    show_default=True,
+    required=True,
+    help="The maximum number of queries any one user may have executing at once.  Defaults to environment variable MAX_QUERIES_PER_USER if set."
+)
+@click.option(
+    "--max-query-queue-depth",
+    type=int,
+    default=os.getenv("MAX_QUERY_QUEUE_DEPTH", DEFAULT_MAX_QUERY_QUEUE_DEPTH),
+    show_default=True,
+    required=True,
+    help="Reject new queries right away once this many are waiting in the queue.  Defaults to environment variable MAX_QUERY_QUEUE_DEPTH if set."
+)
+@click.option(
+    "--result-cache-max-bytes",
+    type=int,
+    default=os.getenv("RESULT_CACHE_MAX_BYTES", DEFAULT_RESULT_CACHE_MAX_BYTES),
+    show_default=True,
+    required=True,
+    help="The memory budget (in bytes) for the server-side result cache - least-recently-used results are evicted to stay under it.  Repeated read-only queries (same normalized SQL, parameters and user) from autocommit sessions are served from the cache.  0 disables the cache.  Defaults to environment variable RESULT_CACHE_MAX_BYTES if set."
+)
+@click.option(
+    "--result-cache-ttl",
+    type=int,
+    default=os.getenv("RESULT_CACHE_TTL", DEFAULT_RESULT_CACHE_TTL),
+    show_default=True,
+    required=True,
+    help="How many seconds a cached result may be served for.  Defaults to environment variable RESULT_CACHE_TTL if set."
+)
+@click.option(
+    "--prefetch-batches",
+    type=int,
+    default=os.getenv("PREFETCH_BATCHES", DEFAULT_PREFETCH_BATCHES),
+    show_default=True,
+    required=True,
+    help="How many record batches to read ahead (in the background) for each open cursor - so that fetches are served from memory while the backend keeps streaming.  0 disables read-ahead.  Defaults to environment variable PREFETCH_BATCHES if set."
+)
+@click.option(
+    "--prefetch-bytes",
+    type=int,
+    default=os.getenv("PREFETCH_BYTES", DEFAULT_PREFETCH_BYTES),
+    show_default=True,
+    required=True,
+    help="The most (in-memory Arrow) bytes to read ahead for each open cursor - read-ahead stops at whichever of --prefetch-batches / --prefetch-bytes is reached first.  Defaults to environment variable PREFETCH_BYTES if set."
+)
+@click.option(
+    "--result-memory-budget",
+    type=int,
+    default=os.getenv("RESULT_MEMORY_BUDGET", DEFAULT_RESULT_MEMORY_BUDGET),
+    show_default=True,
+    required=True,
+    help="The most bytes of query results all cursors may hold in memory at once - a fetch which would go over it spills to a temporary Arrow IPC file (served back through a memory map).  Fetches hold their share until they are sent - and base64 encoded results (which cannot spill) count against it too, so a base64 fetch the budget cannot cover fails (with retryable: true - its rows are kept for the next fetch) - binary results, or smaller fetches, can be sent.  0 means half of the memory limit of the server (or its container).  Defaults to environment variable RESULT_MEMORY_BUDGET if set."
+)
+@click.option(
+    "--spill-directory",
+    type=str,
+    default=os.getenv("SPILL_DIRECTORY", tempfile.gettempdir()),
+    show_default=True,
+    required=True,
+    help="The directory for temporary result spill files.  Defaults to environment variable SPILL_DIRECTORY if set, or the system temporary directory if not set."
+)
+@click.option(
+    "--process-encoding-min-bytes",
+    type=int,
+    default=os.getenv("PROCESS_ENCODING_MIN_BYTES", DEFAULT_PROCESS_ENCODING_MIN_BYTES),
+    show_default=True,
+    required=True,
+    help="The fewest (in-memory Arrow) bytes a base64 fetch result must have to be encoded in a worker process (of --max-process-workers - passed through shared memory) rather than on a thread - so that the encoding does not hold the GIL the event loop needs.  0 measures the threshold shortly after startup (results are encoded on threads until it is measured).  -1 never uses worker processes.  Defaults to environment variable PROCESS_ENCODING_MIN_BYTES if set."
+)
+@click.option(
+    "--max-partition-readers",
+    type=int,
+    default=os.getenv("MAX_PARTITION_READERS", DEFAULT_MAX_PARTITION_READERS),
+    show_default=True,
+    required=True,
+    help="The most result partitions (Flight endpoints) a query run with partitioned: true reads at once - each on a database connection of its own (from the pool - if it can spare one).  0 reads every result through a single stream.  Defaults to environment variable MAX_PARTITION_READERS if set."
+)
+@click.option(
+    "--database-replica-uris",
+    type=str,
+    multiple=True,
+    default=os.getenv("DATABASE_REPLICA_URIS").split(",") if os.getenv("DATABASE_REPLICA_URIS") else [],
+    show_default=False,
+    required=False,
+    help="The URI of an Arrow Flight SQL server which is equivalent to the --database-server-uri server (e.g. a read replica) - repeat the option for each one.  Queries (and transactions) are routed across all of them by --backend-routing-policy.  Replicas are connected to with the --database-username, --database-password and --database-tls-skip-verify settings.  Defaults to environment variable DATABASE_REPLICA_URIS (comma-separated) if set."
+)
+@click.option(
+    "--backend-routing-policy",
+    type=click.Choice([routing_policy.value for routing_policy in RoutingPolicy]),
+    default=os.getenv("BACKEND_ROUTING_POLICY", DEFAULT_BACKEND_ROUTING_POLICY),
+    show_default=True,
+    required=True,
+    help="How queries are routed across the database server and its replicas.  'least_outstanding' picks the backend with the fewest open queries, 'latency_weighted' favors backends with lower recent query latency, 'user_hash' sends each user to the same backend (by consistent hashing) - for cache locality.  Defaults to environment variable BACKEND_ROUTING_POLICY if set."
+)
+@click.option(
+    "--backend-health-check-interval",
+    type=int,
+    default=os.getenv("BACKEND_HEALTH_CHECK_INTERVAL", DEFAULT_BACKEND_HEALTH_CHECK_INTERVAL),
+    show_default=True,
+    required=True,
+    help="How often (in seconds) each backend is health checked - when there are database replicas.  Defaults to environment variable BACKEND_HEALTH_CHECK_INTERVAL if set."
+)
+@click.option(
+    "--backend-ejection-threshold",
+    type=int,
+    default=os.getenv("BACKEND_EJECTION_THRESHOLD", DEFAULT_BACKEND_EJECTION_THRESHOLD),
+    show_default=True,
+    required=True,
+    help="The number of consecutive failures (to connect or to run a query - or health checks) after which a backend is taken out of rotation.  Defaults to environment variable BACKEND_EJECTION_THRESHOLD if set."
+)
+@click.option(
+    "--backend-ejection-time",
+    type=int,
+    default=os.getenv("BACKEND_EJECTION_TIME", DEFAULT_BACKEND_EJECTION_TIME),
+    show_default=True,
+    required=True,
+    help="How long (in seconds) an ejected backend stays out of rotation before it is health checked again.  Defaults to environment variable BACKEND_EJECTION_TIME if set."
+)
+@click.option(
+    "--backend-max-retries",
+    type=int,
+    default=os.getenv("BACKEND_MAX_RETRIES", DEFAULT_BACKEND_MAX_RETRIES),
+    show_default=True,
+    required=True,
+    help="How many other backends a read-only query in an autocommit session is retried on - if its backend could not be reached.  Defaults to environment variable BACKEND_MAX_RETRIES if set."
+)
+@click.option(
+    "--database-shard-uris",
+    type=str,
+    multiple=True,
+    default=os.getenv("DATABASE_SHARD_URIS").split(",") if os.getenv("DATABASE_SHARD_URIS") else [],
+    show_default=False,
+    required=False,
+    help="The URI of an Arrow Flight SQL server which holds a shard of the data - repeat the option for each shard.  A query run with distribute: 'true' (or 'force') runs on every shard in parallel, and the proxy merges the shards' results.  Shards are connected to with the --database-username, --database-password and --database-tls-skip-verify settings.  Needs the 'distributed' extra.  Defaults to environment variable DATABASE_SHARD_URIS (comma-separated) if set."
+)
+@click.option(
+    "--default-distribute-mode",
+    type=click.Choice([distribute_mode.value for distribute_mode in DistributeMode]),
+    default=os.getenv("DEFAULT_DISTRIBUTE_MODE", DEFAULT_DISTRIBUTE_MODE),
+    show_default=True,
+    required=True,
+    help="How queries which do not say (with distribute) are run - 'false' runs them on the --database-server-uri server, 'true' runs them on the --database-shard-uris shards if their results merge exactly (and fails them if not), 'force' runs them on the shards regardless.  Defaults to environment variable DEFAULT_DISTRIBUTE_MODE if set."
+)
+@click.option(
+    "--capture-file",
+    type=str,
+    default=os.getenv("CAPTURE_FILE"),
+    show_default=False,
+    required=False,
+    help="Record each session's requests (authenticate, query, fetch, closeCursor, etc. - with their relative timestamps and fetch sizes) and the size of each result - but no result data, or tokens - to this (JSON lines) file, for replaying the workload with: flight-sql-websocket-proxy-client replay.  The file is overwritten.  Defaults to environment variable CAPTURE_FILE if set."
+)
+@click.option(
+    "--capture-sql",
+    type=click.Choice([capture_sql.value for capture_sql in CaptureSql]),
+    default=os.getenv("CAPTURE_SQL", DEFAULT_CAPTURE_SQL),
+    show_default=True,
+    required=True,
+    help="How much of each query's SQL to capture (with --capture-file).  'full' captures the SQL and its parameters, 'redacted' captures the SQL with its literals replaced (strings with '?', numbers with 0) and only the number of parameters, 'none' captures neither.  A fingerprint of the redacted SQL is always captured.  Defaults to environment variable CAPTURE_SQL if set."
+)
 @coro
 async def click_run_server(version: bool,
                            port: int,
                            base_path: str,
+                           metrics_port: int,
+                           metrics_host: str,
                            tls: list,
                            database_server_uri: str,
                            database_username: str,
@@ -202,10 +601,44 @@ async def click_run_server(version: bool,
                            clerk_secret_key: str,
                            jwks_url: str,
                            session_token_issuer: str,
+                           authentication_cache_max_entries: int,
+                           token_cache_max_ttl: int,
+                           user_cache_ttl: int,
                            max_process_workers: int,
+                           workers: int,
                            websocket_ping_timeout: int,
                            max_websocket_message_size: int,
-                           client_default_fetch_size: int
+                           websocket_fragment_size: int,
+                           client_default_fetch_size: int,
+                           default_result_format: str,
+                           adaptive_fetch_target_bytes: int,
+                           database_pool_min_size: int,
+                           database_pool_max_size: int,
+                           database_pool_idle_timeout: int,
+                           database_pool_health_check_interval: int,
+                           database_pool_checkout_timeout: int,
+                           max_session_concurrency: int,
+                           max_concurrent_queries: int,
+                           max_queries_per_user: int,
+                           max_query_queue_depth: int,
+                           result_cache_max_bytes: int,
+                           result_cache_ttl: int,
+                           prefetch_batches: int,
+                           prefetch_bytes: int,
+                           result_memory_budget: int,
+                           spill_directory: str,
+                           process_encoding_min_bytes: int,
+                           max_partition_readers: int,
+                           database_replica_uris: tuple[str, ...],
+                           backend_routing_policy: str,
+                           backend_health_check_interval: int,
+                           backend_ejection_threshold: int,
+                           backend_ejection_time: int,
+                           backend_max_retries: int,
+                           database_shard_uris: tuple[str, ...],
+                           default_distribute_mode: str,
+                           capture_file: str | None,
+                           capture_sql: str
                            ):
     await run_server(**locals())
 
@@ -0,0 +1,304 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hashlib
+import random
+import time
+from typing import TYPE_CHECKING
+
+from adbc_driver_manager import AdbcStatusCode, Error as AdbcError
+
+from .common import RoutingPolicy
+from .connection_pool import PooledConnection
+from ..config import logger
+from ..constants import BACKEND_LATENCY_EWMA_WEIGHT, BACKEND_HASH_RING_REPLICAS, BACKEND_HEALTH_CHECK_TIMEOUT
+
+if TYPE_CHECKING:
+    from .server_class import Server
+
+# ADBC statuses which mean we could not reach the backend (rather than that it rejected the statement)
+BACKEND_FAILURE_STATUS_CODES = {AdbcStatusCode.IO, AdbcStatusCode.TIMEOUT}
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    return isinstance(error, AdbcError) and error.status_code in BACKEND_FAILURE_STATUS_CODES
+
+
+def get_hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+class Backend:
+    def __init__(self,
+                 uri: str
+                 ):
+        self.uri = uri
+        # Queries holding a cursor on the backend - from checkout until their cursor is released
+        self.outstanding = 0
+        # An exponentially weighted moving average of its query execute times (in seconds)
+        self.latency: float | None = None
+        self.consecutive_failures = 0
+        # While set (a time.monotonic() deadline) - the backend is out of rotation
+        self.ejected_until: float | None = None
+        self.queries = 0
+        self.failures = 0
+        self.ejections = 0
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until is not None
+
+    def stats(self) -> dict:
+        return dict(uri=self.uri,
+                    ejected=self.ejected,
+                    outstanding=self.outstanding,
+                    latency=round(self.latency, 4) if self.latency is not None else None,
+                    queries=self.queries,
+                    failures=self.failures,
+                    ejections=self.ejections
+                    )
+
+
+class BackendRouter:
+    """
+    Routes each query (and each transaction's pinned connection) to one of a set of equivalent backends - by
+    policy:
+      - least_outstanding: the backend with the fewest queries holding a cursor on it.
+      - latency_weighted: a random backend - weighted by the inverse of its recent execute latency (and its
+        outstanding queries).
+      - user_hash: the user's backend on a consistent hash ring - so that each user's repeated queries hit the same
+        backend's caches, and an ejected backend only moves its own users.
+
+    A backend which fails ejection_threshold times in a row (to connect, or to execute - see is_backend_failure)
+    is ejected for ejection_seconds, after which the health check puts it back in rotation as soon as it answers.
+    Backends in rotation are health checked every health_check_interval seconds too - so that an idle backend's
+    failure is found before a query is routed to it.  If every backend is ejected, queries are routed across all
+    of them anyway.  A backend which cannot be connected to is failed over from - to up to max_retries others.
+    """
+    def __init__(self,
+                 server: "Server",
+                 backend_uris: list[str],
+                 policy: RoutingPolicy,
+                 health_check_interval: int,
+                 ejection_threshold: int,
+                 ejection_seconds: int,
+                 max_retries: int
+                 ):
+        self.server = server
+        self.backends = {backend_uri: Backend(uri=backend_uri) for backend_uri in backend_uris}
+        self.policy = RoutingPolicy(policy)
+        self.health_check_interval = health_check_interval
+        self.ejection_threshold = ejection_threshold
+        self.ejection_seconds = ejection_seconds
+        self.max_retries = max_retries
+
+        self.hash_ring = sorted((get_hash(f"{backend_uri}#{replica}"), backend_uri)
+                                for backend_uri in backend_uris
+                                for replica in range(BACKEND_HASH_RING_REPLICAS)
+                                )
+        self.hash_ring_keys = [ring_hash for ring_hash, _ in self.hash_ring]
+        self.retries = 0
+        self.health_check_task: asyncio.Task | None = None
+
+    def get_backend(self,
+                    backend_uri: str
+                    ) -> Backend | None:
+        return self.backends.get(backend_uri)
+
+    def choose(self,
+               user: str | None = None,
+               exclude: set[str] = None
+               ) -> Backend | None:
+        """
+        :param exclude: URIs of backends not to route to (e.g. those a query already failed on).
+        :return: The backend to route to - or None if every backend is excluded.
+        """
+        candidates = [backend for backend in self.backends.values() if backend.uri not in (exclude or set())]
+        if not candidates:
+            return None
+        candidates = [backend for backend in candidates if not backend.ejected] or candidates
+
+        if self.policy == RoutingPolicy.USER_HASH and user is not None:
+            candidate_uris = {backend.uri for backend in candidates}
+            position = bisect.bisect(self.hash_ring_keys, get_hash(user))
+            # Walk the ring clockwise to the first eligible backend
+            for offset in range(len(self.hash_ring)):
+                backend_uri = self.hash_ring[(position + offset) % len(self.hash_ring)][1]
+                if backend_uri in candidate_uris:
+                    return self.backends[backend_uri]
+
+        if self.policy == RoutingPolicy.LATENCY_WEIGHTED:
+            # Backends we have no latency for yet get the best latency we know of - so that they are tried
+            known_latencies = [backend.latency for backend in candidates if backend.latency is not None]
+            best_latency = min(known_latencies) if known_latencies else 1.0
+            weights = [1.0 / (max(backend.latency or best_latency, 1e-4) * (backend.outstanding + 1)) for backend in candidates]
+            return random.choices(candidates, weights=weights)[0]
+
+        # Ties go to a random backend - so that idle backends share the load
+        fewest_outstanding = min(backend.outstanding for backend in candidates)
+        return random.choice([backend for backend in candidates if backend.outstanding == fewest_outstanding])
+
+    async def checkout(self,
+                       autocommit: bool,
+                       user: str | None = None,
+                       exclude: set[str] = None
+                       ) -> PooledConnection:
+        """
+        Checks out a pooled connection to the backend the policy picks for the user.
+
+        :param exclude: URIs of backends not to route to (e.g. those a query already failed on).
+        """
+        failed_backend_uris = set()
+        while True:
+            backend = self.choose(user=user,
+                                  exclude=(exclude or set()) | failed_backend_uris
+                                  )
+            if backend is None:
+                raise RuntimeError("No database backend is left to route to")
+            try:
+                return await self.server.connection_pool.checkout(autocommit=autocommit,
+                                                                  database_server_uri=backend.uri
+                                                                  )
+            except Exception as e:
+                if not is_backend_failure(e):
+                    raise
+                self.record_failure(backend_uri=backend.uri, error=e)
+                failed_backend_uris.add(backend.uri)
+                if len(failed_backend_uris) > self.max_retries or not self.choose(exclude=(exclude or set()) | failed_backend_uris):
+                    raise
+                self.retries += 1
+                logger.warning(msg=f"Failed to connect to database backend: {backend.uri} - trying another backend - error: {str(e)}")
+
+    def begin(self,
+              backend_uri: str
+              ):
+        backend = self.get_backend(backend_uri)
+        if backend:
+            backend.outstanding += 1
+            backend.queries += 1
+
+    def end(self,
+            backend_uri: str
+            ):
+        backend = self.get_backend(backend_uri)
+        if backend:
+            backend.outstanding = max(backend.outstanding - 1, 0)
+
+    def record_success(self,
+                       backend_uri: str,
+                       execute_seconds: float | None = None
+                       ):
+        backend = self.get_backend(backend_uri)
+        if not backend:
+            return
+
+        backend.consecutive_failures = 0
+        if execute_seconds is not None:
+            backend.latency = execute_seconds if backend.latency is None else \
+                (1 - BACKEND_LATENCY_EWMA_WEIGHT) * backend.latency + BACKEND_LATENCY_EWMA_WEIGHT * execute_seconds
+        if backend.ejected:
+            backend.ejected_until = None
+            logger.warning(msg=f"Database backend: {backend.uri} is healthy again - it is back in rotation")
+
+    def record_failure(self,
+                       backend_uri: str,
+                       error: BaseException
+                       ):
+        backend = self.get_backend(backend_uri)
+        if not backend:
+            return
+
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        if backend.ejected:
+            # A failed probe of an ejected backend - keep it out for another ejection period
+            backend.ejected_until = time.monotonic() + self.ejection_seconds
+        elif backend.consecutive_failures >= self.ejection_threshold:
+            backend.ejected_until = time.monotonic() + self.ejection_seconds
+            backend.ejections += 1
+            logger.error(msg=f"Database backend: {backend.uri} failed {backend.consecutive_failures} time(s) in a row - ejecting it for {self.ejection_seconds} second(s) - error: {str(error)}")
+
+    async def discard_after(self,
+                            health_check: asyncio.Future,
+                            pooled_connection: PooledConnection
+                            ):
+        # The connection is only closed once the probe's thread is done with it
+        await asyncio.wait([health_check])
+        await self.server.connection_pool.checkin(pooled_connection, discard=True)
+
+    async def check_backend(self,
+                            backend: Backend
+                            ):
+        """
+        Probes a backend with a connection from the pool.  Only what says the backend itself is failing (it cannot
+        be connected to - or the probe fails with an IO / timeout status) counts against it - a probe which could
+        not run (e.g. the pool or its threads are busy with queries) does not.
+        """
+        connection_pool = self.server.connection_pool
+        try:
+            # The pool's max size is shared by all backends - when it is saturated, we skip the probe rather than
+            # wait for a slot
+            pooled_connection = await asyncio.wait_for(connection_pool.checkout(autocommit=True,
+                                                                                database_server_uri=backend.uri,
+                                                                                wait=False
+                                                                                ),
+                                                       timeout=BACKEND_HEALTH_CHECK_TIMEOUT
+                                                       )
+        except TimeoutError:
+            # The cancelled checkout gives back its pool slot (and closes the connection, if the connect completes later)
+            logger.warning(msg=f"Timed out connecting to database backend: {backend.uri} for its health check - skipping it")
+            return
+        except Exception as e:
+            self.record_failure(backend_uri=backend.uri, error=e)
+            return
+
+        if pooled_connection is None:
+            logger.info(msg=f"Skipped the health check of database backend: {backend.uri} - the connection pool is at its max size")
+            return
+
+        health_check = asyncio.ensure_future(connection_pool._run_in_executor(connection_pool._check_health, pooled_connection))
+        try:
+            # Shielded - a probe which times out keeps running on its thread (with the connection)
+            await asyncio.wait_for(asyncio.shield(health_check), timeout=BACKEND_HEALTH_CHECK_TIMEOUT)
+        except asyncio.CancelledError:
+            asyncio.create_task(self.discard_after(health_check=health_check, pooled_connection=pooled_connection))
+            raise
+        except Exception as e:
+            if is_backend_failure(e):
+                self.record_failure(backend_uri=backend.uri, error=e)
+            else:
+                logger.warning(msg=f"The health check of database backend: {backend.uri} did not complete - error: {str(e) or type(e).__name__}")
+            if health_check.done():
+                await connection_pool.checkin(pooled_connection, discard=True)
+            else:
+                # Timed out - it is not safe to close the connection out from under the probe, nor worth holding up
+                # the other backends' health checks until it is done
+                asyncio.create_task(self.discard_after(health_check=health_check, pooled_connection=pooled_connection))
+        else:
+            self.record_success(backend_uri=backend.uri)
+            await connection_pool.checkin(pooled_connection)
+
+    async def check_health(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            now = time.monotonic()
+            # An ejected backend is only probed once its ejection period is over
+            backends = [backend for backend in self.backends.values()
+                        if not backend.ejected or backend.ejected_until <= now]
+            await asyncio.gather(*[self.check_backend(backend) for backend in backends])
+
+    async def start(self):
+        if len(self.backends) > 1:
+            self.health_check_task = asyncio.create_task(self.check_health())
+
+    async def close(self):
+        if self.health_check_task:
+            self.health_check_task.cancel()
+            self.health_check_task = None
+
+    def stats(self) -> dict:
+        return dict(policy=self.policy,
+                    backends=[backend.stats() for backend in self.backends.values()],
+                    retries=self.retries
+                    )
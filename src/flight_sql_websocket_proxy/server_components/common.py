@@ -10,3 +10,36 @@ class DistributeMode(StrEnum):
     TRUE = auto()
     FALSE = auto()
     FORCE = auto()
+
+
+class ResultFormat(StrEnum):
+    BASE64 = auto()
+    BINARY = auto()
+
+
+class FetchSizing(StrEnum):
+    FIXED = auto()
+    ADAPTIVE = auto()
+
+
+class PartitionOrder(StrEnum):
+    ORDERED = auto()
+    UNORDERED = auto()
+
+
+class QueryPriority(StrEnum):
+    LOW = auto()
+    NORMAL = auto()
+    HIGH = auto()
+
+
+class RoutingPolicy(StrEnum):
+    LEAST_OUTSTANDING = auto()
+    LATENCY_WEIGHTED = auto()
+    USER_HASH = auto()
+
+
+class CaptureSql(StrEnum):
+    FULL = auto()
+    REDACTED = auto()
+    NONE = auto()
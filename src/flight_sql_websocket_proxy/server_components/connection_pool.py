@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, NamedTuple
+
+from adbc_driver_flightsql import dbapi, DatabaseOptions
+
+from ..config import logger
+
+if TYPE_CHECKING:
+    from .server_class import Server
+
+
+class ConnectionKey(NamedTuple):
+    database_server_uri: str
+    database_username: str
+    autocommit: bool
+
+
+class PooledConnection:
+    def __init__(self,
+                 key: ConnectionKey,
+                 connection: dbapi.Connection
+                 ):
+        self.key = key
+        self.connection = connection
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.last_checked_at = self.created_at
+
+    def cursor(self) -> dbapi.Cursor:
+        return self.connection.cursor()
+
+
+class ConnectionPool:
+    """
+    A server-level pool of ADBC Flight SQL connections - shared by all WebSocket clients.
+
+    Connections are keyed by (database server URI, credentials, autocommit) - and checked out around query
+    execution, rather than being held for the life of a WebSocket session.  The pool is pre-warmed at startup
+    with min_size autocommit connections to each backend (the database server and its replicas), connections
+    idle for longer than idle_timeout are evicted (down to min_size), and idle connections are health checked
+    every health_check_interval seconds.
+    """
+    def __init__(self,
+                 server: "Server",
+                 min_size: int,
+                 max_size: int,
+                 idle_timeout: int,
+                 health_check_interval: int,
+                 checkout_timeout: int
+                 ):
+        self.server = server
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+
+        self.idle_connections: dict[ConnectionKey, list[PooledConnection]] = defaultdict(list)
+        self.size = 0
+        self.checked_out = 0
+        self.connect_failures = 0
+        self.condition = asyncio.Condition()
+        self.maintenance_task: asyncio.Task | None = None
+        self.closed = False
+
+    def get_key(self,
+                autocommit: bool,
+                database_server_uri: str = None
+                ) -> ConnectionKey:
+        return ConnectionKey(database_server_uri=database_server_uri or self.server.database_server_uri,
+                             database_username=self.server.database_username,
+                             autocommit=autocommit
+                             )
+
+    @property
+    def idle_count(self) -> int:
+        return sum(len(idle_connections) for idle_connections in self.idle_connections.values())
+
+    def _connect(self,
+                 key: ConnectionKey
+                 ) -> dbapi.Connection:
+        return dbapi.connect(uri=key.database_server_uri,
+                             db_kwargs={"username": key.database_username,
+                                        "password": self.server.database_password,
+                                        DatabaseOptions.TLS_SKIP_VERIFY.value: str(
+                                            self.server.database_tls_skip_verify).lower()
+                                        },
+                             autocommit=key.autocommit
+                             )
+
+    @classmethod
+    def _check_health(cls,
+                      pooled_connection: PooledConnection
+                      ):
+        # A cheap round-trip to the backend
+        pooled_connection.connection.adbc_get_table_types()
+
+    @classmethod
+    def _reset(cls,
+               pooled_connection: PooledConnection
+               ):
+        # Don't hand an open transaction to the next session
+        if not pooled_connection.key.autocommit:
+            pooled_connection.connection.rollback()
+
+    async def _run_in_executor(self, func, *args):
+        return await self.server.event_loop.run_in_executor(self.server.thread_pool, func, *args)
+
+    async def _close_connection(self,
+                                pooled_connection: PooledConnection
+                                ):
+        try:
+            await self._run_in_executor(pooled_connection.connection.close)
+        except Exception as e:
+            logger.warning(msg=f"Failed to close pooled database connection to: {pooled_connection.key.database_server_uri} - error: {str(e)}")
+
+    async def _discard(self,
+                       pooled_connection: PooledConnection
+                       ):
+        async with self.condition:
+            self.size -= 1
+            self.condition.notify()
+        await self._close_connection(pooled_connection)
+
+    def _notify_waiters(self):
+        # Without waiting for the lock here - so that a cancelled task can still call it
+        async def notify():
+            async with self.condition:
+                self.condition.notify()
+
+        asyncio.create_task(notify())
+
+    def _close_late_connection(self,
+                               key: ConnectionKey,
+                               connect_future: Future
+                               ):
+        # A connect which completed after its checkout was cancelled - nobody is waiting for the connection
+        if not connect_future.cancelled() and connect_future.exception() is None:
+            asyncio.create_task(self._close_connection(PooledConnection(key=key,
+                                                                        connection=connect_future.result()
+                                                                        )))
+
+    async def checkout(self,
+                       autocommit: bool,
+                       database_server_uri: str = None,
+                       wait: bool = True
+                       ) -> PooledConnection | None:
+        """
+        :param wait: Whether to wait for a connection if the pool is at its max size - if not, None is returned.
+        """
+        key = self.get_key(autocommit=autocommit,
+                           database_server_uri=database_server_uri
+                           )
+        # The timeout is for the whole checkout - not each wait (a waiter which is woken, but loses the race for the
+        # connection, waits again)
+        deadline = time.monotonic() + self.checkout_timeout
+        async with self.condition:
+            while True:
+                idle_connections = self.idle_connections[key]
+                if idle_connections:
+                    # LIFO - keeps the most recently used connections warm, and lets the rest idle out
+                    pooled_connection = idle_connections.pop()
+                    self.checked_out += 1
+                    return pooled_connection
+
+                if self.size < self.max_size:
+                    # Reserve the slot - we connect outside the lock
+                    self.size += 1
+                    break
+
+                if self.idle_count:
+                    # Make room by closing an idle connection with another key
+                    for other_key, other_idle_connections in self.idle_connections.items():
+                        if other_idle_connections:
+                            asyncio.create_task(self._close_connection(other_idle_connections.pop(0)))
+                            self.size -= 1
+                            break
+                    continue
+
+                if not wait:
+                    return None
+
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=max(deadline - time.monotonic(), 0))
+                except TimeoutError:
+                    raise TimeoutError(f"Timed out after {self.checkout_timeout} second(s) waiting for a database connection - the pool is at its max size: {self.max_size}")
+
+        connect_future: Future | None = None
+        try:
+            connect_future = self.server.thread_pool.submit(self._connect, key)
+            connection = await asyncio.wrap_future(connect_future)
+        except BaseException as e:
+            # Including a cancelled checkout (e.g. a caller's timeout) - whose connect may still be running
+            self.size -= 1
+            if not isinstance(e, asyncio.CancelledError):
+                self.connect_failures += 1
+            if connect_future is not None:
+                event_loop = self.server.event_loop
+                connect_future.add_done_callback(lambda future: event_loop.call_soon_threadsafe(self._close_late_connection, key, future))
+            self._notify_waiters()
+            raise
+
+        async with self.condition:
+            self.checked_out += 1
+
+        logger.info(msg=f"Opened pooled database connection to: {key.database_server_uri} (autocommit: {key.autocommit}) - pool size: {self.size}")
+        return PooledConnection(key=key,
+                                connection=connection
+                                )
+
+    async def checkin(self,
+                      pooled_connection: PooledConnection,
+                      discard: bool = False
+                      ):
+        async with self.condition:
+            self.checked_out -= 1
+
+        # Once the pool is closed - connections are closed as they come back
+        discard = discard or self.closed
+        if not discard:
+            try:
+                await self._run_in_executor(self._reset, pooled_connection)
+            except Exception as e:
+                logger.warning(msg=f"Failed to reset pooled database connection - discarding it - error: {str(e)}")
+                discard = True
+
+        if discard:
+            await self._discard(pooled_connection)
+            return
+
+        pooled_connection.last_used_at = time.monotonic()
+        async with self.condition:
+            self.idle_connections[pooled_connection.key].append(pooled_connection)
+            self.condition.notify()
+
+    async def prewarm(self):
+        connections = []
+        for database_server_uri in self.server.database_backend_uris:
+            for _ in range(min(self.min_size, self.max_size - len(connections))):
+                try:
+                    connections.append(await self.checkout(autocommit=True,
+                                                           database_server_uri=database_server_uri
+                                                           )
+                                       )
+                except Exception as e:
+                    logger.error(msg=f"Failed to pre-warm the database connection pool for: {database_server_uri} - error: {str(e)}")
+                    break
+
+        for pooled_connection in connections:
+            await self.checkin(pooled_connection)
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(min(self.health_check_interval, self.idle_timeout))
+            now = time.monotonic()
+
+            expired_connections = []
+            unchecked_connections = []
+            async with self.condition:
+                default_keys = {self.get_key(autocommit=True, database_server_uri=database_server_uri)
+                                for database_server_uri in self.server.database_backend_uris}
+                for key, idle_connections in self.idle_connections.items():
+                    keep_count = self.min_size if key in default_keys else 0
+                    # The list is oldest-used first - so expire from the front
+                    while len(idle_connections) > keep_count and now - idle_connections[0].last_used_at > self.idle_timeout:
+                        expired_connections.append(idle_connections.pop(0))
+                        self.size -= 1
+
+                    for pooled_connection in list(idle_connections):
+                        if now - pooled_connection.last_checked_at > self.health_check_interval:
+                            idle_connections.remove(pooled_connection)
+                            unchecked_connections.append(pooled_connection)
+                self.checked_out += len(unchecked_connections)
+
+            for pooled_connection in expired_connections:
+                await self._close_connection(pooled_connection)
+
+            for pooled_connection in unchecked_connections:
+                try:
+                    await self._run_in_executor(self._check_health, pooled_connection)
+                except Exception as e:
+                    logger.warning(msg=f"Pooled database connection to: {pooled_connection.key.database_server_uri} failed its health check - discarding it - error: {str(e)}")
+                    async with self.condition:
+                        self.checked_out -= 1
+                    await self._discard(pooled_connection)
+                else:
+                    pooled_connection.last_checked_at = time.monotonic()
+                    # Health checks don't count as use - so put it back where it was in the idle order
+                    async with self.condition:
+                        self.checked_out -= 1
+                        idle_connections = self.idle_connections[pooled_connection.key]
+                        idle_connections.insert(sum(1 for idle_connection in idle_connections
+                                                    if idle_connection.last_used_at <= pooled_connection.last_used_at),
+                                                pooled_connection
+                                                )
+                        self.condition.notify()
+
+            if expired_connections:
+                logger.info(msg=f"Evicted {len(expired_connections)} idle database connection(s) - pool size: {self.size}")
+
+    async def start(self):
+        await self.prewarm()
+        self.maintenance_task = asyncio.create_task(self.maintain())
+
+    async def close(self):
+        """
+        Closes the idle connections - connections which are checked out are closed when they are checked back in.
+        """
+        if self.maintenance_task:
+            self.maintenance_task.cancel()
+            self.maintenance_task = None
+
+        async with self.condition:
+            self.closed = True
+            idle_connections = [pooled_connection for key_connections in self.idle_connections.values()
+                                for pooled_connection in key_connections]
+            self.idle_connections.clear()
+            self.size -= len(idle_connections)
+
+        for pooled_connection in idle_connections:
+            await self._close_connection(pooled_connection)
+
+    def stats(self) -> dict:
+        return dict(size=self.size,
+                    idle=self.idle_count,
+                    checked_out=self.checked_out,
+                    connect_failures=self.connect_failures
+                    )
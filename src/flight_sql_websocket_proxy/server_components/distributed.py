@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from typing import TYPE_CHECKING, Callable, Iterator
+
+import pyarrow
+
+from .common import DistributeMode
+from .connection_pool import PooledConnection
+from .result_cache import is_read_only_sql
+from ..config import logger
+
+if TYPE_CHECKING:
+    from .server_class import Server
+    from ..parser.query import Query as ParsedQuery
+
+DISTRIBUTED_EXTRA_HINT = "install the server's distributed extra: pip install flight-sql-websocket-proxy[distributed]"
+
+
+def check_distributed_dependencies():
+    """
+    Scatter-gather needs a SQL parser (to plan the merge) and DuckDB (to run it) - neither of which the server
+    needs otherwise.
+    """
+    try:
+        import duckdb  # noqa: F401
+        import pglast  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError(f"Distributed queries need package: '{e.name}' - {DISTRIBUTED_EXTRA_HINT}")
+
+
+def get_merge_plan(sql: str,
+                   distribute_mode: DistributeMode
+                   ) -> ParsedQuery | None:
+    """
+    Checks that a statement can be distributed in the given mode.
+
+    :return: The parsed statement (which plans the merge of its shards' results) - or None, if it could not be
+             parsed and is distributed anyway (its shards' results are concatenated).
+    """
+    from ..parser.query import Query as ParsedQuery
+
+    if not is_read_only_sql(sql):
+        raise ValueError("Only read-only statements can be distributed")
+
+    try:
+        parsed_query = ParsedQuery(query_text=sql)
+    except Exception as e:
+        if distribute_mode == DistributeMode.FORCE:
+            logger.warning(msg=f"Could not plan the merge of distributed query: {sql} - its shards' results are concatenated - error: {str(e)}")
+            return None
+        raise ValueError(f"The query cannot be distributed - it could not be parsed: {str(e)} - use distribute: '{DistributeMode.FORCE}' to concatenate its shards' results")
+
+    if parsed_query.merge_problems and distribute_mode != DistributeMode.FORCE:
+        raise ValueError(f"The query cannot be distributed exactly - it has: {'; '.join(parsed_query.merge_problems)} - "
+                         f"use distribute: '{DistributeMode.FORCE}' to distribute it anyway")
+    return parsed_query
+
+
+class DistributedResult:
+    """
+    Runs a statement on every shard in parallel (each on a pooled connection of its own) - and merges the shards'
+    Arrow results into one reader.  Results which only need to be concatenated are streamed, shard by shard;
+    otherwise they are read in full (in parallel) and the merge plan's summary query runs over them - as
+    combined_result - in an in-process DuckDB.
+    """
+    def __init__(self,
+                 server: "Server",
+                 sql: str,
+                 parameters: list | None,
+                 merge_plan: ParsedQuery | None,
+                 run_in_executor: Callable
+                 ):
+        self.server = server
+        self.sql = sql
+        self.parameters = parameters
+        self.merge_plan = merge_plan
+        self.run_in_executor = run_in_executor
+
+        self.shard_uris = list(server.database_shard_uris)
+        self.database_connections: list[PooledConnection] = []
+        self.cursors = []
+        self.duckdb_connection = None
+        self.merge_seconds: float | None = None
+
+    async def checkout_connections(self):
+        checkouts = await asyncio.gather(*[self.server.connection_pool.checkout(autocommit=True,
+                                                                                database_server_uri=shard_uri
+                                                                                )
+                                           for shard_uri in self.shard_uris],
+                                         return_exceptions=True
+                                         )
+        self.database_connections = [checkout for checkout in checkouts if isinstance(checkout, PooledConnection)]
+        for shard_uri, checkout in zip(self.shard_uris, checkouts):
+            if isinstance(checkout, BaseException):
+                raise RuntimeError(f"Failed to connect to shard: {shard_uri} - error: {str(checkout)}")
+
+    async def execute(self) -> pyarrow.RecordBatchReader:
+        from .server_query import Query
+
+        await self.checkout_connections()
+        self.cursors = [database_connection.cursor() for database_connection in self.database_connections]
+
+        shard_readers = await asyncio.gather(*[self.run_in_executor(functools.partial(Query.run_query,
+                                                                                      cursor=cursor,
+                                                                                      sql=self.sql,
+                                                                                      parameters=self.parameters
+                                                                                      )
+                                                                    )
+                                               for cursor in self.cursors],
+                                             return_exceptions=True
+                                             )
+        for shard_uri, shard_reader in zip(self.shard_uris, shard_readers):
+            if isinstance(shard_reader, BaseException):
+                raise RuntimeError(f"The query failed on shard: {shard_uri} - error: {str(shard_reader)}")
+
+        schema = shard_readers[0].schema
+        summary_query = self.merge_plan.get_summary_query(column_names=schema.names) if self.merge_plan else None
+        if summary_query is None:
+            # The backend cursors stay open - and are read from as the client fetches
+            return pyarrow.RecordBatchReader.from_batches(schema, self.concatenate(schema=schema, shard_readers=shard_readers))
+
+        merge_start_time = time.perf_counter()
+        shard_tables = await asyncio.gather(*[self.run_in_executor(shard_reader.read_all) for shard_reader in shard_readers])
+        # Every shard has been read in full - so their connections can go back to the pool now
+        await self.close_shards()
+        record_batch_reader = await self.run_in_executor(functools.partial(self.merge,
+                                                                           schema=schema,
+                                                                           shard_tables=shard_tables,
+                                                                           summary_query=summary_query
+                                                                           )
+                                                         )
+        self.merge_seconds = time.perf_counter() - merge_start_time
+        logger.info(msg=f"Merged the results of {len(shard_tables)} shard(s) in {self.merge_seconds:.4f} second(s) - with summary query: {summary_query}")
+        return record_batch_reader
+
+    @classmethod
+    def concatenate(cls,
+                    schema: pyarrow.Schema,
+                    shard_readers: list[pyarrow.RecordBatchReader]
+                    ) -> Iterator[pyarrow.RecordBatch]:
+        for shard_reader in shard_readers:
+            for record_batch in shard_reader:
+                # Shards can differ in details like nullability - the first shard's schema wins
+                yield record_batch if record_batch.schema == schema else record_batch.cast(schema)
+
+    def merge(self,
+              schema: pyarrow.Schema,
+              shard_tables: list[pyarrow.Table],
+              summary_query: str
+              ) -> pyarrow.RecordBatchReader:
+        import duckdb
+
+        combined_result = pyarrow.concat_tables(shard_tables, promote_options="permissive")
+        self.duckdb_connection = duckdb.connect()
+        self.duckdb_connection.register("combined_result", combined_result)
+        record_batch_reader = self.duckdb_connection.execute(summary_query).fetch_record_batch()
+        if record_batch_reader.schema.names != schema.names:
+            return record_batch_reader
+
+        # DuckDB widens re-aggregated columns (e.g. SUM of BIGINT is HUGEINT) - the client gets the shards' types
+        return record_batch_reader.cast(schema)
+
+    async def close_shards(self):
+        for cursor in self.cursors:
+            try:
+                cursor.close()
+            except Exception as e:
+                logger.warning(msg=f"Failed to close a shard cursor - error: {str(e)}")
+        self.cursors = []
+
+        database_connections, self.database_connections = self.database_connections, []
+        for database_connection in database_connections:
+            await self.server.connection_pool.checkin(database_connection)
+
+    async def close(self):
+        await self.close_shards()
+        if self.duckdb_connection:
+            self.duckdb_connection.close()
+            self.duckdb_connection = None
@@ -0,0 +1,61 @@
+class AdaptiveFetchSizer:
+    """
+    Sizes each fetch so that its response lands close to a target frame size.
+
+    It tracks (as exponentially weighted moving averages) how many payload bytes each row costs once encoded,
+    how many Arrow bytes each row costs in memory, and how fast the client is taking data off the socket.  The
+    frame target shrinks when the observed send throughput cannot deliver a full frame within the target send time.
+    """
+    def __init__(self,
+                 target_frame_bytes: int,
+                 target_send_seconds: float,
+                 min_frame_bytes: int,
+                 smoothing: float = 0.3
+                 ):
+        self.target_frame_bytes = target_frame_bytes
+        self.target_send_seconds = target_send_seconds
+        self.min_frame_bytes = min(min_frame_bytes, target_frame_bytes)
+        self.smoothing = smoothing
+
+        self.payload_bytes_per_row: float | None = None
+        self.arrow_bytes_per_row: float | None = None
+        self.send_bytes_per_second: float | None = None
+
+    def _smooth(self,
+                current_value: float | None,
+                observed_value: float
+                ) -> float:
+        if current_value is None:
+            return observed_value
+        return (self.smoothing * observed_value) + ((1 - self.smoothing) * current_value)
+
+    def observe(self,
+                rows: int,
+                arrow_bytes: int,
+                payload_bytes: int,
+                send_seconds: float
+                ):
+        if rows > 0 and arrow_bytes > 0:
+            self.payload_bytes_per_row = self._smooth(self.payload_bytes_per_row, payload_bytes / rows)
+            self.arrow_bytes_per_row = self._smooth(self.arrow_bytes_per_row, arrow_bytes / rows)
+
+        if payload_bytes > 0 and send_seconds > 0:
+            self.send_bytes_per_second = self._smooth(self.send_bytes_per_second, payload_bytes / send_seconds)
+
+    @property
+    def frame_bytes(self) -> int:
+        frame_bytes = self.target_frame_bytes
+        if self.send_bytes_per_second:
+            frame_bytes = min(frame_bytes, self.send_bytes_per_second * self.target_send_seconds)
+
+        return int(max(frame_bytes, self.min_frame_bytes))
+
+    def next_fetch_bytes(self) -> int:
+        """
+        :return: The number of (in-memory) Arrow bytes to read for the next fetch.
+        """
+        encoding_ratio = 1.0
+        if self.payload_bytes_per_row and self.arrow_bytes_per_row:
+            encoding_ratio = self.payload_bytes_per_row / self.arrow_bytes_per_row
+
+        return max(int(self.frame_bytes / encoding_ratio), 1)
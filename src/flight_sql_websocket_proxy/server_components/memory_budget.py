@@ -0,0 +1,210 @@
+import os
+import tempfile
+import threading
+
+import pyarrow
+
+from ..config import logger
+
+
+class MemoryBudget:
+    """
+    A server-wide cap on the bytes of query results that all cursors may hold in memory at once.  Reservations
+    are all-or-nothing - a cursor which cannot reserve what it needs spills to disk instead.
+
+    It is used from the thread pool - so it guards its state with a (thread) lock.
+    """
+    def __init__(self,
+                 limit_bytes: int
+                 ):
+        self.limit_bytes = limit_bytes
+        self.reserved_bytes = 0
+        self.spills = 0
+        self.spilled_bytes = 0
+        self.lock = threading.Lock()
+
+    def try_reserve(self,
+                    nbytes: int
+                    ) -> bool:
+        with self.lock:
+            if self.reserved_bytes + nbytes > self.limit_bytes:
+                return False
+            self.reserved_bytes += nbytes
+            return True
+
+    def release(self,
+                nbytes: int
+                ):
+        with self.lock:
+            self.reserved_bytes -= nbytes
+
+    def record_spill(self,
+                     nbytes: int
+                     ):
+        with self.lock:
+            self.spills += 1
+            self.spilled_bytes += nbytes
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(limit_bytes=self.limit_bytes,
+                        reserved_bytes=self.reserved_bytes,
+                        spills=self.spills,
+                        spilled_bytes=self.spilled_bytes
+                        )
+
+
+class ResultSpill:
+    """
+    A temporary Arrow IPC file which record batches are spilled to - and read back from through a memory map, so
+    that their data lives in the (reclaimable) page cache rather than in the process' heap.
+    """
+    def __init__(self,
+                 schema: pyarrow.Schema,
+                 directory: str = None
+                 ):
+        file_descriptor, self.path = tempfile.mkstemp(prefix="flight-sql-websocket-proxy-spill-",
+                                                      suffix=".arrow",
+                                                      dir=directory
+                                                      )
+        os.close(file_descriptor)
+        self.sink = pyarrow.OSFile(self.path, mode="wb")
+        self.writer = pyarrow.ipc.new_file(sink=self.sink, schema=schema)
+        self.nbytes = 0
+
+    def write(self,
+              record_batch: pyarrow.RecordBatch
+              ):
+        self.writer.write_batch(record_batch)
+        self.nbytes += record_batch.nbytes
+
+    def finish(self):
+        if not self.sink.closed:
+            self.writer.close()
+            self.sink.close()
+
+    def read_batches(self) -> list[pyarrow.RecordBatch]:
+        """
+        :return: The spilled batches - backed by a memory map of the file, which stays valid (even once the file is
+                 closed and deleted) for as long as the batches are referenced.
+        """
+        self.finish()
+        with pyarrow.memory_map(self.path, "r") as source:
+            reader = pyarrow.ipc.open_file(source)
+            return [reader.get_batch(i) for i in range(reader.num_record_batches)]
+
+    def close(self):
+        self.finish()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logger.warning(msg=f"Failed to remove spill file: '{self.path}' - error: {str(e)}")
+
+
+class BudgetedBatchList:
+    """
+    Collects a fetch's record batches against the memory budget - once the budget cannot cover the next batch,
+    everything collected so far (and everything after it) is spilled to a ResultSpill instead.
+    """
+    def __init__(self,
+                 memory_budget: MemoryBudget,
+                 schema: pyarrow.Schema,
+                 spill_directory: str = None
+                 ):
+        self.memory_budget = memory_budget
+        self.schema = schema
+        self.spill_directory = spill_directory
+
+        self.record_batches: list[pyarrow.RecordBatch] = []
+        self.reserved_bytes = 0
+        self.spill: ResultSpill | None = None
+        self.num_rows = 0
+        self.nbytes = 0
+
+    def append(self,
+               record_batch: pyarrow.RecordBatch
+               ):
+        self.num_rows += record_batch.num_rows
+        self.nbytes += record_batch.nbytes
+
+        if self.spill is None:
+            if self.memory_budget.try_reserve(record_batch.nbytes):
+                self.reserved_bytes += record_batch.nbytes
+                self.record_batches.append(record_batch)
+                return
+
+            self.spill = ResultSpill(schema=self.schema,
+                                     directory=self.spill_directory
+                                     )
+            for spilled_batch in self.record_batches:
+                self.spill.write(spilled_batch)
+            self.record_batches = []
+            self.memory_budget.release(self.reserved_bytes)
+            self.reserved_bytes = 0
+
+        self.spill.write(record_batch)
+
+    def get_batches(self) -> list[pyarrow.RecordBatch]:
+        if self.spill is None:
+            return self.record_batches
+
+        logger.info(msg=f"Spilled {self.spill.nbytes} byte(s) of results to: '{self.spill.path}' - the result memory budget ({self.memory_budget.limit_bytes} bytes) is exhausted")
+        self.memory_budget.record_spill(self.spill.nbytes)
+        record_batches = self.spill.read_batches()
+        # The memory map outlives the file
+        self.spill.close()
+        self.spill = None
+        return record_batches
+
+    def release(self):
+        self.memory_budget.release(self.reserved_bytes)
+        self.reserved_bytes = 0
+        self.record_batches = []
+        if self.spill:
+            self.spill.close()
+            self.spill = None
+
+
+def get_base64_message_bytes(encoded_bytes: int) -> int:
+    # The base64 string - and a JSON message (the same size again) with the string in it
+    return 2 * encoded_bytes
+
+
+class EncodingReservation:
+    """
+    The budget a fetch's base64 encoding holds - an IPC stream copy of its batches and the base64 string (a third
+    bigger than the stream) while they are encoded, and then the string and the JSON message which carries it until
+    it is sent.  Unlike the batches, none of these can spill - so a fetch whose encoding the budget cannot cover
+    fails, rather than taking the memory anyway.
+    """
+    def __init__(self,
+                 memory_budget: MemoryBudget
+                 ):
+        self.memory_budget = memory_budget
+        self.reserved_bytes = 0
+
+    def reserve(self,
+                arrow_bytes: int
+                ):
+        """
+        :param arrow_bytes: The size of the batches to encode - the IPC stream is no bigger (uncompressed).
+        :raises MemoryError: If the budget cannot cover the encoding.
+        """
+        nbytes = get_base64_message_bytes(encoded_bytes=(arrow_bytes + 2) // 3 * 4)
+        if nbytes > self.memory_budget.limit_bytes:
+            raise MemoryError(f"The fetch's base64 encoded results (about {nbytes} bytes - with their IPC stream) are bigger than the result memory budget ({self.memory_budget.limit_bytes} bytes) - fetch fewer rows at a time (fetch_size / fetch_bytes), or use the binary result format")
+        if not self.memory_budget.try_reserve(nbytes):
+            raise MemoryError(f"The result memory budget ({self.memory_budget.limit_bytes} bytes) cannot cover the fetch's base64 encoded results (about {nbytes} bytes) right now - fetch fewer rows at a time")
+        self.reserved_bytes += nbytes
+
+    def settle(self,
+               encoded_bytes: int
+               ):
+        # Once encoded - the IPC stream is gone
+        released_bytes = max(self.reserved_bytes - get_base64_message_bytes(encoded_bytes=encoded_bytes), 0)
+        self.memory_budget.release(released_bytes)
+        self.reserved_bytes -= released_bytes
+
+    def release(self):
+        self.memory_budget.release(self.reserved_bytes)
+        self.reserved_bytes = 0
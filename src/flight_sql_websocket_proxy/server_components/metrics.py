@@ -0,0 +1,369 @@
+import bisect
+import threading
+from typing import Callable
+
+from ..constants import METRICS_PREFIX, METRICS_LATENCY_BUCKETS
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    label_pairs = ",".join(f'{key}="{str(value)}"' for key, value in sorted(labels.items()))
+    return f"{{{label_pairs}}}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_metric(name: str,
+                  snapshot: dict
+                  ) -> list[str]:
+    lines = [f"# HELP {name} {snapshot['help']}",
+             f"# TYPE {name} {snapshot['type']}"
+             ]
+    if snapshot["type"] == "histogram":
+        cumulative_count = 0
+        for bucket, bucket_count in zip(snapshot["buckets"], snapshot["bucket_counts"]):
+            cumulative_count += bucket_count
+            lines.append(f'{name}_bucket{{le="{format_value(float(bucket))}"}} {cumulative_count}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {snapshot["count"]}')
+        lines.append(f"{name}_sum {format_value(snapshot['sum'])}")
+        lines.append(f"{name}_count {snapshot['count']}")
+    else:
+        for labels, value in snapshot["samples"]:
+            lines.append(f"{name}{format_labels(dict(labels))} {format_value(value)}")
+    return lines
+
+
+def render_snapshot(snapshot: dict) -> str:
+    lines = []
+    for name, metric_snapshot in snapshot.items():
+        lines.extend(render_metric(name=name, snapshot=metric_snapshot))
+    return "\n".join(lines) + "\n"
+
+
+def merge_snapshots(snapshots: list[dict]) -> dict:
+    """
+    Combines registry snapshots (e.g. those of several server processes) into one - histograms and counters are
+    summed, and gauges by their merge mode (sum or max).
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric_snapshot in snapshot.items():
+            merged_snapshot = merged.get(name)
+            if merged_snapshot is None:
+                merged[name] = dict(metric_snapshot,
+                                    **(dict(bucket_counts=list(metric_snapshot["bucket_counts"]))
+                                       if metric_snapshot["type"] == "histogram"
+                                       else dict(samples=[[labels, value] for labels, value in metric_snapshot["samples"]]))
+                                    )
+            elif merged_snapshot["type"] == "histogram":
+                if merged_snapshot["buckets"] != metric_snapshot["buckets"]:
+                    raise ValueError(f"Cannot merge histogram: {name} - its buckets differ")
+                merged_snapshot["bucket_counts"] = [merged_count + bucket_count
+                                                    for merged_count, bucket_count in zip(merged_snapshot["bucket_counts"], metric_snapshot["bucket_counts"])]
+                merged_snapshot["count"] += metric_snapshot["count"]
+                merged_snapshot["sum"] += metric_snapshot["sum"]
+            else:
+                merge = max if metric_snapshot.get("merge") == "max" else sum
+                samples = {tuple(map(tuple, labels)): value for labels, value in merged_snapshot["samples"]}
+                for labels, value in metric_snapshot["samples"]:
+                    key = tuple(map(tuple, labels))
+                    samples[key] = merge([samples[key], value]) if key in samples else value
+                merged_snapshot["samples"] = [[list(map(list, key)), value] for key, value in samples.items()]
+    return merged
+
+
+def get_cumulative_snapshot(snapshot: dict) -> dict:
+    """
+    The counters and histograms of a snapshot - the metrics which must not go down when their process is gone.
+    """
+    return {name: metric_snapshot for name, metric_snapshot in snapshot.items() if metric_snapshot["type"] != "gauge"}
+
+
+class Counter:
+    def __init__(self,
+                 name: str,
+                 help_text: str
+                 ):
+        self.name = name
+        self.help_text = help_text
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self,
+            amount: float = 1,
+            **labels
+            ):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            samples = [[list(map(list, key)), value] for key, value in self.values.items()]
+        return dict(type="counter",
+                    help=self.help_text,
+                    samples=samples
+                    )
+
+
+class Gauge:
+    """
+    A metric whose value is read (from the server's own state) when it is scraped - so it never drifts.  The
+    state may itself be a running count - in which case it is exposed with the counter type.  Merged across
+    processes by summing, or (merge="max") by taking the largest value.
+    """
+    def __init__(self,
+                 name: str,
+                 help_text: str,
+                 callback: Callable[[], float],
+                 metric_type: str = "gauge",
+                 merge: str = "sum"
+                 ):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.metric_type = metric_type
+        self.merge = merge
+
+    def snapshot(self) -> dict:
+        return dict(type=self.metric_type,
+                    help=self.help_text,
+                    merge=self.merge,
+                    samples=[[[], self.callback()]]
+                    )
+
+
+class Histogram:
+    def __init__(self,
+                 name: str,
+                 help_text: str,
+                 buckets: list[float] = None
+                 ):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets or METRICS_LATENCY_BUCKETS)
+        self.bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self,
+                value: float
+                ):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if index < len(self.buckets):
+                self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(type="histogram",
+                        help=self.help_text,
+                        buckets=list(self.buckets),
+                        bucket_counts=list(self.bucket_counts),
+                        count=self.count,
+                        sum=self.sum
+                        )
+
+
+class MetricsRegistry:
+    """
+    A minimal, self-contained Prometheus text exposition (format 0.0.4) registry.
+    """
+    def __init__(self,
+                 prefix: str = METRICS_PREFIX
+                 ):
+        self.prefix = prefix
+        self.metrics: list[Counter | Gauge | Histogram] = []
+
+    def counter(self,
+                name: str,
+                help_text: str
+                ) -> Counter:
+        counter = Counter(name=f"{self.prefix}_{name}", help_text=help_text)
+        self.metrics.append(counter)
+        return counter
+
+    def gauge(self,
+              name: str,
+              help_text: str,
+              callback: Callable[[], float],
+              metric_type: str = "gauge",
+              merge: str = "sum"
+              ) -> Gauge:
+        gauge = Gauge(name=f"{self.prefix}_{name}", help_text=help_text, callback=callback, metric_type=metric_type, merge=merge)
+        self.metrics.append(gauge)
+        return gauge
+
+    def histogram(self,
+                  name: str,
+                  help_text: str,
+                  buckets: list[float] = None
+                  ) -> Histogram:
+        histogram = Histogram(name=f"{self.prefix}_{name}", help_text=help_text, buckets=buckets)
+        self.metrics.append(histogram)
+        return histogram
+
+    def snapshot(self) -> dict:
+        """
+        The registry's current values - JSON serializable, so that they can be merged with other processes'.
+        """
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(self) -> str:
+        return render_snapshot(self.snapshot())
+
+
+class ProxyMetrics(MetricsRegistry):
+    """
+    The proxy server's metrics - counters and histograms are updated where the work happens, gauges read the
+    server's state at scrape time.
+    """
+    def __init__(self):
+        super().__init__()
+        self.queries = self.counter(name="queries_total",
+                                    help_text="Queries run - by status (success, error, cached or rejected)."
+                                    )
+        self.fetches = self.counter(name="fetches_total",
+                                    help_text="Fetches served - by status (success or error)."
+                                    )
+        self.rows_sent = self.counter(name="rows_sent_total",
+                                      help_text="Result rows sent to clients."
+                                      )
+        self.bytes_sent = self.counter(name="bytes_sent_total",
+                                       help_text="Bytes sent to clients over websockets (JSON and binary frames)."
+                                       )
+        self.encodings = self.counter(name="fetch_encodings_total",
+                                      help_text="Fetch results encoded - by where the encoding ran (thread, or a worker process)."
+                                      )
+        self.queue_seconds = self.histogram(name="query_queue_seconds",
+                                            help_text="Time queries waited in the scheduler queue."
+                                            )
+        self.execute_seconds = self.histogram(name="query_execute_seconds",
+                                              help_text="Backend execution time of queries (up to their first batch being available)."
+                                              )
+        self.fetch_read_seconds = self.histogram(name="fetch_read_seconds",
+                                                 help_text="Time fetches spent reading record batches."
+                                                 )
+        self.serialize_seconds = self.histogram(name="fetch_serialize_seconds",
+                                                help_text="Time fetches spent serializing record batches to Arrow IPC (and base64)."
+                                                )
+        self.send_seconds = self.histogram(name="fetch_send_seconds",
+                                           help_text="Time fetches spent sending their results over the websocket."
+                                           )
+
+    def register_server_gauges(self,
+                               server
+                               ):
+        self.gauge(name="active_sessions",
+                   help_text="Connected websocket client sessions.",
+                   callback=lambda: len(server.client_connections)
+                   )
+        self.gauge(name="open_cursors",
+                   help_text="Open queries (cursors) across all sessions.",
+                   callback=lambda: sum(len(client.queries) for client in list(server.client_connections.values()))
+                   )
+        self.gauge(name="queries_in_flight",
+                   help_text="Queries executing against the backend.",
+                   callback=lambda: server.query_scheduler.running
+                   )
+        self.gauge(name="queries_queued",
+                   help_text="Queries waiting in the scheduler queue.",
+                   callback=lambda: server.query_scheduler.stats()["queued"]
+                   )
+        self.gauge(name="thread_pool_queue_depth",
+                   help_text="Work items waiting for a thread in the server's thread pool.",
+                   callback=lambda: server.thread_pool._work_queue.qsize()
+                   )
+        self.gauge(name="database_pool_connections",
+                   help_text="Open backend connections in the pool.",
+                   callback=lambda: server.connection_pool.size
+                   )
+        self.gauge(name="database_pool_checked_out",
+                   help_text="Backend connections checked out of the pool.",
+                   callback=lambda: server.connection_pool.checked_out
+                   )
+        self.gauge(name="database_connect_failures_total",
+                   help_text="Failed backend connection attempts.",
+                   callback=lambda: server.connection_pool.connect_failures,
+                   metric_type="counter"
+                   )
+        self.gauge(name="database_backends_ejected",
+                   help_text="Database backends (the server and its replicas) taken out of rotation for failing.",
+                   callback=lambda: sum(1 for backend in server.backend_router.backends.values() if backend.ejected),
+                   merge="max"
+                   )
+        self.gauge(name="database_backend_outstanding_queries",
+                   help_text="Queries holding a cursor on a database backend - across all backends.",
+                   callback=lambda: sum(backend.outstanding for backend in server.backend_router.backends.values())
+                   )
+        self.gauge(name="database_backend_retries_total",
+                   help_text="Connects and queries retried on another database backend after theirs could not be reached.",
+                   callback=lambda: server.backend_router.retries,
+                   metric_type="counter"
+                   )
+        self.gauge(name="jwks_refreshes_total",
+                   help_text="Successful fetches of the JWKS (session token signing keys).",
+                   callback=lambda: server.jwks_manager.refreshes,
+                   metric_type="counter"
+                   )
+        self.gauge(name="jwks_refresh_failures_total",
+                   help_text="Failed fetches of the JWKS.",
+                   callback=lambda: server.jwks_manager.refresh_failures,
+                   metric_type="counter"
+                   )
+        self.gauge(name="jwks_unknown_kid_rejections_total",
+                   help_text="Session tokens rejected for being signed with a key the JWKS does not have.",
+                   callback=lambda: server.jwks_manager.unknown_kid_rejections,
+                   metric_type="counter"
+                   )
+        self.gauge(name="token_cache_hits_total",
+                   help_text="Authentications served from the verified session token cache.",
+                   callback=lambda: server.user_authenticator.token_cache.hits,
+                   metric_type="counter"
+                   )
+        self.gauge(name="token_cache_misses_total",
+                   help_text="Authentications which had to verify their session token.",
+                   callback=lambda: server.user_authenticator.token_cache.misses,
+                   metric_type="counter"
+                   )
+        self.gauge(name="user_cache_hits_total",
+                   help_text="User email lookups served from the user cache.",
+                   callback=lambda: server.user_authenticator.user_cache.hits,
+                   metric_type="counter"
+                   )
+        self.gauge(name="user_cache_misses_total",
+                   help_text="User email lookups which called the Clerk API.",
+                   callback=lambda: server.user_authenticator.user_cache.misses,
+                   metric_type="counter"
+                   )
+        self.gauge(name="result_memory_reserved_bytes",
+                   help_text="Bytes of query results held in memory against the result memory budget.",
+                   callback=lambda: server.memory_budget.reserved_bytes
+                   )
+        self.gauge(name="result_spills_total",
+                   help_text="Fetches which spilled their results to disk.",
+                   callback=lambda: server.memory_budget.spills,
+                   metric_type="counter"
+                   )
+        self.gauge(name="result_cache_bytes",
+                   help_text="Bytes held in the result cache.",
+                   callback=lambda: server.result_cache.nbytes
+                   )
+        self.gauge(name="result_cache_hits_total",
+                   help_text="Result cache hits.",
+                   callback=lambda: server.result_cache.hits,
+                   metric_type="counter"
+                   )
+        self.gauge(name="result_cache_misses_total",
+                   help_text="Result cache misses.",
+                   callback=lambda: server.result_cache.misses,
+                   metric_type="counter"
+                   )
@@ -0,0 +1,212 @@
+from __future__ import annotations
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterator
+
+import pyarrow
+
+from .common import PartitionOrder
+from .connection_pool import PooledConnection
+from ..config import logger
+from ..constants import PARTITION_READ_POLL_INTERVAL
+
+if TYPE_CHECKING:
+    from .server_class import Server
+
+
+class PartitionDone:
+    pass
+
+
+class PartitionedReader:
+    """
+    Reads a result's partitions (its Flight endpoints - from cursor.adbc_execute_partitions) concurrently, and
+    merges them into one stream of record batches - in partition order, or in the order they arrive.
+
+    Each reader needs a connection of its own (the Flight SQL driver cancels a connection's partition stream when
+    another one is read on it) - so besides the query's own connection, it only uses connections the pool can
+    spare right away.  Readers take partitions in order, and buffer what they read - up to max_bytes in all (and
+    against the server's result memory budget), after which they wait for the consumer.  The partition the
+    consumer is on can always buffer a batch if it has none waiting - so that the merge never stalls.
+    """
+    def __init__(self,
+                 server: "Server",
+                 database_connection: PooledConnection,
+                 partitions: list[bytes],
+                 schema: pyarrow.Schema | None,
+                 partition_order: PartitionOrder,
+                 max_readers: int,
+                 max_bytes: int
+                 ):
+        self.server = server
+        self.database_connection = database_connection
+        self.partitions = partitions
+        self.schema = schema
+        self.partition_order = PartitionOrder(partition_order)
+        self.max_readers = max(max_readers, 1)
+        self.max_bytes = max_bytes
+        self.memory_budget = server.memory_budget
+
+        # Connections checked out (on top of the query's own) for the readers - they go back to the pool on close
+        self.reader_connections: list[PooledConnection] = []
+        # One buffer per partition if the merge keeps their order - otherwise one for all of them
+        buffer_count = len(partitions) if self.partition_order == PartitionOrder.ORDERED else 1
+        self.buffers: list[deque[tuple[pyarrow.RecordBatch | PartitionDone | Exception, int]]] = [deque() for _ in range(buffer_count)]
+        self.buffered_bytes = 0
+        self.head_buffer = 0
+        self.next_partition = 0
+        self.condition = threading.Condition()
+        self.schema_ready = threading.Event()
+        if self.schema is not None:
+            self.schema_ready.set()
+        self.stopped = False
+        self.executor: ThreadPoolExecutor | None = None
+
+    async def start(self):
+        for _ in range(min(len(self.partitions), self.max_readers) - 1):
+            pooled_connection = await self.server.connection_pool.checkout(autocommit=True,
+                                                                           database_server_uri=self.database_connection.key.database_server_uri,
+                                                                           wait=False
+                                                                           )
+            if pooled_connection is None:
+                break
+            self.reader_connections.append(pooled_connection)
+
+        connections = [self.database_connection] + self.reader_connections
+        logger.info(msg=f"Reading {len(self.partitions)} result partition(s) with {len(connections)} reader(s) - {self.partition_order}")
+        if not self.partitions:
+            self.schema_ready.set()
+            return
+
+        self.executor = ThreadPoolExecutor(max_workers=len(connections),
+                                           thread_name_prefix="partition-reader"
+                                           )
+        for connection in connections:
+            self.executor.submit(self.read_partitions, connection)
+
+    def put(self,
+            partition: int,
+            item: pyarrow.RecordBatch | PartitionDone | Exception
+            ) -> bool:
+        """
+        :return: False - if the read was stopped (and the item was not buffered).
+        """
+        buffer_index = partition if self.partition_order == PartitionOrder.ORDERED else 0
+        buffer = self.buffers[buffer_index]
+        nbytes = item.nbytes if isinstance(item, pyarrow.RecordBatch) else 0
+        with self.condition:
+            while not self.stopped:
+                reserved_bytes = 0
+                if nbytes == 0:
+                    break
+                if self.buffered_bytes + nbytes <= self.max_bytes and self.memory_budget.try_reserve(nbytes):
+                    reserved_bytes = nbytes
+                    break
+                if buffer_index == self.head_buffer and not buffer:
+                    break
+                self.condition.wait(timeout=PARTITION_READ_POLL_INTERVAL)
+            else:
+                return False
+
+            buffer.append((item, reserved_bytes))
+            self.buffered_bytes += nbytes
+            self.condition.notify_all()
+            return True
+
+    def read_partitions(self,
+                        connection: PooledConnection
+                        ):
+        while not self.stopped:
+            with self.condition:
+                partition = self.next_partition
+                if partition >= len(self.partitions):
+                    return
+                self.next_partition += 1
+
+            cursor = connection.cursor()
+            try:
+                cursor.adbc_read_partition(self.partitions[partition])
+                record_batch_reader = cursor.fetch_record_batch()
+                if not self.schema_ready.is_set():
+                    self.schema = record_batch_reader.schema
+                    self.schema_ready.set()
+                for record_batch in record_batch_reader:
+                    if not self.put(partition, record_batch):
+                        return
+                self.put(partition, PartitionDone())
+            except Exception as e:
+                # Handed to the consumer - which raises it
+                self.schema_ready.set()
+                self.put(partition, e)
+                return
+            finally:
+                cursor.close()
+
+    def take(self,
+             buffer_index: int
+             ) -> pyarrow.RecordBatch | PartitionDone:
+        buffer = self.buffers[buffer_index]
+        with self.condition:
+            if self.head_buffer != buffer_index:
+                self.head_buffer = buffer_index
+                self.condition.notify_all()
+            while not buffer:
+                if self.stopped:
+                    raise RuntimeError("The partitioned read was stopped")
+                self.condition.wait()
+
+            item, reserved_bytes = buffer.popleft()
+            if isinstance(item, pyarrow.RecordBatch):
+                self.buffered_bytes -= item.nbytes
+            self.memory_budget.release(reserved_bytes)
+            self.condition.notify_all()
+
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def merge(self) -> Iterator[pyarrow.RecordBatch]:
+        if self.partition_order == PartitionOrder.ORDERED:
+            for buffer_index in range(len(self.buffers)):
+                while not isinstance(record_batch := self.take(buffer_index), PartitionDone):
+                    yield record_batch
+        else:
+            partitions_done = 0
+            while partitions_done < len(self.partitions):
+                item = self.take(0)
+                if isinstance(item, PartitionDone):
+                    partitions_done += 1
+                else:
+                    yield item
+
+    def get_record_batch_reader(self) -> pyarrow.RecordBatchReader:
+        # Without a schema from the backend up front - we take the first partition's
+        self.schema_ready.wait()
+        if self.schema is None:
+            raise RuntimeError("The backend returned no schema for the partitioned result")
+        return pyarrow.RecordBatchReader.from_batches(self.schema, self.merge())
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+        if self.executor:
+            # Readers notice the stop at their next batch - and close their cursors
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        with self.condition:
+            for buffer in self.buffers:
+                for _, reserved_bytes in buffer:
+                    self.memory_budget.release(reserved_bytes)
+                buffer.clear()
+            self.buffered_bytes = 0
+
+    async def close(self):
+        await self.server.event_loop.run_in_executor(self.server.thread_pool, self.stop)
+        reader_connections, self.reader_connections = self.reader_connections, []
+        for pooled_connection in reader_connections:
+            await self.server.connection_pool.checkin(pooled_connection)
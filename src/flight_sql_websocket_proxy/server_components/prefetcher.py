@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import deque
+
+import pyarrow
+
+from .memory_budget import MemoryBudget
+
+
+class BatchPrefetcher:
+    """
+    A bounded read-ahead buffer in front of a RecordBatchReader.
+
+    fill() runs in a worker thread and reads batches until the buffer holds max_batches batches or max_bytes
+    bytes, so that the backend stream keeps flowing while the client is busy - it returns (freeing the thread)
+    once the buffer is full.  read_next_batch() serves from the buffer first, and only reads the stream itself
+    once the buffer is empty.  Buffered batches count against the server's result memory budget - read-ahead
+    pauses (until the buffer drains) when the budget cannot cover the next batch.
+    """
+    def __init__(self,
+                 record_batch_reader: pyarrow.RecordBatchReader,
+                 max_batches: int,
+                 max_bytes: int,
+                 memory_budget: MemoryBudget
+                 ):
+        self.record_batch_reader = record_batch_reader
+        self.max_batches = max_batches
+        self.max_bytes = max_bytes
+        self.memory_budget = memory_budget
+
+        self.buffer: deque[pyarrow.RecordBatch] = deque()
+        self.buffered_bytes = 0
+        self.reserved_bytes = 0
+        self.over_budget = False
+        self.exhausted = False
+        self.error: Exception | None = None
+        self.closed = False
+        # When the first batch arrived from the backend - read-ahead may read it long before a fetch takes it
+        self.first_batch_time: float | None = None
+        # The reader is not thread-safe - read_lock guards reading it, and buffer_lock guards the buffer (so that a
+        # fetch can take an already-buffered batch while a fill is waiting on the backend for the next one)
+        self.read_lock = threading.Lock()
+        self.buffer_lock = threading.Lock()
+
+    @property
+    def full(self) -> bool:
+        return len(self.buffer) >= self.max_batches or self.buffered_bytes >= self.max_bytes
+
+    @property
+    def needs_fill(self) -> bool:
+        return not (self.closed or self.exhausted or self.error or self.over_budget or self.full)
+
+    def _pop(self) -> pyarrow.RecordBatch | None:
+        with self.buffer_lock:
+            if not self.buffer:
+                return None
+            record_batch = self.buffer.popleft()
+            self.buffered_bytes -= record_batch.nbytes
+            self._release_unbuffered()
+            self.over_budget = False
+            return record_batch
+
+    def _release_unbuffered(self):
+        # Reservations cover at most what is buffered - a batch buffered while over budget was never reserved
+        if self.reserved_bytes > self.buffered_bytes:
+            self.memory_budget.release(self.reserved_bytes - self.buffered_bytes)
+            self.reserved_bytes = self.buffered_bytes
+
+    def _read_from_reader(self) -> pyarrow.RecordBatch:
+        record_batch = self.record_batch_reader.read_next_batch()
+        if self.first_batch_time is None:
+            self.first_batch_time = time.perf_counter()
+        return record_batch
+
+    def fill(self):
+        while True:
+            # Take the read lock per batch - so that a fetch can read the stream itself once the buffer is drained
+            with self.read_lock:
+                if not self.needs_fill:
+                    return
+                try:
+                    record_batch = self._read_from_reader()
+                except StopIteration:
+                    self.exhausted = True
+                    return
+                except Exception as e:
+                    # Raised to the client by the fetch which reaches this point in the stream
+                    self.error = e
+                    return
+
+                with self.buffer_lock:
+                    # We have already read it - so it is buffered either way, but we stop reading ahead if it is over budget
+                    if self.memory_budget.try_reserve(record_batch.nbytes):
+                        self.reserved_bytes += record_batch.nbytes
+                    else:
+                        self.over_budget = True
+                    self.buffer.append(record_batch)
+                    self.buffered_bytes += record_batch.nbytes
+
+    def read_next_batch(self) -> pyarrow.RecordBatch:
+        record_batch = self._pop()
+        if record_batch is not None:
+            return record_batch
+
+        with self.read_lock:
+            # A fill may have buffered the next batch while we waited for the lock
+            record_batch = self._pop()
+            if record_batch is not None:
+                return record_batch
+
+            if self.error:
+                raise self.error
+            if self.exhausted:
+                raise StopIteration
+
+            try:
+                return self._read_from_reader()
+            except StopIteration:
+                self.exhausted = True
+                raise
+
+    def close(self):
+        # Set closed first (fill() stops at its next batch) - and wait for any running fill() before calling this
+        self.closed = True
+        with self.buffer_lock:
+            self.buffer.clear()
+            self.buffered_bytes = 0
+            self._release_unbuffered()
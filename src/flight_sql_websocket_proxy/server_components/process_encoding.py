@@ -0,0 +1,180 @@
+import base64
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import pyarrow
+import pyarrow.ipc
+
+from ..config import logger
+from ..constants import SHARED_MEMORY_PATH, PROCESS_ENCODING_CALIBRATION_SIZES, PROCESS_ENCODING_CALIBRATION_ROUNDS, \
+    PROCESS_ENCODING_MAX_CPU_RATIO, PROCESS_ENCODING_MAX_LATENCY_RATIO
+from ..utils import get_ipc_write_options, get_dataframe_ipc_buffer, get_dataframe_results_as_ipc_base64_str
+
+
+def get_ipc_stream_size(schema: pyarrow.Schema,
+                        record_batches: list[pyarrow.RecordBatch]
+                        ) -> int:
+    # Counts the bytes - without writing them anywhere
+    sink = pyarrow.MockOutputStream()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for record_batch in record_batches:
+            writer.write_batch(record_batch)
+    return sink.size()
+
+
+def has_shared_memory_for(nbytes: int) -> bool:
+    # Writing past the end of a full shared memory filesystem kills the process (SIGBUS) - rather than raising
+    try:
+        return shutil.disk_usage(SHARED_MEMORY_PATH).free > nbytes
+    except OSError:
+        return False
+
+
+def encode_shared_ipc_base64(input_name: str,
+                             input_size: int,
+                             compression: str | None,
+                             compression_level: int | None
+                             ) -> tuple[str, int]:
+    """
+    Base64 encodes an Arrow IPC stream held in shared memory - in a process pool worker.  Compression (if any) is
+    applied here too - by re-writing the stream.
+
+    :return: The name of the shared memory block holding the base64 encoded stream (which the caller unlinks) - and
+             its size.
+    """
+    input_memory = SharedMemory(name=input_name)
+    try:
+        input_view = input_memory.buf[:input_size]
+        if compression in (None, "", "none"):
+            encoded = base64.b64encode(input_view)
+        else:
+            arrow_table = pyarrow.ipc.open_stream(pyarrow.py_buffer(input_view)).read_all()
+            encoded = base64.b64encode(get_dataframe_ipc_buffer(arrow_table,
+                                                                options=get_ipc_write_options(compression=compression,
+                                                                                              compression_level=compression_level
+                                                                                              )
+                                                                ))
+            del arrow_table
+        input_view.release()
+    finally:
+        input_memory.close()
+
+    output_memory = SharedMemory(create=True, size=max(len(encoded), 1))
+    output_memory.buf[:len(encoded)] = encoded
+    output_memory.close()
+    return output_memory.name, len(encoded)
+
+
+class ProcessEncoder:
+    """
+    Encodes fetch results (Arrow IPC - base64 encoded) in the server's process pool - so that the encoding does not
+    hold the GIL the event loop needs.  The record batches go to the worker through shared memory (one copy -
+    rather than pickling), and the encoded result comes back the same way.
+
+    Only results of at least min_bytes are worth the trip - smaller ones are encoded on the calling thread.  With
+    min_bytes 0, the threshold is measured (see calibrate) - and until it is, every result is encoded on threads.
+    """
+    def __init__(self,
+                 process_pool: ProcessPoolExecutor,
+                 process_pool_workers: int,
+                 min_bytes: int
+                 ):
+        self.process_pool = process_pool
+        # The max_workers the pool was created with - to start them all (see calibrate)
+        self.process_pool_workers = process_pool_workers
+        # None: not measured yet - -1: never use the process pool
+        self.min_bytes: int | None = min_bytes or None
+
+    def should_encode_in_process(self,
+                                 nbytes: int
+                                 ) -> bool:
+        return self.min_bytes is not None and 0 <= self.min_bytes <= nbytes
+
+    def encode_base64(self,
+                      schema: pyarrow.Schema,
+                      record_batches: list[pyarrow.RecordBatch],
+                      compression: str | None = None,
+                      compression_level: int | None = None
+                      ) -> str:
+        """
+        Encodes the batches as a base64 Arrow IPC stream in a process pool worker - blocking the calling thread
+        (not the event loop) until it is done.
+        """
+        input_size = get_ipc_stream_size(schema=schema, record_batches=record_batches)
+        # The encoded copy is a third bigger than the stream
+        if not has_shared_memory_for(input_size * 7 // 3):
+            raise MemoryError(f"Not enough shared memory (in: {SHARED_MEMORY_PATH}) to encode {input_size} byte(s) in a worker process")
+
+        input_memory = SharedMemory(create=True, size=max(input_size, 1))
+        try:
+            input_buffer = pyarrow.py_buffer(input_memory.buf)
+            with pyarrow.ipc.new_stream(pyarrow.FixedSizeBufferWriter(input_buffer), schema) as writer:
+                for record_batch in record_batches:
+                    writer.write_batch(record_batch)
+            del writer, input_buffer
+
+            output_name, output_size = self.process_pool.submit(encode_shared_ipc_base64,
+                                                                input_name=input_memory.name,
+                                                                input_size=input_size,
+                                                                compression=compression,
+                                                                compression_level=compression_level
+                                                                ).result()
+        finally:
+            input_memory.close()
+            input_memory.unlink()
+
+        output_memory = SharedMemory(name=output_name)
+        try:
+            output_view = output_memory.buf[:output_size]
+            encoded = str(output_view, "ascii")
+            output_view.release()
+        finally:
+            output_memory.close()
+            output_memory.unlink()
+
+        return encoded
+
+    def calibrate(self) -> int:
+        """
+        Measures the smallest result size worth encoding in a worker process - the size at which doing so costs
+        the calling process at most PROCESS_ENCODING_MAX_CPU_RATIO of the CPU time (which it would spend holding the
+        GIL) that encoding on a thread does, while adding no more than PROCESS_ENCODING_MAX_LATENCY_RATIO to the
+        latency.  Also starts the pool's workers - so that the first fetches do not wait for them.
+
+        :return: The threshold in bytes - or -1 if the pool never pays off on this machine.
+        """
+        def measure(func) -> tuple[float, float]:
+            # The best (wall, calling thread CPU) seconds of a few rounds
+            best_seconds = (float("inf"), float("inf"))
+            for _ in range(PROCESS_ENCODING_CALIBRATION_ROUNDS):
+                start_time, start_cpu_time = time.perf_counter(), time.thread_time()
+                func()
+                best_seconds = min(best_seconds, (time.perf_counter() - start_time, time.thread_time() - start_cpu_time))
+            return best_seconds
+
+        # Workers are started on demand - start them all now
+        for future in [self.process_pool.submit(time.sleep, 0) for _ in range(self.process_pool_workers)]:
+            future.result()
+
+        min_bytes = -1
+        measurements = []
+        for size in PROCESS_ENCODING_CALIBRATION_SIZES:
+            rows = max(size // 16, 1)
+            record_batch = pyarrow.record_batch([pyarrow.array(range(rows), type=pyarrow.int64()),
+                                                 pyarrow.array(range(rows), type=pyarrow.float64())
+                                                 ],
+                                                names=["id", "value"]
+                                                )
+            thread_seconds, thread_cpu_seconds = measure(lambda: get_dataframe_results_as_ipc_base64_str(df=pyarrow.Table.from_batches([record_batch])))
+            process_seconds, process_cpu_seconds = measure(lambda: self.encode_base64(schema=record_batch.schema, record_batches=[record_batch]))
+            measurements.append(f"{size}: thread {thread_seconds:.4f}s / cpu {thread_cpu_seconds:.4f}s - process {process_seconds:.4f}s / cpu {process_cpu_seconds:.4f}s")
+            if process_cpu_seconds <= thread_cpu_seconds * PROCESS_ENCODING_MAX_CPU_RATIO \
+                    and process_seconds <= thread_seconds * PROCESS_ENCODING_MAX_LATENCY_RATIO:
+                min_bytes = size
+                break
+
+        logger.info(msg=f"Process encoding threshold measured: {min_bytes} byte(s) - (bytes: thread / process seconds) {measurements}")
+        self.min_bytes = min_bytes
+        return min_bytes
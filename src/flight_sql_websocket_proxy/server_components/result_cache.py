@@ -0,0 +1,204 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import pyarrow
+
+# Quoted strings/identifiers and comments are matched first - so that we never touch what is inside them.  Strings
+# are standard ('...'), escape (E'...' - where a backslash escapes a quote) or dollar quoted ($$...$$ / $tag$...$tag$)
+SQL_TOKEN_PATTERN = re.compile(r"(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*'|'(?:[^']|'')*'|"
+                               r"(?<![\w$])\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$|"
+                               r"\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|\s+",
+                               re.S
+                               )
+DOLLAR_QUOTED_STRING_PATTERN = re.compile(r"\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*\$(?P=tag)\$", re.S)
+READ_ONLY_STATEMENT_PATTERN = re.compile(r"^\s*\(*\s*(SELECT|WITH|VALUES|TABLE|SHOW|DESCRIBE|EXPLAIN)\b", re.I)
+# Keywords which make an otherwise read-only looking statement write (or lock, or change session state)
+WRITE_KEYWORD_PATTERN = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|UPSERT|REPLACE|CREATE|DROP|ALTER|TRUNCATE|COPY|CALL|"
+                                   r"EXEC|EXECUTE|GRANT|REVOKE|INTO|LOCK|SET|ATTACH|DETACH|PRAGMA|INSTALL|LOAD|VACUUM)\b",
+                                   re.I
+                                   )
+# A number which is not part of an identifier (e.g. t1) or a parameter placeholder (e.g. $1) - with an optional fraction
+# and exponent
+NUMERIC_LITERAL_PATTERN = re.compile(r"(?<![\w.$])\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b|(?<![\w.$])\.\d+(?:[eE][-+]?\d+)?\b")
+
+
+def split_sql(sql: str) -> list[str]:
+    # As SQL_TOKEN_PATTERN.split would (if it had one group) - the text between the tokens and the tokens, alternately
+    parts = []
+    position = 0
+    for match in SQL_TOKEN_PATTERN.finditer(sql):
+        parts.extend((sql[position:match.start()], match.group()))
+        position = match.end()
+    parts.append(sql[position:])
+    return parts
+
+
+def is_string_literal(token: str) -> bool:
+    # The text between tokens can start with a $ too (e.g. a $1 placeholder) - a dollar quote is only ever a whole token
+    return token.startswith(("'", "E'", "e'")) or bool(DOLLAR_QUOTED_STRING_PATTERN.fullmatch(token))
+
+
+def normalize_sql(sql: str) -> str:
+    """
+    Strips comments, collapses runs of whitespace, and drops trailing semicolons - outside of quoted strings
+    and identifiers.  Case is kept as-is (it can matter inside quotes - and in some engines outside of them).
+    """
+    tokens = []
+    for token in split_sql(sql):
+        if token.startswith(("--", "/*")) or token.isspace():
+            tokens.append(" ")
+        elif token:
+            tokens.append(token)
+
+    return re.sub(r" +", " ", "".join(tokens)).strip().rstrip(";").strip()
+
+
+def redact_sql(sql: str) -> str:
+    """
+    Normalizes the SQL (see normalize_sql) - and replaces its string literals with '?' and its numeric literals
+    with 0, so that it keeps its shape (and still parses) without carrying any of the values it was run with.
+    """
+    tokens = []
+    for token in split_sql(normalize_sql(sql)):
+        if is_string_literal(token):
+            tokens.append("'?'")
+        elif token.startswith('"'):
+            tokens.append(token)
+        else:
+            tokens.append(NUMERIC_LITERAL_PATTERN.sub("0", token))
+
+    return "".join(tokens)
+
+
+def is_read_only_sql(sql: str) -> bool:
+    unquoted_sql = "".join(token for token in split_sql(normalize_sql(sql))
+                           if not is_string_literal(token) and not token.startswith('"')
+                           )
+    return bool(READ_ONLY_STATEMENT_PATTERN.match(unquoted_sql)) and not WRITE_KEYWORD_PATTERN.search(unquoted_sql)
+
+
+class CachedResult:
+    def __init__(self,
+                 schema: pyarrow.Schema,
+                 record_batches: list[pyarrow.RecordBatch]
+                 ):
+        self.schema = schema
+        self.record_batches = record_batches
+        self.nbytes = sum(record_batch.nbytes for record_batch in record_batches)
+        self.num_rows = sum(record_batch.num_rows for record_batch in record_batches)
+        self.created_at = time.monotonic()
+
+    def get_record_batch_reader(self) -> pyarrow.RecordBatchReader:
+        return pyarrow.RecordBatchReader.from_batches(self.schema, self.record_batches)
+
+
+class ResultCache:
+    """
+    A server-wide cache of query results (as Arrow record batches) - keyed by normalized SQL text, parameters and
+    user (so that a user is never served results they could not have run themselves).  Entries live for
+    ttl_seconds, and the least-recently-used entries are evicted to keep the total under max_bytes.  Results
+    are recorded as a query's fetches read them - so only results which were read to the end are cached.
+
+    It is used from both the event loop and the thread pool - so it guards its state with a (thread) lock.
+    """
+    def __init__(self,
+                 max_bytes: int,
+                 ttl_seconds: int
+                 ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self.entries: OrderedDict[str, CachedResult] = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypasses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @classmethod
+    def get_key(cls,
+                sql: str,
+                parameters: list | None,
+                user: str | None,
+                distribute: str = "false"
+                ) -> str:
+        # A distributed query's result comes from other servers (the shards) - it is not the same result
+        key_data = json.dumps(dict(sql=normalize_sql(sql),
+                                   parameters=parameters,
+                                   user=user,
+                                   distribute=distribute
+                                   ),
+                              default=str
+                              )
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def _remove(self,
+                key: str
+                ):
+        cached_result = self.entries.pop(key)
+        self.nbytes -= cached_result.nbytes
+
+    def get(self,
+            key: str
+            ) -> CachedResult | None:
+        with self.lock:
+            cached_result = self.entries.get(key)
+            if cached_result and time.monotonic() - cached_result.created_at > self.ttl_seconds:
+                self._remove(key)
+                cached_result = None
+
+            if cached_result is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cached_result
+
+    def put(self,
+            key: str,
+            schema: pyarrow.Schema,
+            record_batches: list[pyarrow.RecordBatch]
+            ):
+        cached_result = CachedResult(schema=schema,
+                                     record_batches=record_batches
+                                     )
+        if cached_result.nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            while self.entries and self.nbytes + cached_result.nbytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+            self.entries[key] = cached_result
+            self.nbytes += cached_result.nbytes
+
+    def record_bypass(self):
+        with self.lock:
+            self.bypasses += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(enabled=self.enabled,
+                        entries=len(self.entries),
+                        bytes=self.nbytes,
+                        max_bytes=self.max_bytes,
+                        hits=self.hits,
+                        misses=self.misses,
+                        evictions=self.evictions,
+                        bypasses=self.bypasses
+                        )
@@ -0,0 +1,91 @@
+import bisect
+import os
+import tempfile
+
+import pyarrow
+
+from ..config import logger
+
+
+class ResultSpool:
+    """
+    A local, random-access copy of a query's results - for scrollable cursors.
+
+    Batches are appended to a temporary file as they are read from the backend, each one as a self-contained
+    Arrow IPC stream segment (so dictionary-encoded columns need no shared state), and indexed by their first
+    row.  Rows are read back as zero-copy slices of a memory map of the file.
+    """
+    def __init__(self,
+                 schema: pyarrow.Schema,
+                 directory: str = None
+                 ):
+        self.schema = schema
+        file_descriptor, self.path = tempfile.mkstemp(prefix="flight-sql-websocket-proxy-spool-",
+                                                      suffix=".arrows",
+                                                      dir=directory
+                                                      )
+        os.close(file_descriptor)
+        self.sink = pyarrow.OSFile(self.path, mode="wb")
+
+        # Per batch: its first row - and the location of its segment in the file
+        self.batch_row_offsets: list[int] = []
+        self.batch_locations: list[tuple[int, int]] = []
+        self.num_rows = 0
+        self.nbytes = 0
+        self.exhausted = False
+        self.mapped_buffer: pyarrow.Buffer | None = None
+
+    def append(self,
+               record_batch: pyarrow.RecordBatch
+               ):
+        segment_start = self.sink.tell()
+        with pyarrow.ipc.new_stream(sink=self.sink, schema=self.schema) as writer:
+            writer.write_batch(record_batch)
+
+        self.batch_row_offsets.append(self.num_rows)
+        self.batch_locations.append((segment_start, self.sink.tell() - segment_start))
+        self.num_rows += record_batch.num_rows
+        self.nbytes += record_batch.nbytes
+
+    def get_batch(self,
+                  index: int
+                  ) -> pyarrow.RecordBatch:
+        segment_start, segment_length = self.batch_locations[index]
+        if self.mapped_buffer is None or segment_start + segment_length > self.mapped_buffer.size:
+            # The file has grown since we mapped it - batches read from the old map keep it alive
+            self.sink.flush()
+            with pyarrow.memory_map(self.path, "r") as source:
+                self.mapped_buffer = source.read_buffer()
+
+        return pyarrow.ipc.open_stream(self.mapped_buffer.slice(segment_start, segment_length)).read_next_batch()
+
+    def read_rows(self,
+                  offset: int,
+                  limit: int = None
+                  ) -> list[pyarrow.RecordBatch]:
+        """
+        :param offset: The first row to read.
+        :param limit: The most rows to read - None reads to the end of what has been spooled.
+        :return: Zero-copy slices of the spooled batches which cover the rows.
+        """
+        end_row = self.num_rows if limit is None else min(offset + limit, self.num_rows)
+        record_batches = []
+        index = max(bisect.bisect_right(self.batch_row_offsets, offset) - 1, 0)
+        while offset < end_row and index < len(self.batch_row_offsets):
+            record_batch = self.get_batch(index)
+            batch_offset = offset - self.batch_row_offsets[index]
+            length = min(record_batch.num_rows - batch_offset, end_row - offset)
+            record_batches.append(record_batch.slice(offset=batch_offset, length=length))
+            offset += length
+            index += 1
+
+        return record_batches
+
+    def close(self):
+        self.mapped_buffer = None
+        if not self.sink.closed:
+            self.sink.close()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logger.warning(msg=f"Failed to remove spool file: '{self.path}' - error: {str(e)}")
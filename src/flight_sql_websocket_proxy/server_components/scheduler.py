@@ -0,0 +1,151 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import defaultdict
+
+from .common import QueryPriority
+from ..constants import QUERY_PRIORITY_WEIGHTS
+
+
+class QueryQueueFullError(Exception):
+    pass
+
+
+class QueuedQuery:
+    def __init__(self,
+                 user: str,
+                 virtual_finish_time: float
+                 ):
+        self.user = user
+        self.virtual_finish_time = virtual_finish_time
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class QueryScheduler:
+    """
+    Admission control for backend query execution.
+
+    At most max_concurrent_queries queries execute at once (and at most max_queries_per_user for any one user).
+    Queries waiting for a slot are dispatched in weighted fair queuing order across users: each queued query is
+    tagged with a virtual finish time - its user's previous tag (or the current virtual time, if later) plus
+    1 / the weight of its priority class - and the lowest tag whose user is under their limit runs next.  So a
+    user with hundreds of queued queries cannot starve a user with one, and higher priority classes get a
+    proportionally larger share.  Once max_queue_depth queries are waiting, new ones are rejected right away.
+    """
+    def __init__(self,
+                 max_concurrent_queries: int,
+                 max_queries_per_user: int,
+                 max_queue_depth: int
+                 ):
+        self.max_concurrent_queries = max_concurrent_queries
+        self.max_queries_per_user = max_queries_per_user
+        self.max_queue_depth = max_queue_depth
+
+        self.queue: list[tuple[float, int, QueuedQuery]] = []
+        self.sequence = itertools.count()
+        self.virtual_time: float = 0.0
+        self.user_virtual_finish_times: dict[str, float] = {}
+        self.running = 0
+        self.running_per_user: dict[str, int] = defaultdict(int)
+        self.rejected = 0
+
+    def _can_run(self,
+                 user: str
+                 ) -> bool:
+        return self.running < self.max_concurrent_queries and self.running_per_user[user] < self.max_queries_per_user
+
+    def _start(self,
+               user: str
+               ):
+        self.running += 1
+        self.running_per_user[user] += 1
+
+    def _dispatch(self):
+        skipped = []
+        while self.queue and self.running < self.max_concurrent_queries:
+            entry = heapq.heappop(self.queue)
+            queued_query = entry[2]
+            if queued_query.future.done():
+                # The waiter went away
+                continue
+            if not self._can_run(queued_query.user):
+                skipped.append(entry)
+                continue
+
+            self.virtual_time = max(self.virtual_time, queued_query.virtual_finish_time)
+            self._start(queued_query.user)
+            queued_query.future.set_result(None)
+
+        for entry in skipped:
+            heapq.heappush(self.queue, entry)
+
+    def _remove(self,
+                queued_query: QueuedQuery
+                ):
+        self.queue = [entry for entry in self.queue if entry[2] is not queued_query]
+        heapq.heapify(self.queue)
+
+    async def acquire(self,
+                      user: str,
+                      priority: QueryPriority = QueryPriority.NORMAL
+                      ) -> float:
+        """
+        Waits for a slot to execute a query - the caller must call release() when the query is done executing.
+
+        :param user: The user running the query.
+        :param priority: The query's priority class.
+        :return: The time (in seconds) the query spent queued.
+        :raises QueryQueueFullError: If the queue is already at max_queue_depth.
+        """
+        start_time = time.perf_counter()
+        if not self.queue and self._can_run(user):
+            self._start(user)
+            return 0.0
+
+        if len(self.queue) >= self.max_queue_depth:
+            self.rejected += 1
+            raise QueryQueueFullError(f"The query queue is full ({self.max_queue_depth} queries waiting) - try again later")
+
+        virtual_finish_time = max(self.virtual_time, self.user_virtual_finish_times.get(user, 0.0)) + (1 / QUERY_PRIORITY_WEIGHTS[QueryPriority(priority)])
+        self.user_virtual_finish_times[user] = virtual_finish_time
+
+        queued_query = QueuedQuery(user=user,
+                                   virtual_finish_time=virtual_finish_time
+                                   )
+        heapq.heappush(self.queue, (virtual_finish_time, next(self.sequence), queued_query))
+        # A slot may be free - just not for this query's place in line
+        self._dispatch()
+
+        try:
+            await queued_query.future
+        except asyncio.CancelledError:
+            if queued_query.future.done() and not queued_query.future.cancelled():
+                # We were handed a slot as we were cancelled - pass it on
+                self.release(user)
+            else:
+                # E.g. the client went away - a dead entry would still count against max_queue_depth (and keep
+                # the fast path above off)
+                self._remove(queued_query)
+            raise
+
+        return time.perf_counter() - start_time
+
+    def release(self,
+                user: str
+                ):
+        self.running -= 1
+        self.running_per_user[user] -= 1
+        if not self.running_per_user[user]:
+            del self.running_per_user[user]
+            if not any(entry[2].user == user for entry in self.queue):
+                # The user has no backlog - their tags start from the current virtual time next time
+                self.user_virtual_finish_times.pop(user, None)
+
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return dict(running=self.running,
+                    queued=sum(1 for entry in self.queue if not entry[2].future.done()),
+                    rejected=self.rejected
+                    )
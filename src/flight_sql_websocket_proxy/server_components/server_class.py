@@ -2,27 +2,51 @@ from __future__ import annotations
 
 import asyncio
 import functools
+import multiprocessing
+from http import HTTPStatus
 import platform
 import re
+import signal
 import ssl
 import sys
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
+from urllib.parse import urlsplit
 
 import websockets
 from munch import Munch
 from websockets.frames import CloseCode
 import adbc_driver_flightsql
 
+from .connection_pool import ConnectionPool
+from .memory_budget import MemoryBudget
+from .process_encoding import ProcessEncoder
+from .metrics import ProxyMetrics, merge_snapshots, render_snapshot
+from .result_cache import ResultCache
+from .scheduler import QueryScheduler
+from .supervisor import get_worker_metrics_path, write_metrics_snapshot, read_metrics_snapshots
 from .server_client import Client
-from .common import ARROW_FLIGHT_SQL_WEBSOCKET_PROXY_SERVER_VERSION
+from .workload_capture import WorkloadCapture
+from .backend_router import BackendRouter
+from .common import ARROW_FLIGHT_SQL_WEBSOCKET_PROXY_SERVER_VERSION, ResultFormat, CaptureSql, DistributeMode, \
+    RoutingPolicy
+from .distributed import check_distributed_dependencies
 from ..config import logger
+from ..security import JwksManager, UserAuthenticator
+from ..constants import DEFAULT_RESULT_MEMORY_BUDGET_FRACTION, DEFAULT_CAPTURE_SQL, DEFAULT_DISTRIBUTE_MODE, \
+    DEFAULT_BACKEND_ROUTING_POLICY, DEFAULT_BACKEND_HEALTH_CHECK_INTERVAL, DEFAULT_BACKEND_EJECTION_THRESHOLD, \
+    DEFAULT_BACKEND_EJECTION_TIME, DEFAULT_BACKEND_MAX_RETRIES, DEFAULT_MAX_PARTITION_READERS, DEFAULT_SERVER_WORKERS, \
+    WORKER_METRICS_PUBLISH_INTERVAL, DEFAULT_PROCESS_ENCODING_MIN_BYTES, DEFAULT_AUTHENTICATION_CACHE_MAX_ENTRIES, \
+    DEFAULT_TOKEN_CACHE_MAX_TTL, DEFAULT_USER_CACHE_TTL, PROCESS_ENCODING_CALIBRATION_DELAY, METRICS_PATH
+from ..utils import get_memory_limit
 
 
 class Server:
     def __init__(self,
                  port: int,
                  base_path: str,
+                 metrics_port: int,
+                 metrics_host: str,
                  tls_certfile: Path,
                  tls_keyfile: Path,
                  database_server_uri: str,
@@ -36,10 +60,49 @@ class Server:
                  max_process_workers: int,
                  websocket_ping_timeout: int,
                  max_websocket_message_size: int,
+                 websocket_fragment_size: int,
                  client_default_fetch_size: int,
+                 default_result_format: str,
+                 adaptive_fetch_target_bytes: int,
+                 database_pool_min_size: int,
+                 database_pool_max_size: int,
+                 database_pool_idle_timeout: int,
+                 database_pool_health_check_interval: int,
+                 database_pool_checkout_timeout: int,
+                 max_session_concurrency: int,
+                 max_concurrent_queries: int,
+                 max_queries_per_user: int,
+                 max_query_queue_depth: int,
+                 result_cache_max_bytes: int,
+                 result_cache_ttl: int,
+                 prefetch_batches: int,
+                 prefetch_bytes: int,
+                 result_memory_budget: int,
+                 spill_directory: str,
+                 process_encoding_min_bytes: int = DEFAULT_PROCESS_ENCODING_MIN_BYTES,
+                 max_partition_readers: int = DEFAULT_MAX_PARTITION_READERS,
+                 database_replica_uris: list[str] | None = None,
+                 backend_routing_policy: str = DEFAULT_BACKEND_ROUTING_POLICY,
+                 backend_health_check_interval: int = DEFAULT_BACKEND_HEALTH_CHECK_INTERVAL,
+                 backend_ejection_threshold: int = DEFAULT_BACKEND_EJECTION_THRESHOLD,
+                 backend_ejection_time: int = DEFAULT_BACKEND_EJECTION_TIME,
+                 backend_max_retries: int = DEFAULT_BACKEND_MAX_RETRIES,
+                 database_shard_uris: list[str] | None = None,
+                 default_distribute_mode: str = DEFAULT_DISTRIBUTE_MODE,
+                 capture_file: str | None = None,
+                 capture_sql: str = DEFAULT_CAPTURE_SQL,
+                 authentication_bypass_user: str | None = None,
+                 authentication_cache_max_entries: int = DEFAULT_AUTHENTICATION_CACHE_MAX_ENTRIES,
+                 token_cache_max_ttl: int = DEFAULT_TOKEN_CACHE_MAX_TTL,
+                 user_cache_ttl: int = DEFAULT_USER_CACHE_TTL,
+                 workers: int = DEFAULT_SERVER_WORKERS,
+                 worker_id: int | None = None,
+                 worker_metrics_directory: str | None = None
                  ):
         self.port = port
         self.base_path = base_path
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
         self.tls_certfile = tls_certfile
         self.tls_keyfile = tls_keyfile
         self.database_server_uri = database_server_uri
@@ -50,10 +113,61 @@ class Server:
         self.clerk_secret_key = clerk_secret_key
         self.jwks_url = jwks_url
         self.session_token_issuer = session_token_issuer
+        self.authentication_cache_max_entries = authentication_cache_max_entries
+        self.token_cache_max_ttl = token_cache_max_ttl
+        self.user_cache_ttl = user_cache_ttl
         self.max_process_workers = max_process_workers
         self.websocket_ping_timeout = websocket_ping_timeout
         self.max_websocket_message_size = max_websocket_message_size
+        self.websocket_fragment_size = websocket_fragment_size
         self.client_default_fetch_size = client_default_fetch_size
+        self.default_result_format = ResultFormat(default_result_format)
+        self.adaptive_fetch_target_bytes = adaptive_fetch_target_bytes
+        self.database_pool_min_size = database_pool_min_size
+        self.database_pool_max_size = database_pool_max_size
+        self.database_pool_idle_timeout = database_pool_idle_timeout
+        self.database_pool_health_check_interval = database_pool_health_check_interval
+        self.database_pool_checkout_timeout = database_pool_checkout_timeout
+        self.max_session_concurrency = max_session_concurrency
+        self.max_concurrent_queries = max_concurrent_queries
+        self.max_queries_per_user = max_queries_per_user
+        self.max_query_queue_depth = max_query_queue_depth
+        self.result_cache_max_bytes = result_cache_max_bytes
+        self.result_cache_ttl = result_cache_ttl
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_bytes = prefetch_bytes
+        self.workers = workers
+        self.worker_id = worker_id
+        self.worker_metrics_directory = worker_metrics_directory
+        # 0 means: derive the budget from the memory we have - each of the --workers processes getting its share
+        self.result_memory_budget = result_memory_budget or int(get_memory_limit() * DEFAULT_RESULT_MEMORY_BUDGET_FRACTION / self.workers)
+        self.spill_directory = spill_directory
+        self.process_encoding_min_bytes = process_encoding_min_bytes
+        self.max_partition_readers = max_partition_readers
+        # The database server and its replicas - equivalent backends which queries are routed across
+        self.database_backend_uris = list(dict.fromkeys([self.database_server_uri] +
+                                                        [replica_uri.strip() for replica_uri in database_replica_uris or [] if replica_uri.strip()]))
+        self.backend_routing_policy = RoutingPolicy(backend_routing_policy)
+        self.backend_health_check_interval = backend_health_check_interval
+        self.backend_ejection_threshold = backend_ejection_threshold
+        self.backend_ejection_time = backend_ejection_time
+        self.backend_max_retries = backend_max_retries
+        self.database_shard_uris = [shard_uri.strip() for shard_uri in database_shard_uris or [] if shard_uri.strip()]
+        self.default_distribute_mode = DistributeMode(default_distribute_mode)
+        if self.database_shard_uris:
+            # Fail at startup - rather than on the first distributed query
+            check_distributed_dependencies()
+        elif self.default_distribute_mode != DistributeMode.FALSE:
+            logger.warning(f"Default distribute mode: '{self.default_distribute_mode}' is ignored - no database shard URIs are configured")
+            self.default_distribute_mode = DistributeMode.FALSE
+        self.capture_file = capture_file
+        if self.capture_file and self.worker_id is not None:
+            # Each worker captures its own sessions - to a file of its own
+            capture_path = Path(self.capture_file)
+            self.capture_file = capture_path.with_name(f"{capture_path.stem}.worker-{self.worker_id}{capture_path.suffix}").as_posix()
+        self.capture_sql = CaptureSql(capture_sql)
+        # Test mode (for benchmarks) - every client is authenticated as this user, without checking its token
+        self.authentication_bypass_user = authentication_bypass_user
 
         self.lock = asyncio.Lock()
         self.client_connections = Munch()
@@ -68,24 +182,130 @@ class Server:
         # Asynch stuff
         self.event_loop = asyncio.get_event_loop()
         self.event_loop.set_default_executor(ThreadPoolExecutor())
-        self.process_pool = ProcessPoolExecutor(max_workers=self.max_process_workers)
+        # Spawned - b/c forking a process with running database driver threads is not safe.  The --workers processes
+        # share the CPUs - so each gets its share of the encoding processes
+        self.process_pool_workers = max(self.max_process_workers // self.workers, 1)
+        self.process_pool = ProcessPoolExecutor(max_workers=self.process_pool_workers,
+                                                mp_context=multiprocessing.get_context("spawn")
+                                                )
         self.thread_pool = ThreadPoolExecutor(max_workers=self.max_process_workers)
         self.bound_handler = functools.partial(self.connection_handler)
+        # Set (e.g. by SIGTERM) to stop serving - and shut down
+        self.stopping = asyncio.Event()
+
+        # The public keys session tokens are signed with - kept fresh in the background
+        self.jwks_manager = JwksManager(jwks_url=self.jwks_url)
+
+        # Verifies session tokens and looks up their users - caching both across sessions
+        self.user_authenticator = UserAuthenticator(clerk_secret_key=self.clerk_secret_key,
+                                                    jwks_manager=self.jwks_manager,
+                                                    session_token_issuer=self.session_token_issuer,
+                                                    cache_max_entries=self.authentication_cache_max_entries,
+                                                    token_cache_max_ttl=self.token_cache_max_ttl,
+                                                    user_cache_ttl=self.user_cache_ttl
+                                                    )
+
+        # Backend connections - shared by all clients
+        self.connection_pool = ConnectionPool(server=self,
+                                              min_size=self.database_pool_min_size,
+                                              max_size=self.database_pool_max_size,
+                                              idle_timeout=self.database_pool_idle_timeout,
+                                              health_check_interval=self.database_pool_health_check_interval,
+                                              checkout_timeout=self.database_pool_checkout_timeout
+                                              )
+
+        # Routes queries across the database server and its replicas - and takes failing ones out of rotation
+        self.backend_router = BackendRouter(server=self,
+                                            backend_uris=self.database_backend_uris,
+                                            policy=self.backend_routing_policy,
+                                            health_check_interval=self.backend_health_check_interval,
+                                            ejection_threshold=self.backend_ejection_threshold,
+                                            ejection_seconds=self.backend_ejection_time,
+                                            max_retries=self.backend_max_retries
+                                            )
+
+        # Admission control for query execution - shared by all clients
+        self.query_scheduler = QueryScheduler(max_concurrent_queries=self.max_concurrent_queries,
+                                              max_queries_per_user=self.max_queries_per_user,
+                                              max_queue_depth=self.max_query_queue_depth
+                                              )
+
+        # Results of repeated read-only queries - shared by all clients
+        self.result_cache = ResultCache(max_bytes=self.result_cache_max_bytes,
+                                        ttl_seconds=self.result_cache_ttl
+                                        )
+
+        # Query results buffered in memory (by all clients) - beyond this, fetches spill to disk
+        self.memory_budget = MemoryBudget(limit_bytes=self.result_memory_budget)
+
+        # Encodes big results in the process pool - rather than under our GIL
+        self.process_encoder = ProcessEncoder(process_pool=self.process_pool,
+                                              process_pool_workers=self.process_pool_workers,
+                                              min_bytes=self.process_encoding_min_bytes
+                                              )
+
+        # Served (in Prometheus text format) at /metrics - on the metrics port (if any)
+        self.metrics = ProxyMetrics()
+        self.metrics.register_server_gauges(server=self)
+
+        # Each session's requests (and response sizes) - for replaying the workload later
+        self.workload_capture: WorkloadCapture | None = None
+        if self.capture_file:
+            self.workload_capture = WorkloadCapture(path=self.capture_file,
+                                                    capture_sql=self.capture_sql
+                                                    )
 
     async def run(self):
         logger.info(
             msg=(f"Starting Arrow Flight SQL Websocket Proxy Server - by GizmoData™ - version: {self.version} - (\n"
                  f" port: {self.port},\n"
                  f" base_path: {self.base_path},\n"
+                 f" metrics_port: {self.metrics_port},\n"
+                 f" metrics_host: {self.metrics_host},\n"
                  f" tls_certfile: {self.tls_certfile.as_posix() if self.tls_certfile else 'None'},\n"
                  f" tls_keyfile: {self.tls_keyfile.as_posix() if self.tls_keyfile else 'None'},\n"
                  f" database_server_uri: {self.database_server_uri},\n"
                  f" database_tls_skip_verify: {self.database_tls_skip_verify},\n"
                  f" clerk_api_url: {self.clerk_api_url},\n"
+                 f" authentication_cache_max_entries: {self.authentication_cache_max_entries},\n"
+                 f" token_cache_max_ttl: {self.token_cache_max_ttl},\n"
+                 f" user_cache_ttl: {self.user_cache_ttl},\n"
                  f" max_process_workers: {self.max_process_workers},\n"
                  f" websocket_ping_timeout: {self.websocket_ping_timeout},\n"
-                 f" max_websocket_message_size: {self.max_websocket_message_size}\n"
-                 f" client_default_fetch_size: {self.client_default_fetch_size}\n"
+                 f" max_websocket_message_size: {self.max_websocket_message_size},\n"
+                 f" websocket_fragment_size: {self.websocket_fragment_size},\n"
+                 f" client_default_fetch_size: {self.client_default_fetch_size},\n"
+                 f" default_result_format: {self.default_result_format},\n"
+                 f" adaptive_fetch_target_bytes: {self.adaptive_fetch_target_bytes},\n"
+                 f" database_pool_min_size: {self.database_pool_min_size},\n"
+                 f" database_pool_max_size: {self.database_pool_max_size},\n"
+                 f" database_pool_idle_timeout: {self.database_pool_idle_timeout},\n"
+                 f" database_pool_health_check_interval: {self.database_pool_health_check_interval},\n"
+                 f" database_pool_checkout_timeout: {self.database_pool_checkout_timeout},\n"
+                 f" max_session_concurrency: {self.max_session_concurrency},\n"
+                 f" max_concurrent_queries: {self.max_concurrent_queries},\n"
+                 f" max_queries_per_user: {self.max_queries_per_user},\n"
+                 f" max_query_queue_depth: {self.max_query_queue_depth},\n"
+                 f" result_cache_max_bytes: {self.result_cache_max_bytes},\n"
+                 f" result_cache_ttl: {self.result_cache_ttl},\n"
+                 f" prefetch_batches: {self.prefetch_batches},\n"
+                 f" prefetch_bytes: {self.prefetch_bytes},\n"
+                 f" result_memory_budget: {self.result_memory_budget},\n"
+                 f" spill_directory: {self.spill_directory},\n"
+                 f" process_encoding_min_bytes: {self.process_encoding_min_bytes},\n"
+                 f" max_partition_readers: {self.max_partition_readers},\n"
+                 f" database_backend_uris: {self.database_backend_uris},\n"
+                 f" backend_routing_policy: {self.backend_routing_policy},\n"
+                 f" backend_health_check_interval: {self.backend_health_check_interval},\n"
+                 f" backend_ejection_threshold: {self.backend_ejection_threshold},\n"
+                 f" backend_ejection_time: {self.backend_ejection_time},\n"
+                 f" backend_max_retries: {self.backend_max_retries},\n"
+                 f" database_shard_uris: {self.database_shard_uris or 'None'},\n"
+                 f" default_distribute_mode: {self.default_distribute_mode},\n"
+                 f" capture_file: {self.capture_file or 'None'},\n"
+                 f" capture_sql: {self.capture_sql},\n"
+                 f" workers: {self.workers},\n"
+                 f" worker_id: {self.worker_id if self.worker_id is not None else 'None'}\n"
                  f")"
                  )
         )
@@ -95,14 +315,124 @@ class Server:
         logger.info(f"Using ADBC Flight SQL driver version: {adbc_driver_flightsql.__version__}")
         logger.info(f"TLS: {'Enabled - clients should connect with protocol/scheme wss://' if self.ssl_context else 'Disabled - clients should connect with protocol/scheme ws://'}")
 
-        async with websockets.serve(handler=self.bound_handler,
-                                    host="0.0.0.0",
-                                    port=self.port,
-                                    max_size=self.max_websocket_message_size,
-                                    ping_timeout=self.websocket_ping_timeout,
-                                    ssl=self.ssl_context
-                                    ):
-            await asyncio.Future()  # run forever
+        if self.authentication_bypass_user:
+            logger.warning(f"Authentication is BYPASSED - all clients are authenticated as user: '{self.authentication_bypass_user}' - this mode is for testing only!")
+        else:
+            await self.jwks_manager.start()
+
+        await self.connection_pool.start()
+        logger.info(f"Database connection pool started - {self.connection_pool.stats()}")
+        await self.backend_router.start()
+        background_tasks = []
+        if self.process_encoding_min_bytes == 0:
+            background_tasks.append(asyncio.create_task(self.calibrate_process_encoding()))
+        if self.worker_metrics_directory:
+            background_tasks.append(asyncio.create_task(self.publish_metrics()))
+        if self.workload_capture:
+            logger.warning(f"Capturing the workload to file: '{self.capture_file}' - SQL: {self.capture_sql}")
+
+        try:
+            # SIGINT (Ctrl-C) cancels us - SIGTERM stops us the same way
+            self.event_loop.add_signal_handler(signal.SIGTERM, self.stop)
+        except (NotImplementedError, RuntimeError) as e:
+            logger.warning(f"SIGTERM will not shut the server down gracefully - error: {str(e)}")
+
+        try:
+            async with websockets.serve(handler=self.bound_handler,
+                                        host="0.0.0.0",
+                                        port=self.port,
+                                        max_size=self.max_websocket_message_size,
+                                        ping_timeout=self.websocket_ping_timeout,
+                                        ssl=self.ssl_context,
+                                        # Workers share the port - the kernel balances connections across them
+                                        reuse_port=self.worker_id is not None
+                                        ):
+                metrics_server = await self.serve_metrics()
+                try:
+                    await self.stopping.wait()
+                finally:
+                    if metrics_server:
+                        metrics_server.close()
+                        await metrics_server.wait_closed()
+                # Leaving the block stops serving - and closes the client connections (their sessions close their
+                # queries, and hand their database connections back)
+                logger.info("Stopping the server")
+        finally:
+            for background_task in background_tasks:
+                background_task.cancel()
+            await self.backend_router.close()
+            await self.connection_pool.close()
+            logger.info(f"Database connection pool closed - {self.connection_pool.stats()}")
+            await self.user_authenticator.close()
+            await self.jwks_manager.close()
+            if self.workload_capture:
+                self.workload_capture.close()
+                logger.info(f"Workload capture closed - {self.workload_capture.stats()}")
+            # Its processes would outlive us otherwise
+            self.process_pool.shutdown(wait=True, cancel_futures=True)
+            self.thread_pool.shutdown(wait=True, cancel_futures=True)
+            logger.info("Process and thread pools shut down")
+
+    def stop(self):
+        self.stopping.set()
+
+    async def calibrate_process_encoding(self):
+        # Results are encoded on threads until this is done.  It waits out the startup (e.g. clients reconnecting after
+        # a deploy) - and runs on a thread of its own, rather than on one of the clients'
+        try:
+            await asyncio.sleep(PROCESS_ENCODING_CALIBRATION_DELAY)
+            await asyncio.to_thread(self.process_encoder.calibrate)
+        except Exception as e:
+            logger.error(msg=f"Failed to measure the process encoding threshold - results will be encoded on threads - error: {str(e)}")
+            self.process_encoder.min_bytes = -1
+
+    @property
+    def worker_metrics_path(self) -> Path:
+        return get_worker_metrics_path(metrics_directory=self.worker_metrics_directory, worker_id=self.worker_id)
+
+    async def publish_metrics(self):
+        # For the other workers' scrapes (and for the supervisor - if we exit)
+        while True:
+            write_metrics_snapshot(path=self.worker_metrics_path, snapshot=self.metrics.snapshot())
+            await asyncio.sleep(WORKER_METRICS_PUBLISH_INTERVAL)
+
+    def render_metrics(self) -> str:
+        if not self.worker_metrics_directory:
+            return self.metrics.render()
+
+        # Our own metrics are current - the other workers' (and the supervisor's) are as last published
+        return render_snapshot(merge_snapshots([self.metrics.snapshot()] +
+                                               read_metrics_snapshots(metrics_directory=self.worker_metrics_directory,
+                                                                      exclude=self.worker_metrics_path
+                                                                      )))
+
+    async def serve_metrics(self) -> websockets.Server | None:
+        # A listener of its own - so that the (unauthenticated) metrics are not served on the public websocket port
+        if not self.metrics_port:
+            return None
+
+        metrics_server = await websockets.serve(handler=self.metrics_connection_handler,
+                                                host=self.metrics_host,
+                                                port=self.metrics_port,
+                                                process_request=self.process_metrics_request,
+                                                reuse_port=self.worker_id is not None
+                                                )
+        logger.info(f"Serving metrics at: http://{self.metrics_host}:{self.metrics_port}{METRICS_PATH}")
+        return metrics_server
+
+    def process_metrics_request(self, connection, request):
+        # Every request is answered as plain HTTP - before (instead of) a websocket handshake
+        if urlsplit(request.path).path != METRICS_PATH:
+            return connection.respond(HTTPStatus.NOT_FOUND, "Not Found\n")
+
+        response = connection.respond(HTTPStatus.OK, self.render_metrics())
+        del response.headers["Content-Type"]
+        response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+        return response
+
+    async def metrics_connection_handler(self, websocket):
+        # process_metrics_request answers every request - so no websocket is ever opened on the metrics port
+        await websocket.close()
 
     async def connection_handler(self, websocket):
         if websocket.request.path == f"{self.base_path.rstrip('/')}/client":
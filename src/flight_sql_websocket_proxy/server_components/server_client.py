@@ -1,19 +1,27 @@
+import asyncio
 import json
 import platform
+import time
+from contextvars import ContextVar
 from typing import TYPE_CHECKING
 
 import websockets
-from adbc_driver_flightsql import dbapi, DatabaseOptions
 from munch import munchify, Munch
 from websockets.frames import CloseCode
 
+from .common import ResultFormat, FetchSizing, QueryPriority, PartitionOrder
+from .connection_pool import PooledConnection
 from .server_query import Query
+from .workload_capture import CaptureSession
 from ..config import logger
-from ..security import authenticate_user
+from ..utils import get_ipc_write_options, get_payload_size
 
 if TYPE_CHECKING:
     from .server_class import Server
 
+# The client-supplied ID of the request being handled - each request runs in its own task (and so its own context)
+request_id_context: ContextVar[str | None] = ContextVar("request_id", default=None)
+
 
 class Client:
     def __init__(self,
@@ -25,17 +33,59 @@ class Client:
         self.client_id = self.websocket_connection.id
         self.authenticated = False
         self.user = None
-        self.database_connection = None
+        self.autocommit = True
+        self.database_connection: PooledConnection | None = None
+        self.result_format = ResultFormat(self.server.default_result_format)
+        self.compression: str | None = None
+        self.compression_level: int | None = None
         self.queries = {}
+        self.send_lock = asyncio.Lock()
+        self.request_semaphore = asyncio.Semaphore(self.server.max_session_concurrency)
+        self.request_tasks: set[asyncio.Task] = set()
+        # Cursors on a pinned (non-autocommit) connection take turns using it
+        self.database_connection_lock = asyncio.Lock()
+        self.capture_session: CaptureSession | None = None
+        if self.server.workload_capture:
+            self.capture_session = self.server.workload_capture.open_session()
+
+    async def send_message(self,
+                           message_dict: dict,
+                           binary_payloads: list = None
+                           ):
+        """
+        Sends a JSON message to the client - optionally followed by one or more binary frames.  If the message is
+        in response to a request which carried a request_id, the message echoes it.
+
+        :param message_dict: The message to send as a JSON text frame.
+        :param binary_payloads: Optional binary messages to send immediately after the JSON message - each one is
+                                either a bytes-like object (bytes, memoryview, etc.) or an iterable of bytes-like
+                                fragments, which is sent as one fragmented message.
+        """
+        request_id = request_id_context.get()
+        if request_id is not None and "request_id" not in message_dict:
+            message_dict = dict(message_dict, request_id=request_id)
+
+        # Hold the lock so that concurrent requests and background streams cannot interleave their frames between a header and its binary frames
+        message_json = json.dumps(message_dict)
+        async with self.send_lock:
+            await self.websocket_connection.send(message_json)
+            for binary_payload in binary_payloads or []:
+                await self.websocket_connection.send(binary_payload)
+
+        wire_bytes = len(message_json) + sum(get_payload_size(binary_payload) for binary_payload in binary_payloads or [])
+        self.server.metrics.bytes_sent.inc(wire_bytes)
+        if self.capture_session:
+            self.capture_session.record_response(message_dict=message_dict,
+                                                 wire_bytes=wire_bytes
+                                                 )
 
     async def get_user(self, token: str):
+        if self.server.authentication_bypass_user:
+            return self.server.authentication_bypass_user, None
+
         try:
             # Verify the token - and get the username
-            authenticated_user = await authenticate_user(oauth2_secret_key=self.server.clerk_secret_key,
-                                                         jwks_url=self.server.jwks_url,
-                                                         session_token_issuer=self.server.session_token_issuer,
-                                                         user_token=token
-                                                         )
+            authenticated_user = await self.server.user_authenticator.authenticate(user_token=token)
             return authenticated_user, None
         except Exception as e:
             logger.exception(msg=str(e))
@@ -44,7 +94,27 @@ class Client:
     async def authenticate_client(self,
                                   message: Munch
                                   ):
+        try:
+            if message.get("result_format", self.result_format) not in list(ResultFormat):
+                raise ValueError(f"Invalid result format: '{message.result_format}' - must be one of: {[result_format.value for result_format in ResultFormat]}")
+            # Validate the session's compression settings up front - rather than on every fetch
+            get_ipc_write_options(compression=message.get("compression"),
+                                  compression_level=message.get("compression_level")
+                                  )
+        except ValueError as e:
+            error_message = str(e)
+            logger.warning(msg=error_message)
+            message_dict = dict(kind="error",
+                                responseTo=message.action,
+                                success=False,
+                                error=error_message
+                                )
+            await self.send_message(message_dict)
+            return
+
+        setup_start_time = time.perf_counter()
         user, auth_error_message = await self.get_user(message.token)
+        auth_seconds = time.perf_counter() - setup_start_time
         if user is None:
             error_message = f"Authentication failed for websocket: '{self.websocket_connection.id}' - error: {auth_error_message}"
             logger.warning(msg=error_message)
@@ -53,7 +123,7 @@ class Client:
                                 success=False,
                                 error=error_message
                                 )
-            await self.websocket_connection.send(json.dumps(message_dict))
+            await self.send_message(message_dict)
             try:
                 await self.websocket_connection.close(code=CloseCode.INTERNAL_ERROR,
                                                       reason=error_message
@@ -63,17 +133,35 @@ class Client:
 
             return
         else:
-            success_message = f"User: '{user}' successfully authenticated for websocket: '{self.websocket_connection.id}'"
+            self.result_format = ResultFormat(message.get("result_format", self.result_format))
+            self.compression = message.get("compression")
+            self.compression_level = message.get("compression_level")
+
             self.user = user
             self.authenticated = True
-            await self.database_connect(autocommit=message.autocommit)
+            # Only once the client is authenticated - an unauthenticated websocket must not take a pooled connection
+            connect_seconds = await self.database_connect(autocommit=message.autocommit)
+            if connect_seconds is None:
+                return
+
+            setup_seconds = time.perf_counter() - setup_start_time
+            success_message = (f"User: '{user}' successfully authenticated for websocket: '{self.websocket_connection.id}' - "
+                               f"result format: '{self.result_format}' - compression: '{self.compression or 'none'}' - "
+                               f"auth: {auth_seconds:.4f}s - connect: {connect_seconds:.4f}s - setup: {setup_seconds:.4f}s"
+                               )
             message_dict = dict(kind="message",
                                 responseTo=message.action,
                                 success=True,
-                                message=success_message
+                                message=success_message,
+                                result_format=self.result_format,
+                                compression=self.compression,
+                                compression_level=self.compression_level,
+                                auth_seconds=auth_seconds,
+                                connect_seconds=connect_seconds,
+                                setup_seconds=setup_seconds
                                 )
             logger.info(msg=success_message)
-            await self.websocket_connection.send(json.dumps(message_dict))
+            await self.send_message(message_dict)
 
     async def check_if_authenticated(self):
         if not self.authenticated:
@@ -86,28 +174,71 @@ class Client:
             except:
                 pass
 
+    async def checkout_database_connection(self,
+                                           autocommit: bool
+                                           ) -> tuple[PooledConnection, float]:
+        start_time = time.perf_counter()
+        pooled_connection = await self.server.backend_router.checkout(autocommit=autocommit,
+                                                                      user=self.user
+                                                                      )
+        return pooled_connection, time.perf_counter() - start_time
+
     async def database_connect(self,
                                autocommit: bool
-                               ):
+                               ) -> float | None:
+        """
+        Connects the session to the database server.
+
+        :param autocommit: Whether the session's connection is in autocommit mode.
+        :return: The time (in seconds) the connect took - or None if it failed.
+        """
         await self.check_if_authenticated()
+        self.autocommit = autocommit
         try:
-            self.database_connection = dbapi.connect(uri=self.server.database_server_uri,
-                                                     db_kwargs={"username": self.server.database_username,
-                                                                "password": self.server.database_password,
-                                                                DatabaseOptions.TLS_SKIP_VERIFY.value: str(
-                                                                    self.server.database_tls_skip_verify).lower()
-                                                                },
-                                                     autocommit=autocommit
-                                                     )
+            pooled_connection, connect_seconds = await self.checkout_database_connection(autocommit=autocommit)
         except Exception as e:
-            error_message = f"SQL Client Websocket connection: '{self.websocket_connection.id}' - from user: {self.user} - failed to connect to database URI: {self.server.database_server_uri} - error: {str(e)}"
+            error_message = f"SQL Client Websocket connection: '{self.websocket_connection.id}' - from user: {self.user} - failed to connect to database URI(s): {self.server.database_backend_uris} - error: {str(e)}"
             logger.error(error_message)
             await self.websocket_connection.close(code=CloseCode.INTERNAL_ERROR,
                                                   reason=error_message
                                                   )
+            return None
         else:
+            if self.database_connection:
+                # Re-authentication - hand back the connection pinned by the previous one
+                await self.server.connection_pool.checkin(self.database_connection)
+                self.database_connection = None
+
+            if autocommit:
+                # Autocommit sessions only hold a connection while they have an open cursor
+                await self.server.connection_pool.checkin(pooled_connection)
+            else:
+                # A transaction can span queries - so the session stays pinned to one connection
+                self.database_connection = pooled_connection
             logger.info(
-                f"SQL Client Websocket connection: '{self.websocket_connection.id}' - from user: {self.user} - connected successfully to database URI: {self.server.database_server_uri}")
+                f"SQL Client Websocket connection: '{self.websocket_connection.id}' - from user: {self.user} - connected successfully to database URI: {pooled_connection.key.database_server_uri} in {connect_seconds:.4f} second(s)")
+            return connect_seconds
+
+    async def disconnect(self):
+        # Let in-flight requests wind down first - they may be running on a query's cursor in the thread pool
+        if self.request_tasks:
+            await asyncio.gather(*self.request_tasks, return_exceptions=True)
+
+        for query in list(self.queries.values()):
+            try:
+                await query.close_cursor()
+            except Exception as e:
+                logger.warning(msg=f"Failed to close Query: '{query.query_id}' for client: '{self.client_id}' - error: {str(e)}")
+
+        if self.database_connection:
+            await self.server.connection_pool.checkin(self.database_connection)
+            self.database_connection = None
+
+        if self.capture_session:
+            self.capture_session.close()
+
+        self.server.client_connections.pop(self.client_id, None)
+        logger.info(msg=f"SQL Client Websocket connection: '{self.client_id}' - closed")
 
     async def connect(self):
         logger.info(
@@ -123,43 +254,124 @@ class Client:
                                      f"\n- Connection proxied to database server: '{self.server.database_server_uri}'"
                                      )
                             )
-        await self.websocket_connection.send(json.dumps(message_dict))
+        await self.send_message(message_dict)
 
         await self.process_client_commands()
 
+    async def handle_message(self,
+                             message: Munch,
+                             received_time: float
+                             ):
+        # Responses (including any a background stream sends later) echo the request's ID - see send_message
+        request_id_context.set(message.get("request_id"))
+        if self.capture_session and message.action != "query":
+            self.capture_session.record_request(message=message,
+                                                received_time=received_time
+                                                )
+        try:
+            if message.action == "authenticate":
+                await self.authenticate_client(message)
+            elif message.action == "query":
+                query = Query(sql=message.sql,
+                              parameters=message.parameters,
+                              priority=message.get("priority", QueryPriority.NORMAL),
+                              use_cache=message.get("cache", True),
+                              scrollable=message.get("scrollable", False),
+                              distribute=message.get("distribute", self.server.default_distribute_mode),
+                              partitioned=message.get("partitioned", False),
+                              partition_order=message.get("partition_order", PartitionOrder.ORDERED),
+                              client=self
+                              )
+                self.queries[query.query_id] = query
+                if self.capture_session:
+                    self.capture_session.record_request(message=message,
+                                                        received_time=received_time,
+                                                        query_id=query.query_id
+                                                        )
+                async with query.lock:
+                    await query.run_query_async()
+            elif message.action == "cacheStats":
+                await self.check_if_authenticated()
+                message_dict = dict(kind="cacheStats",
+                                    responseTo=message.action,
+                                    success=True,
+                                    **self.server.result_cache.stats()
+                                    )
+                await self.send_message(message_dict)
+            elif message.action in ["fetch", "grantCredits", "closeCursor"]:
+                query = self.queries.get(message.query_id)
+                if message.action == "grantCredits" and query is None:
+                    # Credits can cross paths with the end of a stream - there is nothing to grant them to
+                    pass
+                elif query is None:
+                    error_message = f"Query ID: '{message.query_id}' - does NOT exist for client: '{self.client_id}'"
+                    logger.error(error_message)
+                    message_dict = dict(kind="error",
+                                        responseTo=message.action,
+                                        success=False,
+                                        error=error_message
+                                        )
+                    await self.send_message(message_dict)
+                elif message.action == "grantCredits":
+                    # Not queued behind the query's lock - a stream waiting for credits must be able to get them
+                    query.grant_credits(batches=message.get("credits", 0),
+                                        bytes=message.get("credit_bytes")
+                                        )
+                else:
+                    # Requests on the same query run one at a time - in the order they arrived
+                    async with query.lock:
+                        if message.action == "fetch":
+                            await query.fetch_results_async(fetch_mode=message.fetch_mode,
+                                                            fetch_size=message.get("fetch_size", self.server.client_default_fetch_size),
+                                                            fetch_bytes=message.get("fetch_bytes", 0),
+                                                            fetch_sizing=message.get("fetch_sizing", FetchSizing.FIXED),
+                                                            result_format=message.get("result_format", self.result_format),
+                                                            compression=message.get("compression", self.compression),
+                                                            compression_level=message.get("compression_level", self.compression_level),
+                                                            credits=message.get("credits"),
+                                                            credit_bytes=message.get("credit_bytes"),
+                                                            offset=message.get("offset"),
+                                                            limit=message.get("limit")
+                                                            )
+                        elif message.action == "closeCursor":
+                            await query.close_cursor()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            error_message = f"Request: '{message.action}' from client: '{self.client_id}' - FAILED on the server - with error: '{str(e)}'"
+            logger.exception(msg=error_message)
+            message_dict = dict(kind="error",
+                                responseTo=message.action,
+                                success=False,
+                                error=error_message
+                                )
+            try:
+                await self.send_message(message_dict)
+            except websockets.exceptions.ConnectionClosed:
+                pass
+        finally:
+            self.request_semaphore.release()
+
     async def process_client_commands(self):
         try:
             async for raw_message in self.websocket_connection:
                 if raw_message:
                     logger.info(msg=f"Message received from client: '{self.client_id}' (User: {self.user or '(not authenticated)'}) - '{raw_message}'")
 
+                    received_time = time.perf_counter()
                     message = munchify(x=json.loads(raw_message))
 
+                    # We stop reading from the socket while the session is at its concurrency limit
+                    await self.request_semaphore.acquire()
                     if message.action == "authenticate":
-                        await self.authenticate_client(message)
-                    elif message.action == "query":
-                        query = Query(sql=message.sql,
-                                      parameters=message.parameters,
-                                      client=self
-                                      )
-                        await query.run_query_async()
-                        self.queries[query.query_id] = query
-                    elif message.action in ["fetch", "closeCursor"]:
-                        if message.query_id not in self.queries:
-                            error_message = f"Query ID: '{message.query_id}' - does NOT exist for client: '{self.client_id}'"
-                            logger.error(error_message)
-                            message_dict = dict(kind="error",
-                                                responseTo=message.action,
-                                                success=False,
-                                                error=error_message
-                                                )
-                            await self.websocket_connection.send(json.dumps(message_dict))
-                        if message.action == "fetch":
-                            await self.queries[message.query_id].fetch_results_async(fetch_mode=message.fetch_mode,
-                                                                                     fetch_size=message.get("fetch_size", self.server.client_default_fetch_size)
-                                                                                     )
-                        elif message.action == "closeCursor":
-                            await self.queries[message.query_id].close_cursor()
+                        # Everything else depends on the session being set up - so nothing runs alongside this
+                        await self.handle_message(message, received_time=received_time)
+                    else:
+                        request_task = asyncio.create_task(self.handle_message(message, received_time=received_time))
+                        self.request_tasks.add(request_task)
+                        request_task.add_done_callback(self.request_tasks.discard)
 
         except websockets.exceptions.ConnectionClosedError:
             pass
+        finally:
+            await self.disconnect()
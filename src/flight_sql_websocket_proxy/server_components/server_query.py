@@ -1,17 +1,33 @@
+import asyncio
 import functools
-import json
+import time
 import uuid
-from datetime import datetime, UTC
+from concurrent.futures.process import BrokenProcessPool
 from sys import getsizeof
-from typing import List, Optional
+from typing import Callable, List, Optional
 from typing import TYPE_CHECKING
 
 import pyarrow
+import websockets
 from adbc_driver_manager.dbapi import Cursor
 from pyarrow import RecordBatchReader
 
+from .backend_router import is_backend_failure
+from .common import ResultFormat, FetchSizing, QueryPriority, DistributeMode, PartitionOrder
+from .connection_pool import PooledConnection
+from .distributed import DistributedResult, get_merge_plan
+from .fetch_sizing import AdaptiveFetchSizer
+from .memory_budget import BudgetedBatchList, EncodingReservation
+from .partitioned_reader import PartitionedReader
+from .prefetcher import BatchPrefetcher
+from .result_cache import CachedResult, is_read_only_sql
+from .result_spool import ResultSpool
+from .scheduler import QueryQueueFullError
+from ..constants import DEFAULT_STREAM_CREDITS, DEFAULT_ADAPTIVE_FETCH_TARGET_SEND_SECONDS, \
+    DEFAULT_ADAPTIVE_FETCH_MIN_BYTES
 from ..config import logger
-from ..utils import get_dataframe_results_as_ipc_base64_str
+from ..utils import get_dataframe_results_as_ipc_base64_str, get_record_batches_ipc_fragments, \
+    get_ipc_write_options
 
 if TYPE_CHECKING:
     from .server_client import Client
@@ -22,31 +38,167 @@ class Query:
                  client: "Client",
                  sql: str,
                  parameters: Optional[List[str]] = None,
+                 priority: QueryPriority = QueryPriority.NORMAL,
+                 use_cache: bool = True,
+                 scrollable: bool = False,
+                 distribute: DistributeMode = DistributeMode.FALSE,
+                 partitioned: bool = False,
+                 partition_order: PartitionOrder = PartitionOrder.ORDERED
                  ):
         self.client = client
         self.query_id = str(uuid.uuid4())
-        self.cursor: Cursor = self.client.database_connection.cursor()
+        self.database_connection: PooledConnection | None = None
+        self.owns_database_connection: bool = False
+        # The backend the query's cursor is on - while it counts as one of the backend's outstanding queries
+        self.backend_uri: str | None = None
+        self.cursor: Cursor | None = None
         self.record_batch_reader: RecordBatchReader = None
         self.results = None
         self.sql = sql
         self.parameters = parameters
-        self.start_time = datetime.now(tz=UTC).isoformat()
-        self.end_time = None
+        self.priority = priority
+        self.queue_seconds: float = 0.0
+        self.execute_seconds: float | None = None
+        # From the query's start until its first batch arrived from the backend (or the cache)
+        self.first_batch_seconds: float | None = None
+        # The time the previous fetch took to send - a fetch's own send time is only known once it has been sent
+        self.last_send_seconds: float | None = None
+        self.use_cache = use_cache
+        self.cached: bool = False
+        # While set - the batches read from the backend are recorded for the result cache
+        self.cache_key: str | None = None
+        self.cache_record_batches: list[pyarrow.RecordBatch] | None = None
+        self.cache_record_bytes: int = 0
+        self.prefetcher: BatchPrefetcher | None = None
+        self.prefetch_task: asyncio.Task | None = None
+        self.scrollable = scrollable
+        self.distribute = distribute
+        # Set while a distributed query holds its shards' connections (or its merged result)
+        self.distributed_result: DistributedResult | None = None
+        # Read the result's partitions (Flight endpoints) concurrently - rather than through one stream
+        self.partitioned = partitioned
+        self.partition_order = partition_order
+        self.partitioned_reader: PartitionedReader | None = None
+        self.spool: ResultSpool | None = None
+        # The first row of the last fetch - and the row the next (offset-less) fetch starts from
+        self.scroll_offset: int = 0
+        self.scroll_position: int = 0
+        # Monotonic (time.perf_counter) - for timings only
+        self.start_time = time.perf_counter()
         self.rows_fetched: int = 0
         self.executed: bool = False
         self.all_rows_fetched: bool = False
+        # Batches read from the backend but not sent yet (e.g. the remainder of a sliced batch) - served first, in order
+        self.pending_batches: list[pyarrow.RecordBatch] = []
+        self.fetch_sizer = AdaptiveFetchSizer(target_frame_bytes=self.client.server.adaptive_fetch_target_bytes,
+                                              target_send_seconds=DEFAULT_ADAPTIVE_FETCH_TARGET_SEND_SECONDS,
+                                              min_frame_bytes=DEFAULT_ADAPTIVE_FETCH_MIN_BYTES
+                                              )
+        self.stream_task: asyncio.Task | None = None
+        self.stream_credits: int = 0
+        self.stream_credit_bytes: int | None = None
+        self.stream_credit_event = asyncio.Event()
+        self.stream_stopped: bool = False
+        # Serializes the client's requests (fetch, closeCursor, etc.) on this query
+        self.lock = asyncio.Lock()
 
     def __del__(self):
         if self.cursor:
             self.cursor.close()
 
     async def close_cursor(self):
-        if self.cursor:
-            self.cursor.close()
+        if self.stream_task and self.stream_task is not asyncio.current_task():
+            # Let the stream finish its in-flight batch before we close the cursor out from under it
+            self.stream_stopped = True
+            self.stream_credit_event.set()
+            await self.stream_task
+
+        # A result which was not read to the end is not cached
+        self.cache_record_batches = None
+
+        await self.release_cursor()
+
+        if self.spool:
+            self.spool.close()
+            self.spool = None
 
         if self.query_id in self.client.queries:
             del self.client.queries[self.query_id]
 
+    async def release_cursor(self,
+                             discard_connection: bool = False
+                             ):
+        """
+        Closes the backend cursor and returns its connection to the pool - the query itself stays open (a
+        scrollable cursor keeps serving its spooled results).
+
+        :param discard_connection: Close the connection rather than return it to the pool (e.g. its backend failed).
+        """
+        if self.prefetcher:
+            # Stop the read-ahead (at its next batch) - and release what it buffered
+            self.prefetcher.closed = True
+            if self.prefetch_task:
+                await self.prefetch_task
+            self.prefetcher.close()
+            self.prefetcher = None
+
+        if self.partitioned_reader:
+            # Its readers use the query's connection too - so they stop before the connection goes back
+            partitioned_reader, self.partitioned_reader = self.partitioned_reader, None
+            await partitioned_reader.close()
+
+        if self.cursor:
+            if self.owns_database_connection:
+                self.cursor.close()
+            else:
+                async with self.client.database_connection_lock:
+                    self.cursor.close()
+            self.cursor = None
+
+        if self.distributed_result:
+            distributed_result, self.distributed_result = self.distributed_result, None
+            await distributed_result.close()
+
+        if self.backend_uri:
+            self.client.server.backend_router.end(self.backend_uri)
+            self.backend_uri = None
+
+        if self.database_connection and self.owns_database_connection:
+            database_connection, self.database_connection = self.database_connection, None
+            await self.client.server.connection_pool.checkin(database_connection,
+                                                             discard=discard_connection
+                                                             )
+
+    async def open_cursor(self,
+                          exclude_backend_uris: set[str] = None
+                          ):
+        if self.client.database_connection:
+            # The session is pinned to a connection (it is not in autocommit mode)
+            self.database_connection = self.client.database_connection
+            self.owns_database_connection = False
+        else:
+            self.database_connection = await self.client.server.backend_router.checkout(autocommit=self.client.autocommit,
+                                                                                        user=self.client.user,
+                                                                                        exclude=exclude_backend_uris
+                                                                                        )
+            self.owns_database_connection = True
+
+        self.backend_uri = self.database_connection.key.database_server_uri
+        self.client.server.backend_router.begin(self.backend_uri)
+        self.cursor = self.database_connection.cursor()
+
+    async def run_in_executor(self, func):
+        if self.owns_database_connection or not self.database_connection:
+            return await self.client.server.event_loop.run_in_executor(executor=self.client.server.thread_pool,
+                                                                       func=func
+                                                                       )
+
+        # Other queries in the session share the pinned connection - and ADBC connections are not safe for concurrent use
+        async with self.client.database_connection_lock:
+            return await self.client.server.event_loop.run_in_executor(executor=self.client.server.thread_pool,
+                                                                       func=func
+                                                                       )
+
     @classmethod
     def run_query(cls,
                   cursor: Cursor,
@@ -59,85 +211,539 @@ class Query:
 
         return cursor.fetch_record_batch()
 
-    async def run_query_async(self):
-        await self.client.check_if_authenticated()
+    @classmethod
+    def run_query_partitions(cls,
+                             cursor: Cursor,
+                             sql: str,
+                             parameters: Optional[List[str]] = None
+                             ) -> tuple[list[bytes], pyarrow.Schema | None]:
+        return cursor.adbc_execute_partitions(operation=sql,
+                                              parameters=parameters
+                                              )
 
-        try:
-            partial_run_query = functools.partial(self.run_query,
+    async def read_partitions(self,
+                              partitions: list[bytes],
+                              schema: pyarrow.Schema | None
+                              ) -> RecordBatchReader:
+        self.partitioned_reader = PartitionedReader(server=self.client.server,
+                                                    database_connection=self.database_connection,
+                                                    partitions=partitions,
+                                                    schema=schema,
+                                                    partition_order=self.partition_order,
+                                                    max_readers=self.client.server.max_partition_readers,
+                                                    max_bytes=self.client.server.prefetch_bytes
+                                                    )
+        await self.partitioned_reader.start()
+        return await self.run_in_executor(func=self.partitioned_reader.get_record_batch_reader)
+
+    async def execute_on_backend(self) -> RecordBatchReader:
+        """
+        Runs the query on the backend the router picks - and, if that backend cannot be reached, retries a
+        read-only query which is not part of a transaction on another one (up to the router's max_retries).
+        """
+        backend_router = self.client.server.backend_router
+        failed_backend_uris = set()
+        while True:
+            await self.open_cursor(exclude_backend_uris=failed_backend_uris)
+            # A transaction's partitions could only be read on its one (pinned) connection - so they are read serially
+            read_partitions = self.partitioned and self.owns_database_connection and self.client.server.max_partition_readers > 0
+            partial_run_query = functools.partial(self.run_query_partitions if read_partitions else self.run_query,
                                                   cursor=self.cursor,
                                                   sql=self.sql,
                                                   parameters=self.parameters
                                                   )
 
-            self.record_batch_reader = await self.client.server.event_loop.run_in_executor(
-                executor=self.client.server.thread_pool,
-                func=partial_run_query
-            )
+            execute_start_time = time.perf_counter()
+            try:
+                record_batch_reader = await self.run_in_executor(func=partial_run_query)
+                if read_partitions:
+                    record_batch_reader = await self.read_partitions(*record_batch_reader)
+            except Exception as e:
+                if not is_backend_failure(e):
+                    raise
+
+                backend_uri = self.backend_uri
+                backend_router.record_failure(backend_uri=backend_uri, error=e)
+                can_retry = (self.owns_database_connection
+                             and is_read_only_sql(self.sql)
+                             and len(failed_backend_uris) < backend_router.max_retries
+                             )
+                failed_backend_uris.add(backend_uri)
+                await self.release_cursor(discard_connection=True)
+                if not can_retry or not backend_router.choose(exclude=failed_backend_uris):
+                    raise
+
+                backend_router.retries += 1
+                logger.warning(msg=f"Query: '{self.query_id}' - could not reach database backend: {backend_uri} - retrying it on another backend - error: {str(e)}")
+            else:
+                backend_router.record_success(backend_uri=self.backend_uri,
+                                              execute_seconds=time.perf_counter() - execute_start_time
+                                              )
+                return record_batch_reader
+
+    async def run_query_async(self):
+        await self.client.check_if_authenticated()
+
+        try:
+            try:
+                priority = QueryPriority(self.priority)
+            except ValueError:
+                raise ValueError(f"Invalid priority: '{self.priority}' - must be one of: {[priority.value for priority in QueryPriority]}")
+
+            try:
+                self.partition_order = PartitionOrder(self.partition_order)
+            except ValueError:
+                raise ValueError(f"Invalid partition order: '{self.partition_order}' - must be one of: {[partition_order.value for partition_order in PartitionOrder]}")
+
+            merge_plan = self.get_merge_plan()
+
+            cached_result = self.get_cached_result()
+            if cached_result:
+                # Served through the normal fetch path - without touching the scheduler or the database
+                self.record_batch_reader = cached_result.get_record_batch_reader()
+                self.cached = True
+            else:
+                # Wait for our turn before taking a database connection - so that queued queries don't tie up the pool
+                self.queue_seconds = await self.client.server.query_scheduler.acquire(user=self.client.user,
+                                                                                      priority=priority
+                                                                                      )
+                self.client.server.metrics.queue_seconds.observe(self.queue_seconds)
+                try:
+                    execute_start_time = time.perf_counter()
+                    if self.distribute != DistributeMode.FALSE:
+                        self.distributed_result = DistributedResult(server=self.client.server,
+                                                                    sql=self.sql,
+                                                                    parameters=self.parameters,
+                                                                    merge_plan=merge_plan,
+                                                                    run_in_executor=self.run_in_executor
+                                                                    )
+                        self.record_batch_reader = await self.distributed_result.execute()
+                    else:
+                        self.record_batch_reader = await self.execute_on_backend()
+                    self.execute_seconds = time.perf_counter() - execute_start_time
+                    self.client.server.metrics.execute_seconds.observe(self.execute_seconds)
+                finally:
+                    self.client.server.query_scheduler.release(user=self.client.user)
+
+                if self.cache_key:
+                    self.cache_record_batches = []
+
+                if self.client.server.prefetch_batches > 0:
+                    self.prefetcher = BatchPrefetcher(record_batch_reader=self.record_batch_reader,
+                                                      max_batches=self.client.server.prefetch_batches,
+                                                      max_bytes=self.client.server.prefetch_bytes,
+                                                      memory_budget=self.client.server.memory_budget
+                                                      )
         except Exception as e:
+            self.client.server.metrics.queries.inc(status="rejected" if isinstance(e, QueryQueueFullError) else "error")
             error_message = f"Query: {self.sql} - FAILED on the server - with error: '{str(e)}'"
             message_dict = dict(kind="queryResult",
                                 responseTo="query",
                                 success=False,
                                 error=error_message,
-                                query_id=self.query_id
+                                query_id=self.query_id,
+                                queue_seconds=self.queue_seconds,
+                                timings=self.get_query_timings()
                                 )
-            await self.client.websocket_connection.send(json.dumps(message_dict))
+            await self.close_cursor()
+            await self.client.send_message(message_dict)
         else:
+            self.client.server.metrics.queries.inc(status="cached" if self.cached else "success")
             self.executed = True
-            self.end_time = datetime.now(tz=UTC).isoformat()
-            success_message = f"Query: '{self.query_id}' - execution elapsed time: {str(datetime.fromisoformat(self.end_time) - datetime.fromisoformat(self.start_time))}"
+            if self.scrollable:
+                self.spool = ResultSpool(schema=self.record_batch_reader.schema,
+                                         directory=self.client.server.spill_directory
+                                         )
+            self.start_prefetch()
+            timings = self.get_query_timings()
+            success_message = f"Query: '{self.query_id}' - execution elapsed time: {timings['total_seconds']:.4f} second(s) - queued for: {self.queue_seconds:.4f} second(s)"
 
             message_dict = dict(kind="queryResult",
                                 responseTo="query",
                                 success=True,
                                 message=success_message,
-                                query_id=self.query_id
+                                query_id=self.query_id,
+                                queue_seconds=self.queue_seconds,
+                                cached=self.cached,
+                                timings=timings
                                 )
-            await self.client.websocket_connection.send(json.dumps(message_dict))
+            await self.client.send_message(message_dict)
 
-    @classmethod
-    def fetch_results(cls,
-                      record_batch_reader: RecordBatchReader,
+    def get_query_timings(self) -> dict:
+        """
+        :return: Where the query's time (in seconds) went so far - execute_seconds is None for a cached result.
+        """
+        return dict(queue_seconds=self.queue_seconds,
+                    execute_seconds=self.execute_seconds,
+                    # For a distributed query - the part of execute_seconds its shards' results took to merge
+                    merge_seconds=self.distributed_result.merge_seconds if self.distributed_result else None,
+                    total_seconds=time.perf_counter() - self.start_time
+                    )
+
+    def get_merge_plan(self):
+        """
+        Checks (before the query queues) that it can run in its distribute mode.
+
+        :return: For a distributed query - its merge plan (see distributed.get_merge_plan).
+        """
+        try:
+            self.distribute = DistributeMode(self.distribute)
+        except ValueError:
+            raise ValueError(f"Invalid distribute mode: '{self.distribute}' - must be one of: {[distribute_mode.value for distribute_mode in DistributeMode]}")
+
+        if self.distribute == DistributeMode.FALSE:
+            return None
+        if not self.client.server.database_shard_uris:
+            raise ValueError(f"Distribute mode: '{self.distribute}' - needs database shard URIs - and the server has none configured")
+        if not self.client.autocommit:
+            raise ValueError("A distributed query runs in autocommit mode on each shard - it cannot run in a transaction")
+
+        return get_merge_plan(sql=self.sql,
+                              distribute_mode=self.distribute
+                              )
+
+    def get_cached_result(self) -> CachedResult | None:
+        result_cache = self.client.server.result_cache
+        if not (result_cache.enabled and self.use_cache):
+            return None
+
+        # A transaction can see its own uncommitted writes - so only autocommit sessions use the cache
+        if not self.client.autocommit or not is_read_only_sql(self.sql):
+            result_cache.record_bypass()
+            return None
+
+        self.cache_key = result_cache.get_key(sql=self.sql,
+                                              parameters=self.parameters,
+                                              user=self.client.user,
+                                              distribute=self.distribute
+                                              )
+        return result_cache.get(self.cache_key)
+
+    def start_prefetch(self):
+        if not self.prefetcher or not self.prefetcher.needs_fill:
+            return
+        if self.prefetch_task and not self.prefetch_task.done():
+            return
+
+        self.prefetch_task = asyncio.create_task(self.run_in_executor(func=self.prefetcher.fill))
+
+    def read_next_batch(self) -> pyarrow.RecordBatch:
+        # Serve what a previous fetch read, but did not send, first
+        if self.pending_batches:
+            return self.pending_batches.pop(0)
+
+        try:
+            if self.prefetcher:
+                record_batch = self.prefetcher.read_next_batch()
+            else:
+                record_batch = self.record_batch_reader.read_next_batch()
+        except StopIteration:
+            if self.cache_record_batches is not None:
+                # We read the whole result - so it can be cached
+                self.client.server.result_cache.put(key=self.cache_key,
+                                                    schema=self.record_batch_reader.schema,
+                                                    record_batches=self.cache_record_batches
+                                                    )
+                self.cache_record_batches = None
+            raise
+
+        if self.first_batch_seconds is None:
+            first_batch_time = self.prefetcher.first_batch_time if self.prefetcher else None
+            self.first_batch_seconds = (first_batch_time or time.perf_counter()) - self.start_time
+
+        if self.cache_record_batches is not None:
+            self.cache_record_batches.append(record_batch)
+            self.cache_record_bytes += record_batch.nbytes
+            if self.cache_record_bytes > self.client.server.result_cache.max_bytes:
+                # Too big to ever fit in the cache - stop holding on to it
+                self.cache_record_batches = None
+
+        return record_batch
+
+    def encode_record_batches(self,
+                              record_batches: list[pyarrow.RecordBatch],
+                              result_format: ResultFormat,
+                              ipc_write_options: pyarrow.ipc.IpcWriteOptions,
+                              compression: str | None = None,
+                              compression_level: int | None = None,
+                              encoding_reservation: EncodingReservation | None = None
+                              ) -> str | list[bytearray | memoryview]:
+        """
+        :param encoding_reservation: Reserves the memory a base64 encoding holds against the result memory budget
+                                     - it raises a MemoryError if the budget cannot cover it.
+        """
+        metrics = self.client.server.metrics
+        if result_format == ResultFormat.BINARY:
+            metrics.encodings.inc(executor="thread")
+            # A list of fragments - which reference the batches' own buffers - sent as one fragmented binary message
+            return list(get_record_batches_ipc_fragments(schema=self.record_batch_reader.schema,
+                                                         record_batches=record_batches,
+                                                         max_fragment_size=self.client.server.websocket_fragment_size,
+                                                         options=ipc_write_options
+                                                         )
+                        )
+
+        arrow_bytes = sum(record_batch.nbytes for record_batch in record_batches)
+        if encoding_reservation:
+            # Spilled batches are read back through a memory map - but their encoding is built on the heap
+            encoding_reservation.reserve(arrow_bytes=arrow_bytes)
+
+        # Big results are base64 encoded in a worker process - so that the encoding does not hold our GIL
+        process_encoder = self.client.server.process_encoder
+        result_data = None
+        if process_encoder.should_encode_in_process(nbytes=arrow_bytes):
+            try:
+                result_data = process_encoder.encode_base64(schema=self.record_batch_reader.schema,
+                                                            record_batches=record_batches,
+                                                            compression=compression,
+                                                            compression_level=compression_level
+                                                            )
+            except Exception as e:
+                logger.warning(msg=f"Query: '{self.query_id}' - failed to encode results in a worker process - encoding them on a thread instead - error: {str(e)}")
+                if isinstance(e, BrokenProcessPool):
+                    process_encoder.min_bytes = -1
+            else:
+                metrics.encodings.inc(executor="process")
+
+        if result_data is None:
+            metrics.encodings.inc(executor="thread")
+            # We build the table from the schema - b/c we need it even if there are no batches left
+            arrow_table: pyarrow.Table = pyarrow.Table.from_batches(batches=record_batches,
+                                                                    schema=self.record_batch_reader.schema
+                                                                    )
+            result_data = get_dataframe_results_as_ipc_base64_str(df=arrow_table,
+                                                                  options=ipc_write_options
+                                                                  )
+
+        if encoding_reservation:
+            encoding_reservation.settle(encoded_bytes=len(result_data))
+        return result_data
+
+    def spool_rows(self,
+                   end_row: int = None
+                   ):
+        # Copy batches from the backend into the spool until it holds end_row rows (or all of them - if None)
+        while not self.spool.exhausted and (end_row is None or self.spool.num_rows < end_row):
+            try:
+                record_batch = self.read_next_batch()
+            except StopIteration:
+                self.spool.exhausted = True
+                break
+
+            if record_batch.num_rows:
+                self.spool.append(record_batch)
+
+    def read_spooled_rows(self,
+                          fetch_size: int = 0,
+                          fetch_bytes: int = 0,
+                          limit: int = None
+                          ) -> tuple[list[pyarrow.RecordBatch], bool]:
+        """
+        Reads the rows from scroll_position onward - limit rows (if set - even 0), or fetch_size rows (or roughly
+        fetch_bytes bytes of them, or all of the rest - if neither is set).
+
+        :return: Zero-copy slices of the spooled batches - and whether the fetch reached the end of the results.
+        """
+        offset = self.scroll_position
+        if limit is None:
+            limit = fetch_size
+            if not limit and fetch_bytes:
+                # Work out the row count from what the rows spooled so far cost
+                self.spool_rows(end_row=offset + 1)
+                bytes_per_row = max(self.spool.nbytes / max(self.spool.num_rows, 1), 1)
+                limit = max(int(fetch_bytes // bytes_per_row), 1)
+            # None reads all of the rest
+            limit = limit or None
+
+        self.spool_rows(end_row=offset + limit if limit is not None else None)
+        record_batches = self.spool.read_rows(offset=offset,
+                                              limit=limit
+                                              )
+
+        self.scroll_offset = offset
+        self.scroll_position = offset + sum(record_batch.num_rows for record_batch in record_batches)
+        return record_batches, self.spool.exhausted and self.scroll_position >= self.spool.num_rows
+
+    def fetch_results(self,
                       fetch_mode: str,
-                      fetch_size: int = 0
-                      ) -> tuple[None, int, bool] | tuple[str, int, bool]:
-        if fetch_mode == "all":
-            arrow_table: pyarrow.Table = record_batch_reader.read_all()
-            all_rows_fetched = True
-        elif fetch_mode == "batch":
-            record_batches = []
-            total_rows_fetched = 0
-            all_rows_fetched = False
-            while True:
-                try:
-                    record_batch: pyarrow.RecordBatch = record_batch_reader.read_next_batch()
-                except StopIteration:
-                    # Just fetch the empty batch - b/c we need the schema
-                    arrow_table = record_batch_reader.read_all()
-                    all_rows_fetched = True
-                    break
+                      fetch_size: int = 0,
+                      fetch_bytes: int = 0,
+                      result_format: ResultFormat = ResultFormat.BASE64,
+                      compression: str | None = None,
+                      compression_level: int | None = None,
+                      limit: int = None
+                      ) -> tuple[str | list[bytearray | memoryview], int, int, bool, dict, Callable[[], None]]:
+        """
+        :param limit: The rows to fetch from a scrollable cursor (even 0) - rather than fetch_size / fetch_bytes.
+        :return: The encoded results, their row count and size, whether all rows are fetched, timings - and a
+                 function to call once the results are sent (which releases the memory budget they hold).
+        """
+        if fetch_mode not in ("all", "batch"):
+            raise ValueError(f"Invalid fetch mode: '{fetch_mode}' - must be one of: 'all', 'batch' or 'stream'")
 
-                total_rows_fetched += record_batch.num_rows
-                record_batches.append(record_batch)
+        ipc_write_options = get_ipc_write_options(compression=compression,
+                                                  compression_level=compression_level
+                                                  )
 
-                if all_rows_fetched or total_rows_fetched >= fetch_size:
-                    break
+        metrics = self.client.server.metrics
+        encoding_reservation = EncodingReservation(memory_budget=self.client.server.memory_budget)
+        read_start_time = time.perf_counter()
+        if self.spool:
+            scroll_position = self.scroll_position
+            try:
+                # Fetch mode: 'all' reads the rest of the rows
+                record_batches, all_rows_fetched = self.read_spooled_rows(fetch_size=fetch_size if fetch_mode == "batch" else 0,
+                                                                          fetch_bytes=fetch_bytes if fetch_mode == "batch" else 0,
+                                                                          limit=limit
+                                                                          )
+                read_seconds = time.perf_counter() - read_start_time
+                serialize_start_time = time.perf_counter()
+                result_data = self.encode_record_batches(record_batches=record_batches,
+                                                         result_format=result_format,
+                                                         ipc_write_options=ipc_write_options,
+                                                         compression=compression,
+                                                         compression_level=compression_level,
+                                                         encoding_reservation=encoding_reservation
+                                                         )
+                serialize_seconds = time.perf_counter() - serialize_start_time
+            except BaseException:
+                encoding_reservation.release()
+                # The rows stay spooled - the fetch can be retried
+                self.scroll_position = scroll_position
+                raise
+            metrics.fetch_read_seconds.observe(read_seconds)
+            metrics.serialize_seconds.observe(serialize_seconds)
+            return (result_data,
+                    sum(record_batch.num_rows for record_batch in record_batches),
+                    sum(record_batch.nbytes for record_batch in record_batches),
+                    all_rows_fetched,
+                    dict(read_seconds=read_seconds, serialize_seconds=serialize_seconds),
+                    encoding_reservation.release
+                    )
 
-            if len(record_batches) != 0:
-                arrow_table: pyarrow.Table = pyarrow.Table.from_batches(batches=record_batches)
-        else:
-            raise ValueError(f"Invalid fetch mode: '{fetch_mode}' - must be one of: 'all' or 'batch'")
+        # Collected against the server's result memory budget - spilling to disk if it cannot cover them
+        fetched_batches = BudgetedBatchList(memory_budget=self.client.server.memory_budget,
+                                            schema=self.record_batch_reader.schema,
+                                            spill_directory=self.client.server.spill_directory
+                                            )
+
+        def release():
+            fetched_batches.release()
+            encoding_reservation.release()
+
+        try:
+            if fetch_mode == "all":
+                while True:
+                    try:
+                        fetched_batches.append(self.read_next_batch())
+                    except StopIteration:
+                        break
+                all_rows_fetched = True
+            elif fetch_mode == "batch":
+                all_rows_fetched = False
+                while True:
+                    try:
+                        record_batch: pyarrow.RecordBatch = self.read_next_batch()
+                    except StopIteration:
+                        all_rows_fetched = True
+                        break
+
+                    if record_batch.num_rows == 0:
+                        continue
+
+                    # Work out how many rows of this batch fit in what is left of the fetch's row and byte budgets
+                    rows_to_take = record_batch.num_rows
+                    if fetch_size:
+                        rows_to_take = min(rows_to_take, fetch_size - fetched_batches.num_rows)
+                    if fetch_bytes:
+                        bytes_per_row = max(record_batch.nbytes / record_batch.num_rows, 1)
+                        rows_within_budget = int((fetch_bytes - fetched_batches.nbytes) // bytes_per_row)
+                        # Always return at least one row - even if a single row is bigger than the byte budget
+                        rows_to_take = min(rows_to_take, max(rows_within_budget, 1 if fetched_batches.num_rows == 0 else 0))
+
+                    if rows_to_take <= 0:
+                        self.pending_batches.insert(0, record_batch)
+                        break
+
+                    if rows_to_take < record_batch.num_rows:
+                        # Zero-copy slices - the remainder is served first by the next fetch
+                        self.pending_batches.insert(0, record_batch.slice(offset=rows_to_take))
+                        record_batch = record_batch.slice(offset=0, length=rows_to_take)
+
+                    fetched_batches.append(record_batch)
 
-        return get_dataframe_results_as_ipc_base64_str(df=arrow_table), arrow_table.num_rows, all_rows_fetched
+                    if not (fetch_size or fetch_bytes) \
+                            or (fetch_size and fetched_batches.num_rows >= fetch_size) \
+                            or (fetch_bytes and fetched_batches.nbytes >= fetch_bytes):
+                        break
+
+            record_batches = fetched_batches.get_batches()
+            read_seconds = time.perf_counter() - read_start_time
+            serialize_start_time = time.perf_counter()
+            try:
+                result_data = self.encode_record_batches(record_batches=record_batches,
+                                                         result_format=result_format,
+                                                         ipc_write_options=ipc_write_options,
+                                                         compression=compression,
+                                                         compression_level=compression_level,
+                                                         encoding_reservation=encoding_reservation
+                                                         )
+            except MemoryError:
+                # The budget cannot cover the encoding (right now) - the rows are already read from the backend, so
+                # they are put back for the next fetch to serve (first) - and the fetch can be retried
+                self.pending_batches[:0] = record_batches
+                raise
+            serialize_seconds = time.perf_counter() - serialize_start_time
+            metrics.fetch_read_seconds.observe(read_seconds)
+            metrics.serialize_seconds.observe(serialize_seconds)
+        except BaseException:
+            release()
+            raise
+
+        # The results (binary fragments reference the batches' buffers) are held until they are sent
+        return (result_data,
+                fetched_batches.num_rows,
+                fetched_batches.nbytes,
+                all_rows_fetched,
+                dict(read_seconds=read_seconds, serialize_seconds=serialize_seconds),
+                release
+                )
 
     async def fetch_results_async(self,
                                   fetch_mode: str,
-                                  fetch_size: int = 0
+                                  fetch_size: int = 0,
+                                  fetch_bytes: int = 0,
+                                  fetch_sizing: FetchSizing = FetchSizing.FIXED,
+                                  result_format: ResultFormat = ResultFormat.BASE64,
+                                  compression: str | None = None,
+                                  compression_level: int | None = None,
+                                  credits: int = None,
+                                  credit_bytes: int = None,
+                                  offset: int = None,
+                                  limit: int = None
                                   ):
         await self.client.check_if_authenticated()
 
-        if not self.executed:
+        error_message = None
+        if fetch_mode not in ("all", "batch", "stream"):
+            error_message = f"Invalid fetch mode: '{fetch_mode}' - must be one of: 'all', 'batch' or 'stream'"
+        elif not self.executed:
             error_message = f"Query: '{self.query_id}' - has not been executed yet - cannot fetch results..."
+        elif self.stream_task and not self.stream_task.done():
+            error_message = f"Query: '{self.query_id}' - is already streaming results - cannot fetch results..."
+        elif (offset is not None or limit is not None) and not self.scrollable:
+            error_message = f"Query: '{self.query_id}' - is not scrollable - cannot fetch by offset / limit - run the query with scrollable: true"
+        elif (offset is not None and offset < 0) or (limit is not None and limit < 0):
+            error_message = f"Invalid offset: '{offset}' / limit: '{limit}' - they cannot be negative"
+        elif limit == 0 and fetch_mode == "stream":
+            error_message = "Invalid limit: 0 - a stream cannot send zero rows - fetch them with fetch_mode: 'batch'"
+
+        try:
+            fetch_sizing = FetchSizing(fetch_sizing)
+        except ValueError:
+            error_message = f"Invalid fetch sizing: '{fetch_sizing}' - must be one of: {[sizing.value for sizing in FetchSizing]}"
+
+        if error_message:
             message_dict = dict(kind="fetchResult",
                                 responseTo="fetch",
                                 query_id=self.query_id,
@@ -145,23 +751,82 @@ class Query:
                                 error=error_message,
                                 data=None
                                 )
-            await self.client.websocket_connection.send(json.dumps(message_dict))
+            await self.client.send_message(message_dict)
             return
 
+        if offset is not None:
+            # Scrollable cursors fetch from their scroll position - so a jump just moves it
+            self.scroll_position = offset
+
+        if fetch_mode == "stream":
+            if limit is not None:
+                # Each streamed batch has limit rows
+                fetch_size = limit
+            # The stream runs in the background - so that the client can grant credits while it is running
+            self.grant_credits(batches=credits or DEFAULT_STREAM_CREDITS,
+                               bytes=credit_bytes
+                               )
+            self.stream_task = asyncio.create_task(self.stream_results(fetch_size=fetch_size,
+                                                                       fetch_bytes=fetch_bytes,
+                                                                       fetch_sizing=fetch_sizing,
+                                                                       result_format=result_format,
+                                                                       compression=compression,
+                                                                       compression_level=compression_level
+                                                                       )
+                                                   )
+        else:
+            await self.fetch_and_send_results(fetch_mode=fetch_mode,
+                                              fetch_size=fetch_size,
+                                              fetch_bytes=fetch_bytes,
+                                              fetch_sizing=fetch_sizing,
+                                              result_format=result_format,
+                                              compression=compression,
+                                              compression_level=compression_level,
+                                              limit=limit
+                                              )
+
+    async def fetch_and_send_results(self,
+                                     fetch_mode: str,
+                                     fetch_size: int = 0,
+                                     fetch_bytes: int = 0,
+                                     fetch_sizing: FetchSizing = FetchSizing.FIXED,
+                                     result_format: ResultFormat = ResultFormat.BASE64,
+                                     compression: str | None = None,
+                                     compression_level: int | None = None,
+                                     limit: int = None
+                                     ) -> tuple[dict, int]:
+        """
+        :return: The fetch's response header (without its results - which are not held on to once sent) - and the
+                 size of the results sent.
+        """
         message_dict = dict()
+        binary_payloads = []
+        release_results = None
+        batch_rows_fetched = 0
+        batch_bytes_fetched = 0
+        payload_bytes = 0
         try:
+            result_format = ResultFormat(result_format)
+            if fetch_sizing == FetchSizing.ADAPTIVE:
+                # The sizer picks the byte budget - the row count falls out of slicing to it
+                fetch_size = 0
+                fetch_bytes = self.fetch_sizer.next_fetch_bytes()
+
             partial_fetch_results = functools.partial(self.fetch_results,
-                                                      record_batch_reader=self.record_batch_reader,
-                                                      fetch_mode=fetch_mode,
-                                                      fetch_size=fetch_size
+                                                      fetch_mode="batch" if fetch_mode == "stream" else fetch_mode,
+                                                      fetch_size=fetch_size,
+                                                      fetch_bytes=fetch_bytes,
+                                                      result_format=result_format,
+                                                      compression=compression,
+                                                      compression_level=compression_level,
+                                                      limit=limit
                                                       )
 
-            result_base64_str, batch_rows_fetched, self.all_rows_fetched = await self.client.server.event_loop.run_in_executor(
-                executor=self.client.server.thread_pool,
-                func=partial_fetch_results
-            )
+            result_data, batch_rows_fetched, batch_bytes_fetched, self.all_rows_fetched, fetch_timings, release_results = await self.run_in_executor(func=partial_fetch_results)
 
             self.rows_fetched += batch_rows_fetched
+            # Read ahead while we send this fetch (and the client works through it)
+            self.start_prefetch()
 
         except Exception as e:
             error_message = f"Fetch for Query ID: {self.query_id} - FAILED on the server - with error: '{str(e)}'"
@@ -170,6 +835,9 @@ class Query:
                                 query_id=self.query_id,
                                 success=False,
                                 error=error_message,
+                                # The fetch's rows are kept (pending, or spooled) - so it can be retried, e.g. once
+                                # other sessions' results are sent, or with fewer rows at a time
+                                retryable=isinstance(e, MemoryError),
                                 data=None
                                 )
         else:
@@ -179,17 +847,144 @@ class Query:
                                 query_id=self.query_id,
                                 success=True,
                                 message=success_message,
+                                fetch_mode=fetch_mode,
+                                fetch_sizing=fetch_sizing,
                                 batch_rows_fetched=batch_rows_fetched,
                                 total_rows_fetched=self.rows_fetched,
                                 all_rows_fetched=self.all_rows_fetched,
-                                data=result_base64_str
+                                result_format=result_format,
+                                compression=compression or "none",
+                                compression_level=compression_level,
+                                timings=dict(fetch_timings,
+                                             first_batch_seconds=self.first_batch_seconds,
+                                             last_send_seconds=self.last_send_seconds
+                                             )
                                 )
+            if result_format == ResultFormat.BINARY:
+                # The raw Arrow IPC stream follows this header as a (fragmented) binary message
+                binary_payloads.append(result_data)
+                payload_bytes = sum(len(fragment) for fragment in result_data)
+                message_dict.update(data=None,
+                                    binary_frames=len(binary_payloads),
+                                    binary_bytes=payload_bytes
+                                    )
+            else:
+                payload_bytes = len(result_data)
+                message_dict.update(data=result_data)
 
-            if self.all_rows_fetched:
+            if self.spool:
+                message_dict.update(offset=self.scroll_offset,
+                                    total_rows=self.spool.num_rows if self.spool.exhausted else None
+                                    )
+                if self.spool.exhausted and self.cursor:
+                    # Everything is spooled - so the backend cursor (and its connection) can go
+                    await self.release_cursor()
+            elif self.all_rows_fetched:
                 await self.close_cursor()
         finally:
-            await self.client.websocket_connection.send(json.dumps(message_dict))
+            send_start_time = time.perf_counter()
+            try:
+                await self.client.send_message(message_dict, binary_payloads=binary_payloads)
+            finally:
+                # The results hold their memory budget until they are sent
+                message_dict.update(data=None)
+                binary_payloads.clear()
+                result_data = None
+                if release_results:
+                    release_results()
+            send_seconds = time.perf_counter() - send_start_time
+            self.last_send_seconds = send_seconds
+            self.fetch_sizer.observe(rows=batch_rows_fetched,
+                                     arrow_bytes=batch_bytes_fetched,
+                                     payload_bytes=payload_bytes,
+                                     send_seconds=send_seconds
+                                     )
+            metrics = self.client.server.metrics
+            metrics.fetches.inc(status="success" if message_dict.get("success") else "error")
+            if message_dict.get("success"):
+                metrics.send_seconds.observe(send_seconds)
+                metrics.rows_sent.inc(batch_rows_fetched)
             logger.info(
-                msg=f"Sent Query: '{self.query_id}' Fetch results (size: {getsizeof(message_dict)}) to SQL "
-                    f"Client: '{self.client.client_id}'"
+                msg=f"Sent Query: '{self.query_id}' Fetch results (size: {getsizeof(message_dict) + payload_bytes}) to SQL "
+                    f"Client: '{self.client.client_id}' in {send_seconds:.4f} second(s)"
             )
+
+        return message_dict, payload_bytes
+
+    def grant_credits(self,
+                      batches: int = 0,
+                      bytes: int = None
+                      ):
+        """
+        Grants stream credits - the server may push a batch while it has batch credits (and byte credits - if
+        the client is using them) remaining.
+
+        :param batches: The number of additional batches the server may push.
+        :param bytes: The number of additional payload bytes the server may push.
+        """
+        self.stream_credits += batches or 0
+        if bytes is not None:
+            self.stream_credit_bytes = (self.stream_credit_bytes or 0) + bytes
+        self.stream_credit_event.set()
+
+    def has_stream_credits(self) -> bool:
+        return self.stream_credits > 0 and (self.stream_credit_bytes is None or self.stream_credit_bytes > 0)
+
+    async def stream_results(self,
+                             fetch_size: int,
+                             fetch_bytes: int,
+                             fetch_sizing: FetchSizing,
+                             result_format: ResultFormat,
+                             compression: str | None,
+                             compression_level: int | None
+                             ):
+        message_dict = dict()
+        try:
+            while not self.stream_stopped:
+                while not self.has_stream_credits() and not self.stream_stopped:
+                    self.stream_credit_event.clear()
+                    await self.stream_credit_event.wait()
+
+                if self.stream_stopped:
+                    break
+
+                message_dict, payload_bytes = await self.fetch_and_send_results(fetch_mode="stream",
+                                                                                fetch_size=fetch_size,
+                                                                                fetch_bytes=fetch_bytes,
+                                                                                fetch_sizing=fetch_sizing,
+                                                                                result_format=result_format,
+                                                                                compression=compression,
+                                                                                compression_level=compression_level
+                                                                                )
+                self.stream_credits -= 1
+                if self.stream_credit_bytes is not None:
+                    self.stream_credit_bytes -= payload_bytes
+
+                if not message_dict.get("success") or self.all_rows_fetched:
+                    break
+        except websockets.exceptions.ConnectionClosed:
+            return
+        except Exception as e:
+            # Nobody awaits the stream's task - so the client is told here (rather than the error going unretrieved)
+            logger.error(msg=f"Query: '{self.query_id}' - stream FAILED - error: {str(e) or type(e).__name__}")
+            message_dict = dict(success=False,
+                                error=f"Stream for Query ID: {self.query_id} - FAILED on the server - with error: '{str(e)}'"
+                                )
+
+        message_dict = dict(kind="streamEnd",
+                            responseTo="fetch",
+                            query_id=self.query_id,
+                            success=message_dict.get("success", True),
+                            error=message_dict.get("error"),
+                            cancelled=self.stream_stopped,
+                            total_rows_fetched=self.rows_fetched,
+                            all_rows_fetched=self.all_rows_fetched,
+                            # The stream's final fetch has no later fetchResult to report its send time in
+                            timings=dict(last_send_seconds=self.last_send_seconds)
+                            )
+        try:
+            await self.client.send_message(message_dict)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.error(msg=f"Query: '{self.query_id}' - failed to send the end of its stream - error: {str(e) or type(e).__name__}")
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+from pathlib import Path
+
+from .metrics import MetricsRegistry, merge_snapshots, get_cumulative_snapshot
+from ..config import logger
+from ..constants import WORKER_MONITOR_INTERVAL, WORKER_MIN_UPTIME, WORKER_RESTART_DELAY, WORKER_MAX_RESTART_DELAY, \
+    WORKER_SHUTDOWN_TIMEOUT
+
+SUPERVISOR_METRICS_FILE_NAME = "supervisor.json"
+
+
+def get_worker_metrics_path(metrics_directory: str,
+                            worker_id: int
+                            ) -> Path:
+    return Path(metrics_directory) / f"worker-{worker_id}.json"
+
+
+def write_metrics_snapshot(path: Path,
+                           snapshot: dict
+                           ):
+    # Written aside and renamed into place - so that readers never see a partial file
+    temporary_path = path.with_name(f".{path.name}.{os.getpid()}")
+    temporary_path.write_text(json.dumps(snapshot))
+    os.replace(temporary_path, path)
+
+
+def read_metrics_snapshot(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def read_metrics_snapshots(metrics_directory: str,
+                           exclude: Path | None = None
+                           ) -> list[dict]:
+    """
+    The snapshots published by the supervisor and its workers.
+
+    :param exclude: A snapshot file not to read (e.g. the caller's own - which it has fresher values for).
+    """
+    snapshots = []
+    for path in sorted(Path(metrics_directory).glob("*.json")):
+        if path != exclude and (snapshot := read_metrics_snapshot(path)) is not None:
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def kill_process_group(process_group_id: int):
+    # Whatever is left of a worker's process group (e.g. its encoding processes - if it did not shut down cleanly)
+    try:
+        os.killpg(process_group_id, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_worker(server_arguments: dict,
+               worker_id: int,
+               metrics_directory: str,
+               log_level: int
+               ):
+    """
+    Runs one server worker process - until it is terminated (SIGTERM stops the server gracefully).  A
+    multiprocessing target.
+    """
+    from ..server import run_server
+
+    # A process group of our own (which our own processes join) - so that the supervisor can clean up after us
+    os.setpgid(0, 0)
+    # The supervisor shuts its workers down - so that a Ctrl-C in the terminal is not handled twice
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger().setLevel(log_level)
+    asyncio.run(run_server(**server_arguments,
+                           worker_id=worker_id,
+                           worker_metrics_directory=metrics_directory
+                           )
+                )
+
+
+class WorkerProcess:
+    def __init__(self,
+                 worker_id: int
+                 ):
+        self.worker_id = worker_id
+        self.process: multiprocessing.Process | None = None
+        self.started_at: float | None = None
+        # Quick successive crashes back off the restarts - so that a worker which cannot start does not spin
+        self.quick_exits = 0
+        self.restart_at: float | None = None
+
+
+class Supervisor:
+    """
+    Runs the server as several worker processes - each with its own event loop, database connections and caches -
+    which share the listening port with SO_REUSEPORT (the kernel balances new connections across them).  Workers
+    which exit are restarted.  Each worker publishes its metrics to a shared directory, and a metrics scrape (which
+    lands on any one worker) is answered with all of theirs combined - including the counts of workers which
+    have since exited.
+    """
+    def __init__(self,
+                 server_arguments: dict,
+                 workers: int
+                 ):
+        self.server_arguments = server_arguments
+        self.workers = [WorkerProcess(worker_id=worker_id) for worker_id in range(workers)]
+        self.context = multiprocessing.get_context("spawn")
+        self.metrics_directory: str | None = None
+        self.stopping = asyncio.Event()
+
+        # The supervisor's own metrics - and the counters and histograms of workers which have exited
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge(name="workers",
+                           help_text="Server worker processes running.",
+                           callback=lambda: sum(1 for worker in self.workers if worker.process and worker.process.is_alive())
+                           )
+        self.restarts = self.metrics.counter(name="worker_restarts_total",
+                                             help_text="Server worker processes restarted after they exited."
+                                             )
+        self.exited_worker_metrics: dict = {}
+
+    def start_worker(self,
+                     worker: WorkerProcess
+                     ):
+        process = self.context.Process(target=run_worker,
+                                       kwargs=dict(server_arguments=self.server_arguments,
+                                                   worker_id=worker.worker_id,
+                                                   metrics_directory=self.metrics_directory,
+                                                   log_level=logging.getLogger().level
+                                                   ),
+                                       name=f"flight-sql-websocket-proxy-worker-{worker.worker_id}",
+                                       daemon=False
+                                       )
+        process.start()
+        worker.process = process
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info(msg=f"Started server worker: {worker.worker_id} - pid: {worker.process.pid}")
+
+    def handle_exit(self,
+                    worker: WorkerProcess
+                    ):
+        uptime = time.monotonic() - worker.started_at
+        logger.error(msg=f"Server worker: {worker.worker_id} (pid: {worker.process.pid}) exited with code: {worker.process.exitcode} after {uptime:.1f} second(s) - restarting it")
+
+        kill_process_group(worker.process.pid)
+
+        # Keep what the worker counted - so that the combined counters never go down
+        metrics_path = get_worker_metrics_path(metrics_directory=self.metrics_directory, worker_id=worker.worker_id)
+        if (snapshot := read_metrics_snapshot(metrics_path)) is not None:
+            self.exited_worker_metrics = merge_snapshots([self.exited_worker_metrics, get_cumulative_snapshot(snapshot)])
+        metrics_path.unlink(missing_ok=True)
+
+        worker.process = None
+        worker.quick_exits = worker.quick_exits + 1 if uptime < WORKER_MIN_UPTIME else 0
+        restart_delay = min(WORKER_RESTART_DELAY * 2 ** max(worker.quick_exits - 1, 0), WORKER_MAX_RESTART_DELAY) if worker.quick_exits else 0
+        worker.restart_at = time.monotonic() + restart_delay
+
+    def publish_metrics(self):
+        write_metrics_snapshot(path=Path(self.metrics_directory) / SUPERVISOR_METRICS_FILE_NAME,
+                               snapshot=merge_snapshots([self.metrics.snapshot(), self.exited_worker_metrics])
+                               )
+
+    def stop_workers(self):
+        processes = [worker.process for worker in self.workers if worker.process]
+        for process in processes:
+            process.terminate()
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        for process in processes:
+            process.join(timeout=max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(msg=f"Server worker process: {process.pid} did not stop in {WORKER_SHUTDOWN_TIMEOUT} second(s) - killing it")
+            kill_process_group(process.pid)
+            process.join()
+
+    async def run(self):
+        event_loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            event_loop.add_signal_handler(signal_number, self.stopping.set)
+
+        self.metrics_directory = tempfile.mkdtemp(prefix="flight-sql-websocket-proxy-metrics-")
+        logger.info(msg=f"Starting {len(self.workers)} server worker(s) - sharing port: {self.server_arguments['port']}")
+        try:
+            for worker in self.workers:
+                self.start_worker(worker)
+
+            while not self.stopping.is_set():
+                for worker in self.workers:
+                    if worker.process and not worker.process.is_alive():
+                        self.handle_exit(worker)
+                    if worker.process is None and worker.restart_at <= time.monotonic():
+                        self.restarts.inc()
+                        self.start_worker(worker)
+                self.publish_metrics()
+
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), timeout=WORKER_MONITOR_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            logger.info(msg="Stopping the server workers")
+            await event_loop.run_in_executor(None, self.stop_workers)
+            shutil.rmtree(self.metrics_directory, ignore_errors=True)
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import time
+from datetime import UTC, datetime
+
+from munch import Munch
+
+from .common import CaptureSql
+from .result_cache import redact_sql
+from ..constants import CAPTURE_FORMAT_VERSION
+
+# Request fields which are never copied into a capture - credentials, and fields which are recorded in a form of their own
+CAPTURE_EXCLUDED_REQUEST_FIELDS = {"action", "token", "request_id", "query_id", "sql", "parameters"}
+CAPTURE_EVENT_FIELDS = {"t", "s", "a", "k", "q"}
+
+
+def get_sql_fingerprint(sql: str) -> str:
+    return hashlib.sha256(redact_sql(sql).encode()).hexdigest()[:16]
+
+
+class WorkloadCapture:
+    """
+    Records each session's requests (with the time they arrived - relative to the start of the capture) and the
+    size of each response - never any result data, or credentials - as JSON lines, for benchmark/replay.py to
+    re-drive against a proxy.  Sessions are numbered - and so are each session's queries (in the order they
+    arrived), in place of their IDs.  A header line is followed by one event per line - e.g.:
+
+      {"t":0.0012,"s":1,"a":"open"}
+      {"t":0.0518,"s":1,"a":"query","q":0,"fp":"9f2c...","sql":"SELECT * FROM t WHERE x = 0","np":0}
+      {"t":0.0934,"s":1,"k":"queryResult","q":0,"ok":true,"ex":0.0401}
+      {"t":0.1002,"s":1,"a":"fetch","q":0,"fetch_mode":"batch","fetch_size":10000}
+      {"t":0.1227,"s":1,"k":"fetchResult","q":0,"ok":true,"rows":10000,"bytes":412345}
+      {"t":9.8031,"s":1,"a":"close"}
+
+    It is only used from the event loop - so it needs no lock.
+    """
+    def __init__(self,
+                 path: str,
+                 capture_sql: CaptureSql
+                 ):
+        self.path = path
+        self.capture_sql = CaptureSql(capture_sql)
+        self.start_time = time.perf_counter()
+        self.session_count = 0
+        self.event_count = 0
+
+        # Line buffered - so that a server which is killed leaves a complete capture behind
+        self.capture_file = open(path, "w", buffering=1)
+        self.write(dict(capture="flight-sql-websocket-proxy",
+                        version=CAPTURE_FORMAT_VERSION,
+                        started_at=datetime.now(tz=UTC).isoformat(),
+                        sql=self.capture_sql
+                        )
+                   )
+
+    def write(self,
+              line_dict: dict
+              ):
+        if self.capture_file.closed:
+            return
+        self.capture_file.write(json.dumps(line_dict, separators=(",", ":"), default=str) + "\n")
+
+    def record(self,
+               event_time: float,
+               session_number: int,
+               **fields
+               ):
+        self.write(dict(t=round(event_time - self.start_time, 4),
+                        s=session_number,
+                        **fields
+                        )
+                   )
+        self.event_count += 1
+
+    def open_session(self) -> "CaptureSession":
+        self.session_count += 1
+        capture_session = CaptureSession(capture=self,
+                                         session_number=self.session_count
+                                         )
+        self.record(event_time=time.perf_counter(),
+                    session_number=capture_session.session_number,
+                    a="open"
+                    )
+        return capture_session
+
+    def get_sql_fields(self,
+                       sql: str,
+                       parameters: list | None
+                       ) -> dict:
+        sql_fields = dict(fp=get_sql_fingerprint(sql))
+        if self.capture_sql == CaptureSql.FULL:
+            sql_fields.update(sql=sql, parameters=parameters)
+        else:
+            if self.capture_sql == CaptureSql.REDACTED:
+                sql_fields.update(sql=redact_sql(sql))
+            sql_fields.update(np=len(parameters or []))
+        return sql_fields
+
+    def close(self):
+        self.capture_file.close()
+
+    def stats(self) -> dict:
+        return dict(path=self.path,
+                    sql=self.capture_sql,
+                    sessions=self.session_count,
+                    events=self.event_count
+                    )
+
+
+class CaptureSession:
+    """
+    One websocket session's view of the capture - it numbers the session's queries.
+    """
+    def __init__(self,
+                 capture: WorkloadCapture,
+                 session_number: int
+                 ):
+        self.capture = capture
+        self.session_number = session_number
+        self.query_numbers: dict[str, int] = {}
+
+    def record(self,
+               event_time: float | None = None,
+               **fields
+               ):
+        self.capture.record(event_time=event_time or time.perf_counter(),
+                            session_number=self.session_number,
+                            **fields
+                            )
+
+    def record_request(self,
+                       message: Munch,
+                       received_time: float,
+                       query_id: str | None = None
+                       ):
+        """
+        :param query_id: For a query request - the ID the server gave the new query.
+        """
+        event = {key: value for key, value in message.items()
+                 if key not in CAPTURE_EXCLUDED_REQUEST_FIELDS | CAPTURE_EVENT_FIELDS}
+        if message.action == "query":
+            self.query_numbers[query_id] = len(self.query_numbers)
+            event.update(self.capture.get_sql_fields(sql=message.get("sql") or "",
+                                                     parameters=message.get("parameters")
+                                                     )
+                         )
+            event.update(q=self.query_numbers[query_id])
+        elif "query_id" in message:
+            # None for a query ID this session never had - which is replayed as such
+            event.update(q=self.query_numbers.get(message.query_id))
+
+        self.record(event_time=received_time, a=message.action, **event)
+
+    def record_response(self,
+                        message_dict: dict,
+                        wire_bytes: int
+                        ):
+        # Only responses to requests - not the greeting
+        if "responseTo" not in message_dict:
+            return
+
+        event = dict(k=message_dict["kind"])
+        if message_dict["kind"] == "error":
+            event.update(r=message_dict["responseTo"])
+        if "query_id" in message_dict:
+            event.update(q=self.query_numbers.get(message_dict["query_id"]))
+        event.update(ok=message_dict.get("success"))
+
+        if message_dict["kind"] == "queryResult" and message_dict.get("success"):
+            event.update(ex=(message_dict.get("timings") or {}).get("execute_seconds"),
+                         cached=message_dict.get("cached")
+                         )
+        elif message_dict["kind"] == "fetchResult" and message_dict.get("success"):
+            event.update(rows=message_dict.get("batch_rows_fetched"),
+                         bytes=wire_bytes
+                         )
+        elif message_dict["kind"] == "streamEnd":
+            event.update(cancelled=message_dict.get("cancelled"))
+
+        self.record(**event)
+
+    def close(self):
+        self.record(a="close")
@@ -6,16 +6,16 @@ import re
 import shutil
 from datetime import UTC, datetime, timedelta
 from functools import wraps
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Tuple
 
 import psutil
 import pyarrow
-from codetiming import Timer
 from dotenv import load_dotenv
 from munch import Munch
 from pyarrow import parquet as pq
 
 from .config import logger
+from .constants import IPC_SMALL_CHUNK_SIZE, IPC_COMPRESSION_CODECS
 
 # Load our environment file if it is present
 load_dotenv(dotenv_path=".env")
@@ -37,11 +37,17 @@ def get_cpu_count():
 
 
 def get_memory_limit():
-    if os.path.isfile('/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+    memory_limit = psutil.virtual_memory().total
+    if os.path.isfile('/sys/fs/cgroup/memory.max'):
+        # cgroup v2 - "max" means no limit
+        with open('/sys/fs/cgroup/memory.max') as limit:
+            limit_value = limit.read().strip()
+        if limit_value != "max":
+            memory_limit = min(memory_limit, int(limit_value))
+    elif os.path.isfile('/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        # cgroup v1 - an unlimited cgroup reports a huge number, so we cap it at the physical memory
         with open('/sys/fs/cgroup/memory/memory.limit_in_bytes') as limit:
-            memory_limit = int(limit.read())
-    else:
-        memory_limit = psutil.virtual_memory().total
+            memory_limit = min(memory_limit, int(limit.read()))
 
     return memory_limit
 
@@ -64,13 +70,130 @@ def get_dataframe_from_parquet_bytes(bytes_value: bytes) -> pyarrow.Table:
     return pq.read_table(source=pyarrow.BufferReader(pyarrow.py_buffer(bytes_value)))
 
 
-def get_dataframe_ipc_bytes(df: pyarrow.Table) -> bytes:
+def get_ipc_write_options(compression: str | None = None,
+                          compression_level: int | None = None
+                          ) -> pyarrow.ipc.IpcWriteOptions:
+    """
+    Builds the IPC write options for the requested record batch body compression.
+
+    :param compression: The codec to compress IPC buffers with: 'lz4' (LZ4_FRAME), 'zstd' - or None/'none' for
+                        uncompressed IPC.
+    :param compression_level: Optional codec compression level - the codec's default is used if not set.
+    :raises ValueError: If the codec or level is not supported.
+    """
+    if compression in (None, "", "none"):
+        return pyarrow.ipc.IpcWriteOptions()
+
+    compression = compression.lower()
+    if compression not in IPC_COMPRESSION_CODECS:
+        raise ValueError(f"Invalid compression: '{compression}' - must be one of: {['none'] + IPC_COMPRESSION_CODECS}")
+
+    if not pyarrow.Codec.is_available(compression):
+        raise ValueError(f"Compression codec: '{compression}' is not available in this build of pyarrow")
+
+    try:
+        codec = pyarrow.Codec(compression=compression,
+                              compression_level=compression_level
+                              )
+    except (ValueError, pyarrow.ArrowException) as e:
+        raise ValueError(f"Invalid compression level: {compression_level} for compression: '{compression}' - error: {str(e)}")
+
+    return pyarrow.ipc.IpcWriteOptions(compression=codec)
+
+
+def get_dataframe_ipc_buffer(df: pyarrow.Table,
+                             options: pyarrow.ipc.IpcWriteOptions = None
+                             ) -> pyarrow.Buffer:
     sink = pyarrow.BufferOutputStream()
-    with pyarrow.ipc.new_stream(sink, df.schema) as writer:
+    with pyarrow.ipc.new_stream(sink, df.schema, options=options) as writer:
         writer.write(df)
-    buf = sink.getvalue()
-    return buf.to_pybytes()
+    return sink.getvalue()
 
 
-def get_dataframe_results_as_ipc_base64_str(df: pyarrow.Table) -> str:
-    return base64.b64encode(get_dataframe_ipc_bytes(df)).decode()
+def get_dataframe_ipc_bytes(df: pyarrow.Table) -> bytes:
+    return get_dataframe_ipc_buffer(df).to_pybytes()
+
+
+def get_dataframe_results_as_ipc_base64_str(df: pyarrow.Table,
+                                            options: pyarrow.ipc.IpcWriteOptions = None
+                                            ) -> str:
+    # b64encode accepts any bytes-like object - so we skip the intermediate to_pybytes() copy
+    return base64.b64encode(get_dataframe_ipc_buffer(df, options=options)).decode()
+
+
+class IpcStreamSink:
+    """
+    A write-only file-like object for pyarrow's IPC stream writer.  It keeps the chunks it is handed instead
+    of copying them into one contiguous buffer - Arrow passes record batch body buffers through as-is, so draining
+    the sink yields views over the batches' own memory.
+    """
+    def __init__(self, max_fragment_size: int):
+        self.max_fragment_size = max_fragment_size
+        self.pending_chunks = []
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.pending_chunks.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> Iterator[bytearray | memoryview]:
+        """
+        Yields the written chunks as WebSocket fragments of at most max_fragment_size bytes.  Small chunks (IPC
+        message metadata, padding, etc.) are coalesced, large buffers are sliced via memoryview - without copying.
+        """
+        small_chunk_size = min(IPC_SMALL_CHUNK_SIZE, self.max_fragment_size)
+        small_chunks = bytearray()
+        for chunk in self.pending_chunks:
+            chunk_view = memoryview(chunk)
+            if chunk_view.nbytes < small_chunk_size:
+                # Flush before the chunk would take the fragment over max_fragment_size - not after
+                if len(small_chunks) + chunk_view.nbytes > self.max_fragment_size:
+                    yield small_chunks
+                    small_chunks = bytearray()
+                small_chunks += chunk_view
+            else:
+                if small_chunks:
+                    yield small_chunks
+                    small_chunks = bytearray()
+                for offset in range(0, chunk_view.nbytes, self.max_fragment_size):
+                    yield chunk_view[offset:offset + self.max_fragment_size]
+
+        if small_chunks:
+            yield small_chunks
+
+        self.pending_chunks.clear()
+
+
+def get_record_batches_ipc_fragments(schema: pyarrow.Schema,
+                                     record_batches: Iterable[pyarrow.RecordBatch],
+                                     max_fragment_size: int,
+                                     options: pyarrow.ipc.IpcWriteOptions = None
+                                     ) -> Iterator[bytearray | memoryview]:
+    """
+    Serializes record batches as an Arrow IPC stream - one batch at a time - yielding it as WebSocket fragments.
+    The IPC stream is never held in memory as one contiguous copy.
+    """
+    sink = IpcStreamSink(max_fragment_size=max_fragment_size)
+    with pyarrow.ipc.new_stream(sink, schema, options=options) as writer:
+        for record_batch in record_batches:
+            writer.write_batch(record_batch)
+            yield from sink.drain()
+
+    # The end-of-stream marker (and the schema - if there were no batches)
+    yield from sink.drain()
+
+
+def get_payload_size(payload) -> int:
+    """
+    :param payload: A bytes-like object - or a list of bytes-like fragments (as sent as one fragmented message).
+    :return: The payload's size in bytes.
+    """
+    if isinstance(payload, (list, tuple)):
+        return sum(get_payload_size(fragment) for fragment in payload)
+    return memoryview(payload).nbytes
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("adbc_driver_flightsql")
+
+from flight_sql_websocket_proxy.server_components import backend_router
+from flight_sql_websocket_proxy.server_components.backend_router import BackendRouter
+from flight_sql_websocket_proxy.server_components.connection_pool import ConnectionPool
+
+BACKEND_URI = "grpc://replica:31337"
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+        self.in_use = False
+
+    def close(self):
+        assert not self.in_use, "closed while the health check was using it"
+        self.closed = True
+
+
+class HungBackendPool(ConnectionPool):
+    # Connects and health checks block until they are released - like a hung backend
+    def __init__(self, hang_connects: bool, **kwargs):
+        super().__init__(**kwargs)
+        self.hang_connects = hang_connects
+        self.release = threading.Event()
+        self.connections = []
+
+    def _connect(self, key):
+        if self.hang_connects:
+            self.release.wait()
+        connection = FakeConnection()
+        self.connections.append(connection)
+        return connection
+
+    def _check_health(self, pooled_connection):
+        pooled_connection.connection.in_use = True
+        self.release.wait()
+        pooled_connection.connection.in_use = False
+
+
+def get_router(hang_connects: bool) -> BackendRouter:
+    server = SimpleNamespace(thread_pool=ThreadPoolExecutor(max_workers=8),
+                             event_loop=asyncio.get_running_loop(),
+                             database_server_uri=BACKEND_URI,
+                             database_username="user",
+                             database_password="password",
+                             database_tls_skip_verify=False,
+                             database_backend_uris=[BACKEND_URI]
+                             )
+    server.connection_pool = HungBackendPool(hang_connects=hang_connects,
+                                             server=server,
+                                             min_size=0,
+                                             max_size=3,
+                                             idle_timeout=60,
+                                             health_check_interval=60,
+                                             checkout_timeout=1
+                                             )
+    return BackendRouter(server=server,
+                         backend_uris=[BACKEND_URI, "grpc://other:31337"],
+                         policy="least_outstanding",
+                         health_check_interval=60,
+                         ejection_threshold=3,
+                         ejection_seconds=60,
+                         max_retries=1
+                         )
+
+
+async def wait_until(condition):
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out waiting for the condition")
+
+
+def test_timed_out_connects_do_not_leak_pool_slots(monkeypatch):
+    monkeypatch.setattr(backend_router, "BACKEND_HEALTH_CHECK_TIMEOUT", 0.05)
+
+    async def run():
+        router = get_router(hang_connects=True)
+        connection_pool = router.server.connection_pool
+        for _ in range(4):
+            await router.check_backend(router.get_backend(BACKEND_URI))
+        assert connection_pool.size == 0
+        assert router.get_backend(BACKEND_URI).failures == 0
+
+        # The hung connects complete late - and their connections are closed
+        connection_pool.release.set()
+        await wait_until(lambda: len(connection_pool.connections) == 4 and all(connection.closed for connection in connection_pool.connections))
+        router.server.thread_pool.shutdown()
+
+    asyncio.run(run())
+
+
+def test_a_timed_out_health_check_discards_its_connection_once_the_probe_is_done(monkeypatch):
+    monkeypatch.setattr(backend_router, "BACKEND_HEALTH_CHECK_TIMEOUT", 0.05)
+
+    async def run():
+        router = get_router(hang_connects=False)
+        connection_pool = router.server.connection_pool
+        await router.check_backend(router.get_backend(BACKEND_URI))
+        connection = connection_pool.connections[0]
+        assert not connection.closed and connection_pool.size == 1
+
+        connection_pool.release.set()
+        await wait_until(lambda: connection.closed and connection_pool.size == 0)
+        router.server.thread_pool.shutdown()
+
+    asyncio.run(run())
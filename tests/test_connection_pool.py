@@ -0,0 +1,99 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("adbc_driver_flightsql")
+
+from flight_sql_websocket_proxy.server_components.connection_pool import ConnectionPool
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class SlowConnectPool(ConnectionPool):
+    # Connects block until they are released - like a hung backend
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.release_connects = threading.Event()
+        self.connections = []
+
+    def _connect(self, key):
+        self.release_connects.wait()
+        connection = FakeConnection()
+        self.connections.append(connection)
+        return connection
+
+
+def get_pool(max_size: int,
+             checkout_timeout: int = 1
+             ) -> SlowConnectPool:
+    server = SimpleNamespace(thread_pool=ThreadPoolExecutor(max_workers=4),
+                             event_loop=asyncio.get_running_loop(),
+                             database_server_uri="grpc://backend:31337",
+                             database_username="user",
+                             database_password="password",
+                             database_tls_skip_verify=False,
+                             database_backend_uris=["grpc://backend:31337"]
+                             )
+    return SlowConnectPool(server=server,
+                           min_size=0,
+                           max_size=max_size,
+                           idle_timeout=60,
+                           health_check_interval=60,
+                           checkout_timeout=checkout_timeout
+                           )
+
+
+def test_a_cancelled_checkout_gives_back_its_slot_and_closes_the_late_connection():
+    async def run():
+        pool = get_pool(max_size=1)
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(pool.checkout(autocommit=True), timeout=0.05)
+        assert pool.size == 0
+
+        # The connect completes after its checkout was cancelled
+        pool.release_connects.set()
+        for _ in range(100):
+            if pool.connections and pool.connections[0].closed:
+                break
+            await asyncio.sleep(0.01)
+        assert pool.connections[0].closed
+
+        pooled_connection = await pool.checkout(autocommit=True)
+        assert pool.size == 1 and not pooled_connection.connection.closed
+        pool.server.thread_pool.shutdown()
+
+    asyncio.run(run())
+
+
+def test_the_checkout_timeout_is_for_the_whole_checkout():
+    async def run():
+        pool = get_pool(max_size=1, checkout_timeout=1)
+        pool.release_connects.set()
+        pooled_connection = await pool.checkout(autocommit=True)
+
+        async def notify_without_checkin():
+            # Wakes the waiter again and again - without ever making a connection available
+            while True:
+                await asyncio.sleep(0.2)
+                async with pool.condition:
+                    pool.condition.notify_all()
+
+        notifier = asyncio.create_task(notify_without_checkin())
+        start_time = asyncio.get_running_loop().time()
+        with pytest.raises(TimeoutError):
+            await pool.checkout(autocommit=True)
+        assert asyncio.get_running_loop().time() - start_time < 1.5
+        notifier.cancel()
+        await pool.checkin(pooled_connection, discard=True)
+        pool.server.thread_pool.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("duckdb")
+pytest.importorskip("pglast")
+
+from flight_sql_websocket_proxy.parser.query import Query
+
+
+@pytest.mark.parametrize("query_text", ["SELECT median(x) FROM t",
+                                        "SELECT g, sum(x), stddev(x) FROM t GROUP BY g",
+                                        "SELECT g, string_agg(y, ',') FROM t GROUP BY g",
+                                        "SELECT g, approx_count_distinct(y) FROM t GROUP BY g",
+                                        "SELECT g, my_aggregate(x) FROM t GROUP BY g",
+                                        "SELECT g, sum(x) / median(x) FROM t GROUP BY g"
+                                        ])
+def test_aggregates_which_cannot_be_re_aggregated_are_merge_problems(query_text):
+    assert not Query(query_text=query_text).is_exactly_mergeable
+
+
+def test_other_aggregates_are_not_group_keys():
+    query = Query(query_text="SELECT g, sum(x), stddev(x) FROM t GROUP BY g")
+    assert query.get_summary_query(column_names=["g", "s", "sd"]) == \
+        'SELECT "g", SUM("s") AS "s", ANY_VALUE("sd") AS "sd" FROM combined_result GROUP BY "g"'
+
+
+def test_a_lone_other_aggregate_is_summarized():
+    query = Query(query_text="SELECT median(x) FROM t")
+    assert query.get_summary_query(column_names=["m"]) == 'SELECT ANY_VALUE("m") AS "m" FROM combined_result'
+
+
+def test_scalar_functions_merge_exactly():
+    query = Query(query_text="SELECT upper(g), extract(year FROM d), count(*) FROM t GROUP BY 1, 2 ORDER BY 3 DESC LIMIT 5")
+    assert query.is_exactly_mergeable
+    assert query.get_summary_query(column_names=["g", "y", "c"]) == \
+        'SELECT "g", "y", SUM("c") AS "c" FROM combined_result GROUP BY "g", "y" ORDER BY "c" DESC LIMIT 5'
@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from flight_sql_websocket_proxy.server_components.result_cache import redact_sql, normalize_sql, is_read_only_sql
+
+
+@pytest.mark.parametrize("sql, redacted_sql", [("SELECT * FROM t WHERE a = 'secret' AND b = 42", "SELECT * FROM t WHERE a = '?' AND b = 0"),
+                                               ("SELECT 'it''s secret'", "SELECT '?'"),
+                                               ("SELECT E'it\\'s secret'", "SELECT '?'"),
+                                               ("SELECT e'a\\\\', 'b'", "SELECT '?', '?'"),
+                                               ("SELECT $$secret$$", "SELECT '?'"),
+                                               ("SELECT $tag$it's $$ a secret$tag$ AS x", "SELECT '?' AS x"),
+                                               ("SELECT $a$one$a$, $b$two$b$", "SELECT '?', '?'"),
+                                               ("SELECT * FROM t WHERE a = $1 AND b = ?", "SELECT * FROM t WHERE a = $1 AND b = ?"),
+                                               ("SELECT \"col'1\", a$b FROM t1", "SELECT \"col'1\", a$b FROM t1")
+                                               ])
+def test_redact_sql(sql, redacted_sql):
+    assert redact_sql(sql) == redacted_sql
+
+
+def test_normalize_sql_keeps_comments_inside_dollar_quotes():
+    assert normalize_sql("SELECT $$ -- not a comment $$ -- a comment\n;") == "SELECT $$ -- not a comment $$"
+
+
+def test_keywords_inside_strings_do_not_make_sql_write():
+    assert is_read_only_sql("SELECT $$INSERT INTO t$$, E'\\'DROP TABLE t'")
+    assert not is_read_only_sql("SELECT 1 INTO t")
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from flight_sql_websocket_proxy.server_components.scheduler import QueryScheduler, QueryQueueFullError
+
+
+def test_cancelled_waiters_leave_the_queue():
+    async def run():
+        scheduler = QueryScheduler(max_concurrent_queries=1,
+                                   max_queries_per_user=1,
+                                   max_queue_depth=2
+                                   )
+        await scheduler.acquire(user="a")
+        waiters = [asyncio.create_task(scheduler.acquire(user="b")) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueryQueueFullError):
+            await scheduler.acquire(user="c")
+
+        # E.g. their clients disconnected
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        assert scheduler.queue == []
+        assert scheduler.stats()["queued"] == 0
+
+        # The fast path is back - once the running query is done
+        scheduler.release(user="a")
+        assert await asyncio.wait_for(scheduler.acquire(user="c"), timeout=1) == 0.0
+
+    asyncio.run(run())
+
+
+def test_waiters_are_dispatched_in_fair_order():
+    async def run():
+        scheduler = QueryScheduler(max_concurrent_queries=1,
+                                   max_queries_per_user=1,
+                                   max_queue_depth=10
+                                   )
+        await scheduler.acquire(user="a")
+        order = []
+
+        async def run_query(user: str):
+            await scheduler.acquire(user=user)
+            order.append(user)
+            await asyncio.sleep(0)
+            scheduler.release(user=user)
+
+        tasks = [asyncio.create_task(run_query(user)) for user in ["a", "a", "a", "b"]]
+        await asyncio.sleep(0)
+        scheduler.release(user="a")
+        await asyncio.gather(*tasks)
+        # One user's backlog does not starve another user's query
+        assert order.index("b") <= 1
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+import pyarrow
+import pyarrow.ipc
+import pytest
+
+from flight_sql_websocket_proxy.utils import IpcStreamSink, get_record_batches_ipc_fragments
+
+
+@pytest.mark.parametrize("max_fragment_size", [1024, 65536, 100000])
+def test_fragments_never_exceed_the_max_fragment_size(max_fragment_size):
+    sink = IpcStreamSink(max_fragment_size=max_fragment_size)
+    # Small chunks which do not divide the max fragment size evenly - the coalescing must not overshoot it
+    for _ in range(100):
+        sink.write(b"x" * 20000)
+        sink.write(b"y" * 1000)
+    sink.write(b"z" * 300000)
+
+    fragments = list(sink.drain())
+    assert all(memoryview(fragment).nbytes <= max_fragment_size for fragment in fragments)
+    assert b"".join(bytes(fragment) for fragment in fragments) == (b"x" * 20000 + b"y" * 1000) * 100 + b"z" * 300000
+
+
+def test_record_batch_fragments_are_an_ipc_stream():
+    record_batches = [pyarrow.record_batch([pyarrow.array(range(start, start + 5000)),
+                                            pyarrow.array([str(i) for i in range(5000)])
+                                            ],
+                                           names=["id", "name"]
+                                           )
+                      for start in range(0, 50000, 5000)]
+    fragments = list(get_record_batches_ipc_fragments(schema=record_batches[0].schema,
+                                                      record_batches=record_batches,
+                                                      max_fragment_size=65536
+                                                      ))
+    assert all(memoryview(fragment).nbytes <= 65536 for fragment in fragments)
+    table = pyarrow.ipc.open_stream(b"".join(bytes(fragment) for fragment in fragments)).read_all()
+    assert table.equals(pyarrow.Table.from_batches(record_batches))